@@ -13,14 +13,16 @@ import cffi
 
 COMPILE_CMD = ("gcc -Wall -g -O2 -shared -fPIC"
                " -flto -fwhole-program -fno-use-linker-plugin"
-               " -o %s %s")
+               " -o %s %s -lpthread")
 SOURCE_FILES = [
     'pyhelper.c', 'serialqueue.c', 'stepcompress.c', 'itersolve.c',
-    'kin_cartesian.c', 'kin_corexy.c', 'kin_delta.c', 'kin_extruder.c'
+    'kin_cartesian.c', 'kin_corexy.c', 'kin_delta.c', 'kin_extruder.c',
+    'lookahead.c', 'msgblock.c', 'threadpool.c'
 ]
 DEST_LIB = "c_helper.so"
 OTHER_FILES = [
-    'list.h', 'serialqueue.h', 'stepcompress.h', 'itersolve.h', 'pyhelper.h'
+    'list.h', 'serialqueue.h', 'stepcompress.h', 'itersolve.h', 'pyhelper.h',
+    'msgblock.h', 'threadpool.h'
 ]
 
 defs_stepcompress = """
@@ -32,13 +34,19 @@ defs_stepcompress = """
     int stepcompress_reset(struct stepcompress *sc, uint64_t last_step_clock);
     int stepcompress_set_homing(struct stepcompress *sc, uint64_t homing_clock);
     int stepcompress_queue_msg(struct stepcompress *sc, uint32_t *data, int len);
+    void stepcompress_get_stats(struct stepcompress *sc, char *buf, int len);
 
     struct steppersync *steppersync_alloc(struct serialqueue *sq
         , struct stepcompress **sc_list, int sc_num, int move_num);
     void steppersync_free(struct steppersync *ss);
     void steppersync_set_time(struct steppersync *ss
         , double time_offset, double mcu_freq);
+    void steppersync_set_thread_pool(struct steppersync *ss
+        , struct thread_pool *tp);
+    void steppersync_set_adaptive_error(struct steppersync *ss
+        , uint32_t max_error, double link_rate, double link_backlog);
     int steppersync_flush(struct steppersync *ss, uint64_t move_clock);
+    void steppersync_get_stats(struct steppersync *ss, char *buf, int len);
 """
 
 defs_itersolve = """
@@ -55,6 +63,16 @@ defs_itersolve = """
         , double x, double y, double z);
     void itersolve_set_commanded_pos(struct stepper_kinematics *sk, double pos);
     double itersolve_get_commanded_pos(struct stepper_kinematics *sk);
+    int32_t itersolve_set_analytic(struct stepper_kinematics *sk, int enable);
+    struct stepgen_pool *stepgen_pool_alloc(int num_threads);
+    void stepgen_pool_free(struct stepgen_pool *sp);
+    void stepgen_pool_queue(struct stepgen_pool *sp
+        , struct stepper_kinematics *sk, struct move *m);
+    int32_t stepgen_pool_flush(struct stepgen_pool *sp);
+    int32_t move_batch_gen_steps(double *records, int record_count
+        , struct stepper_kinematics **sks, int *job_records, int job_count
+        , struct stepgen_pool *sp, struct steppersync **ss_list
+        , double *ss_clock_adj, int ss_count);
 """
 
 defs_kin_cartesian = """
@@ -78,6 +96,21 @@ defs_kin_extruder = """
         , double extra_accel_v, double extra_decel_v);
 """
 
+defs_lookahead = """
+    struct lookahead *lookahead_alloc(void);
+    void lookahead_free(struct lookahead *la);
+    void lookahead_reset(struct lookahead *la);
+    double lookahead_add_move(struct lookahead *la, int is_kinematic_move
+        , double move_d, double axes_d_x, double axes_d_y, double axes_d_z
+        , double accel, double max_cruise_v2, double delta_v2
+        , double smooth_delta_v2, double junction_deviation
+        , double extruder_v2);
+    int lookahead_flush(struct lookahead *la, int leftover, int lazy);
+    void lookahead_get_junctions(struct lookahead *la, int start, int count
+        , double *out);
+    void lookahead_pop(struct lookahead *la, int count);
+"""
+
 defs_serialqueue = """
     #define MESSAGE_MAX 64
     struct pull_queue_message {
@@ -93,8 +126,16 @@ defs_serialqueue = """
     void serialqueue_free_commandqueue(struct command_queue *cq);
     void serialqueue_send(struct serialqueue *sq, struct command_queue *cq
         , uint8_t *msg, int len, uint64_t min_clock, uint64_t req_clock);
+    void serialqueue_send_params(struct serialqueue *sq
+        , struct command_queue *cq, int64_t *data, int len
+        , uint64_t min_clock, uint64_t req_clock);
+    void serialqueue_send_packed(struct serialqueue *sq
+        , struct command_queue *cq, uint8_t *data, int *lens, int count
+        , uint64_t min_clock, uint64_t req_clock);
     void serialqueue_pull(struct serialqueue *sq
         , struct pull_queue_message *pqm);
+    int serialqueue_pull_batch(struct serialqueue *sq
+        , struct pull_queue_message *pqm, int max);
     void serialqueue_set_baud_adjust(struct serialqueue *sq, double baud_adjust);
     void serialqueue_set_receive_window(struct serialqueue *sq
         , int receive_window);
@@ -105,6 +146,18 @@ defs_serialqueue = """
         , struct pull_queue_message *q, int max);
 """
 
+defs_msgblock = """
+    uint16_t msgblock_crc16_ccitt(uint8_t *buf, uint8_t len);
+    int msgblock_encode_params(uint8_t *out, int64_t *data, int count);
+    int msgblock_decode_params(uint8_t *buf, int len, int pos, uint8_t *types
+        , int count, int64_t *out);
+"""
+
+defs_threadpool = """
+    struct thread_pool *thread_pool_alloc(int num_threads);
+    void thread_pool_free(struct thread_pool *tp);
+"""
+
 defs_pyhelper = """
     void set_python_logging_callback(void (*func)(const char *));
     double get_monotonic(void);
@@ -116,7 +169,8 @@ defs_std = """
 
 defs_all = [
     defs_pyhelper, defs_serialqueue, defs_std, defs_stepcompress, defs_itersolve,
-    defs_kin_cartesian, defs_kin_corexy, defs_kin_delta, defs_kin_extruder
+    defs_kin_cartesian, defs_kin_corexy, defs_kin_delta, defs_kin_extruder,
+    defs_lookahead, defs_msgblock, defs_threadpool
 ]
 
 # Return the list of file modification times
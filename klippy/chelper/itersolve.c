@@ -11,6 +11,7 @@
 #include "itersolve.h" // struct coord
 #include "pyhelper.h" // errorf
 #include "stepcompress.h" // queue_append_start
+#include "threadpool.h" // thread_pool_run
 
 
 /****************************************************************
@@ -139,10 +140,15 @@ itersolve_find_step(struct stepper_kinematics *sk, struct move *m
     return best_guess;
 }
 
+static int32_t linear_gen_steps(struct stepper_kinematics *sk
+                                , struct move *m);
+
 // Generate step times for a stepper during a move
 int32_t __visible
 itersolve_gen_steps(struct stepper_kinematics *sk, struct move *m)
 {
+    if (sk->use_analytic)
+        return linear_gen_steps(sk, m);
     struct stepcompress *sc = sk->sc;
     sk_callback calc_position = sk->calc_position;
     double half_step = .5 * sk->step_dist;
@@ -207,6 +213,8 @@ itersolve_gen_steps(struct stepper_kinematics *sk, struct move *m)
     return 0;
 }
 
+
+
 void __visible
 itersolve_set_stepcompress(struct stepper_kinematics *sk
                            , struct stepcompress *sc, double step_dist)
@@ -236,3 +244,346 @@ itersolve_get_commanded_pos(struct stepper_kinematics *sk)
 {
     return sk->commanded_pos;
 }
+
+
+/****************************************************************
+ * Analytic solver for linear kinematics
+ ****************************************************************/
+
+// On cartesian and corexy kinematics the stepper position is a linear
+// function of the distance moved, which is a quadratic function of
+// time during each phase of the velocity trapezoid.  The step times
+// can therefore be calculated directly with the quadratic formula
+// instead of searching for them with itersolve_find_step().
+
+struct linear_solve {
+    struct queue_append qa;
+    double half_step, mcu_freq, commanded_pos;
+    int sdir;
+};
+
+// Generate the steps of a range where the stepper moves monotonically
+// from 'pos' (with velocity 'v' and half acceleration 'ha') until
+// 'end_time'
+static int32_t
+linear_gen_range(struct linear_solve *ls, double time, double end_time
+                 , double pos, double v, double ha)
+{
+    double range_t = end_time - time;
+    double end_pos = pos + (v + ha * range_t) * range_t;
+    double half_step = ls->half_step;
+    int dir = end_pos > ls->commanded_pos;
+    double dist = fabs(end_pos - ls->commanded_pos);
+    if (dir != ls->sdir) {
+        // Only change direction if going past midway point
+        if (dist < half_step + .000000001)
+            return 0;
+        int ret = queue_append_set_next_step_dir(&ls->qa, dir);
+        if (ret)
+            return ret;
+        ls->sdir = dir;
+    }
+    double step_offset = dir ? half_step : -half_step;
+    while (dist >= half_step) {
+        // Solve 'pos + (v + ha*t)*t = target' for t (using the form
+        // of the quadratic formula that avoids cancellation)
+        double target = ls->commanded_pos + step_offset;
+        double target_d = target - pos;
+        double t = 0.;
+        if (dir ? target_d > 0. : target_d < 0.) {
+            double disc = v*v + 4. * ha * target_d;
+            double sq = disc > 0. ? sqrt(disc) : 0.;
+            double denom = dir ? v + sq : sq - v;
+            if (denom > 0.)
+                t = 2. * fabs(target_d) / denom;
+        }
+        int ret = queue_append(&ls->qa, (time + t) * ls->mcu_freq);
+        if (ret)
+            return ret;
+        ls->commanded_pos = target + step_offset;
+        dist = dir ? end_pos - ls->commanded_pos : ls->commanded_pos - end_pos;
+    }
+    return 0;
+}
+
+// Generate the steps of a move phase where the stepper position is
+// 'pos + (v + ha*t)*t' for 't' in the range [0, phase_t]
+static int32_t
+linear_gen_phase(struct linear_solve *ls, double start_time, double phase_t
+                 , double pos, double v, double ha)
+{
+    if (phase_t <= 0.)
+        return 0;
+    double stop_t = ha ? -.5 * v / ha : 0.;
+    if (stop_t > 0. && stop_t < phase_t) {
+        // The stepper changes direction during the phase
+        int ret = linear_gen_range(ls, start_time, start_time + stop_t
+                                   , pos, v, ha);
+        if (ret)
+            return ret;
+        pos += .5 * v * stop_t;
+        start_time += stop_t;
+        phase_t -= stop_t;
+        v = 0.;
+    }
+    return linear_gen_range(ls, start_time, start_time + phase_t, pos, v, ha);
+}
+
+// Generate step times for a stepper with linear kinematics
+static int32_t
+linear_gen_steps(struct stepper_kinematics *sk, struct move *m)
+{
+    struct stepcompress *sc = sk->sc;
+    struct coord *c = &sk->linear_c;
+    double base = (c->x * m->start_pos.x + c->y * m->start_pos.y
+                   + c->z * m->start_pos.z);
+    double ratio = c->x * m->axes_r.x + c->y * m->axes_r.y + c->z * m->axes_r.z;
+    struct linear_solve ls = {
+        .qa = queue_append_start(sc, m->print_time, .5),
+        .half_step = .5 * sk->step_dist,
+        .mcu_freq = stepcompress_get_mcu_freq(sc),
+        .commanded_pos = sk->commanded_pos,
+        .sdir = stepcompress_get_step_dir(sc),
+    };
+    double decel_time = m->accel_t + m->cruise_t;
+    int32_t ret = linear_gen_phase(
+        &ls, 0., m->accel_t, base
+        , ratio * m->accel.c1, ratio * m->accel.c2);
+    if (ret)
+        return ret;
+    ret = linear_gen_phase(
+        &ls, m->accel_t, m->cruise_t, base + ratio * m->cruise_start_d
+        , ratio * m->cruise_v, 0.);
+    if (ret)
+        return ret;
+    ret = linear_gen_phase(
+        &ls, decel_time, m->move_t - decel_time
+        , base + ratio * m->decel_start_d
+        , ratio * m->decel.c1, ratio * m->decel.c2);
+    if (ret)
+        return ret;
+    queue_append_finish(ls.qa);
+    sk->commanded_pos = ls.commanded_pos;
+    return 0;
+}
+
+// Select the analytic solver for a stepper - returns 0 if the
+// kinematics of the stepper do not support it
+int32_t __visible
+itersolve_set_analytic(struct stepper_kinematics *sk, int enable)
+{
+    sk->use_analytic = enable && sk->is_linear;
+    return sk->use_analytic;
+}
+
+
+/****************************************************************
+ * Parallel step generation
+ ****************************************************************/
+
+// Step generation of different steppers is independent, so the moves
+// of each stepper can be processed on a separate thread.  The moves
+// of a single stepper are always processed in order by one thread, so
+// the output is identical to calling itersolve_gen_steps() directly.
+
+struct stepgen_job {
+    struct move m;
+    int next;
+};
+
+struct stepgen_stepper {
+    struct stepper_kinematics *sk;
+    int first_job, last_job;
+    int32_t ret;
+};
+
+struct stepgen_pool {
+    struct thread_pool *tp;
+    // Queued moves
+    struct stepgen_job *jobs;
+    int job_count, job_alloc;
+    struct stepgen_stepper *steppers;
+    int stepper_count, stepper_alloc;
+};
+
+// Generate the steps of all queued moves of a stepper
+static void
+stepgen_pool_run(void *data, int idx)
+{
+    struct stepgen_pool *sp = data;
+    struct stepgen_stepper *s = &sp->steppers[idx];
+    int j;
+    for (j = s->first_job; j >= 0; j = sp->jobs[j].next) {
+        s->ret = itersolve_gen_steps(s->sk, &sp->jobs[j].m);
+        if (s->ret)
+            break;
+    }
+}
+
+// Create a pool that generates steps using 'num_threads' threads (the
+// calling thread is one of them)
+struct stepgen_pool * __visible
+stepgen_pool_alloc(int num_threads)
+{
+    struct stepgen_pool *sp = malloc(sizeof(*sp));
+    memset(sp, 0, sizeof(*sp));
+    sp->tp = thread_pool_alloc(num_threads);
+    return sp;
+}
+
+// Stop the worker threads and free all resources
+void __visible
+stepgen_pool_free(struct stepgen_pool *sp)
+{
+    if (!sp)
+        return;
+    thread_pool_free(sp->tp);
+    free(sp->jobs);
+    free(sp->steppers);
+    free(sp);
+}
+
+// Queue the steps of a stepper during a move for generation on the
+// next stepgen_pool_flush() call
+void __visible
+stepgen_pool_queue(struct stepgen_pool *sp, struct stepper_kinematics *sk
+                   , struct move *m)
+{
+    // Lookup (or add) the stepper
+    struct stepgen_stepper *s = NULL;
+    int i;
+    for (i = sp->stepper_count - 1; i >= 0; i--) {
+        if (sp->steppers[i].sk == sk) {
+            s = &sp->steppers[i];
+            break;
+        }
+    }
+    if (!s) {
+        if (sp->stepper_count >= sp->stepper_alloc) {
+            sp->stepper_alloc = sp->stepper_alloc ? 2*sp->stepper_alloc : 8;
+            sp->steppers = realloc(
+                sp->steppers, sizeof(*sp->steppers) * sp->stepper_alloc);
+        }
+        s = &sp->steppers[sp->stepper_count++];
+        s->sk = sk;
+        s->first_job = s->last_job = -1;
+        s->ret = 0;
+    }
+    // Store a copy of the move
+    if (sp->job_count >= sp->job_alloc) {
+        sp->job_alloc = sp->job_alloc ? 2*sp->job_alloc : 64;
+        sp->jobs = realloc(sp->jobs, sizeof(*sp->jobs) * sp->job_alloc);
+    }
+    int idx = sp->job_count++;
+    struct stepgen_job *j = &sp->jobs[idx];
+    j->m = *m;
+    j->next = -1;
+    if (s->last_job >= 0)
+        sp->jobs[s->last_job].next = idx;
+    else
+        s->first_job = idx;
+    s->last_job = idx;
+}
+
+// Generate the steps of all queued moves - returns the error of the
+// first stepper (in queue order) that failed
+int32_t __visible
+stepgen_pool_flush(struct stepgen_pool *sp)
+{
+    if (!sp->job_count)
+        return 0;
+    thread_pool_run(sp->tp, stepgen_pool_run, sp, sp->stepper_count);
+    int32_t ret = 0;
+    int i;
+    for (i = 0; i < sp->stepper_count; i++) {
+        if (sp->steppers[i].ret) {
+            ret = sp->steppers[i].ret;
+            break;
+        }
+    }
+    sp->job_count = sp->stepper_count = 0;
+    return ret;
+}
+
+
+/****************************************************************
+ * Batched move processing
+ ****************************************************************/
+
+// The host queues the moves of a look-ahead flush as an array of
+// fixed size records and the steppers to step for each record as a
+// job list.  Processing the records in order produces the same calls
+// to itersolve_gen_steps() and steppersync_flush() as issuing them one
+// move at a time.
+
+enum { MB_MOVE, MB_EXTRUDE_MOVE, MB_FLUSH };
+#define MB_RECORD_SIZE 14
+
+// Flush the steppersyncs up to the given print time
+static int32_t
+move_batch_flush(double flush_time, struct steppersync **ss_list
+                 , double *ss_clock_adj, int ss_count)
+{
+    int i;
+    for (i = 0; i < ss_count; i++) {
+        double offset = ss_clock_adj[i*2], freq = ss_clock_adj[i*2+1];
+        int64_t clock = (flush_time - offset) * freq;
+        if (clock < 0)
+            continue;
+        int ret = steppersync_flush(ss_list[i], clock);
+        if (ret)
+            return ret;
+    }
+    return 0;
+}
+
+// Generate the steps of a batch of move records
+int32_t __visible
+move_batch_gen_steps(double *records, int record_count
+                     , struct stepper_kinematics **sks, int *job_records
+                     , int job_count, struct stepgen_pool *sp
+                     , struct steppersync **ss_list, double *ss_clock_adj
+                     , int ss_count)
+{
+    struct move m;
+    int i, j = 0;
+    for (i = 0; i < record_count; i++) {
+        double *r = &records[i * MB_RECORD_SIZE];
+        int32_t ret;
+        switch ((int)r[0]) {
+        case MB_MOVE:
+            move_fill(&m, r[1], r[2], r[3], r[4], r[5], r[6], r[7]
+                      , r[8], r[9], r[10], r[11], r[12], r[13]);
+            break;
+        case MB_EXTRUDE_MOVE:
+            extruder_move_fill(&m, r[1], r[2], r[3], r[4], r[5], r[6]
+                               , r[7], r[8], r[9], r[10]);
+            break;
+        case MB_FLUSH:
+            if (sp) {
+                ret = stepgen_pool_flush(sp);
+                if (ret)
+                    return ret;
+            }
+            ret = move_batch_flush(r[1], ss_list, ss_clock_adj, ss_count);
+            if (ret)
+                return ret;
+            continue;
+        default:
+            errorf("Invalid move batch record %d", (int)r[0]);
+            return ERROR_RET;
+        }
+        for (; j < job_count && job_records[j] == i; j++) {
+            if (sp) {
+                stepgen_pool_queue(sp, sks[j], &m);
+                continue;
+            }
+            ret = itersolve_gen_steps(sks[j], &m);
+            if (ret)
+                return ret;
+        }
+    }
+    if (sp)
+        return stepgen_pool_flush(sp);
+    return 0;
+}
@@ -26,6 +26,11 @@ void move_fill(struct move *m, double print_time
                , double start_pos_x, double start_pos_y, double start_pos_z
                , double axes_d_x, double axes_d_y, double axes_d_z
                , double start_v, double cruise_v, double accel);
+void extruder_move_fill(struct move *m, double print_time
+                        , double accel_t, double cruise_t, double decel_t
+                        , double start_pos
+                        , double start_v, double cruise_v, double accel
+                        , double extra_accel_v, double extra_decel_v);
 double move_get_distance(struct move *m, double move_time);
 struct coord move_get_coord(struct move *m, double move_time);
 
@@ -36,6 +41,10 @@ struct stepper_kinematics {
     double step_dist, commanded_pos;
     struct stepcompress *sc;
     sk_callback calc_position;
+    // Stepper position as a linear function of the cartesian
+    // position (only set on kinematics supporting the analytic solver)
+    struct coord linear_c;
+    int is_linear, use_analytic;
 };
 
 int32_t itersolve_gen_steps(struct stepper_kinematics *sk, struct move *m);
@@ -45,5 +54,20 @@ double itersolve_calc_position_from_coord(struct stepper_kinematics *sk
                                           , double x, double y, double z);
 void itersolve_set_commanded_pos(struct stepper_kinematics *sk, double pos);
 double itersolve_get_commanded_pos(struct stepper_kinematics *sk);
+int32_t itersolve_set_analytic(struct stepper_kinematics *sk, int enable);
+
+struct stepgen_pool *stepgen_pool_alloc(int num_threads);
+void stepgen_pool_free(struct stepgen_pool *sp);
+void stepgen_pool_queue(struct stepgen_pool *sp, struct stepper_kinematics *sk
+                        , struct move *m);
+int32_t stepgen_pool_flush(struct stepgen_pool *sp);
+
+struct steppersync;
+int32_t move_batch_gen_steps(double *records, int record_count
+                             , struct stepper_kinematics **sks
+                             , int *job_records, int job_count
+                             , struct stepgen_pool *sp
+                             , struct steppersync **ss_list
+                             , double *ss_clock_adj, int ss_count);
 
 #endif // itersolve.h
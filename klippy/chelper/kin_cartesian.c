@@ -36,11 +36,16 @@ cartesian_stepper_alloc(char axis)
 {
     struct stepper_kinematics *sk = malloc(sizeof(*sk));
     memset(sk, 0, sizeof(*sk));
-    if (axis == 'x')
+    if (axis == 'x') {
         sk->calc_position = cart_stepper_x_calc_position;
-    else if (axis == 'y')
+        sk->linear_c.x = 1.;
+    } else if (axis == 'y') {
         sk->calc_position = cart_stepper_y_calc_position;
-    else if (axis == 'z')
+        sk->linear_c.y = 1.;
+    } else if (axis == 'z') {
         sk->calc_position = cart_stepper_z_calc_position;
+        sk->linear_c.z = 1.;
+    }
+    sk->is_linear = 1;
     return sk;
 }
@@ -30,9 +30,13 @@ corexy_stepper_alloc(char type)
 {
     struct stepper_kinematics *sk = malloc(sizeof(*sk));
     memset(sk, 0, sizeof(*sk));
-    if (type == '+')
+    if (type == '+') {
         sk->calc_position = corexy_stepper_plus_calc_position;
-    else if (type == '-')
+        sk->linear_c = (struct coord){ 1., 1., 0. };
+    } else if (type == '-') {
         sk->calc_position = corexy_stepper_minus_calc_position;
+        sk->linear_c = (struct coord){ 1., -1., 0. };
+    }
+    sk->is_linear = 1;
     return sk;
 }
@@ -23,6 +23,8 @@ extruder_stepper_alloc(void)
     struct stepper_kinematics *sk = malloc(sizeof(*sk));
     memset(sk, 0, sizeof(*sk));
     sk->calc_position = extruder_calc_position;
+    sk->linear_c.x = 1.;
+    sk->is_linear = 1;
     return sk;
 }
 
@@ -49,6 +51,7 @@ extruder_move_fill(struct move *m, double print_time
     m->decel.c1 = cruise_v + extra_decel_v;
     m->decel.c2 = -m->accel.c2;
 
-    // Setup start distance
-    m->start_pos.x = start_pos;
+    // Setup start distance (as a move along the x axis)
+    m->start_pos = (struct coord){ start_pos, 0., 0. };
+    m->axes_r = (struct coord){ 1., 0., 0. };
 }
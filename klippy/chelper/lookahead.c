@@ -0,0 +1,263 @@
+// Move queue "look-ahead" junction speed planning
+//
+// Copyright (C) 2016-2018  Kevin O'Connor <kevin@koconnor.net>
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+//
+// This is a C implementation of the planner in toolhead.py (see
+// Move.calc_junction(), Move.set_junction(), and MoveQueue.flush()).
+// The python code is the reference - the two must produce the same
+// results.  Junction speeds are tracked in velocity squared (_v2).
+
+#include <math.h> // sqrt
+#include <stdlib.h> // malloc
+#include <string.h> // memset
+#include "compiler.h" // __visible
+#include "pyhelper.h" // errorf
+
+#define LOOKAHEAD_START_SIZE 128
+
+struct lookahead_move {
+    // Move parameters (from lookahead_add_move)
+    double move_d, axes_d_x, axes_d_y, axes_d_z, accel;
+    double max_cruise_v2, delta_v2, smooth_delta_v2;
+    int is_kinematic_move;
+    // Junction limits (from calc_junction)
+    double max_start_v2, max_smoothed_v2;
+    // Velocity trapezoid (from set_junction)
+    double accel_t, cruise_t, decel_t, start_v, cruise_v, end_v;
+};
+
+struct lookahead_delayed {
+    struct lookahead_move *move;
+    double start_v2, end_v2;
+};
+
+struct lookahead {
+    struct lookahead_move *moves;
+    struct lookahead_delayed *delayed;
+    int move_count, alloc_count;
+};
+
+struct lookahead * __visible
+lookahead_alloc(void)
+{
+    struct lookahead *la = malloc(sizeof(*la));
+    memset(la, 0, sizeof(*la));
+    la->alloc_count = LOOKAHEAD_START_SIZE;
+    la->moves = malloc(sizeof(*la->moves) * la->alloc_count);
+    la->delayed = malloc(sizeof(*la->delayed) * la->alloc_count);
+    return la;
+}
+
+void __visible
+lookahead_free(struct lookahead *la)
+{
+    if (!la)
+        return;
+    free(la->moves);
+    free(la->delayed);
+    free(la);
+}
+
+// Discard all queued moves
+void __visible
+lookahead_reset(struct lookahead *la)
+{
+    la->move_count = 0;
+}
+
+static inline double
+min2(double a, double b)
+{
+    return b < a ? b : a;
+}
+
+// Find the maximum junction speed between 'prev' and 'm'
+static void
+calc_junction(struct lookahead_move *m, struct lookahead_move *prev
+              , double junction_deviation, double extruder_v2)
+{
+    if (!m->is_kinematic_move || !prev->is_kinematic_move)
+        return;
+    // Find max velocity using approximated centripetal velocity as
+    // described at:
+    // https://onehossshay.wordpress.com/2011/09/24/improving_grbl_cornering_algorithm/
+    double junction_cos_theta = -((m->axes_d_x * prev->axes_d_x
+                                   + m->axes_d_y * prev->axes_d_y
+                                   + m->axes_d_z * prev->axes_d_z)
+                                  / (m->move_d * prev->move_d));
+    if (junction_cos_theta > 0.999999)
+        return;
+    if (junction_cos_theta < -0.999999)
+        junction_cos_theta = -0.999999;
+    double sin_theta_d2 = sqrt(0.5*(1.0-junction_cos_theta));
+    double R = junction_deviation * sin_theta_d2 / (1. - sin_theta_d2);
+    double tan_theta_d2 = sin_theta_d2 / sqrt(0.5*(1.0+junction_cos_theta));
+    double move_centripetal_v2 = .5 * m->move_d * tan_theta_d2 * m->accel;
+    double prev_move_centripetal_v2 = (.5 * prev->move_d * tan_theta_d2
+                                       * prev->accel);
+    double v2 = min2(R * m->accel, R * prev->accel);
+    v2 = min2(v2, move_centripetal_v2);
+    v2 = min2(v2, prev_move_centripetal_v2);
+    v2 = min2(v2, extruder_v2);
+    v2 = min2(v2, m->max_cruise_v2);
+    v2 = min2(v2, prev->max_cruise_v2);
+    v2 = min2(v2, prev->max_start_v2 + prev->delta_v2);
+    m->max_start_v2 = v2;
+    m->max_smoothed_v2 = min2(
+        v2, prev->max_smoothed_v2 + prev->smooth_delta_v2);
+}
+
+// Add a move to the end of the queue and calculate its junction with
+// the previous move.  Returns the move's max_start_v2.
+double __visible
+lookahead_add_move(struct lookahead *la, int is_kinematic_move
+                   , double move_d
+                   , double axes_d_x, double axes_d_y, double axes_d_z
+                   , double accel, double max_cruise_v2, double delta_v2
+                   , double smooth_delta_v2, double junction_deviation
+                   , double extruder_v2)
+{
+    if (la->move_count >= la->alloc_count) {
+        int alloc = la->alloc_count * 2;
+        la->moves = realloc(la->moves, sizeof(*la->moves) * alloc);
+        la->delayed = realloc(la->delayed, sizeof(*la->delayed) * alloc);
+        if (!la->moves || !la->delayed) {
+            errorf("lookahead: out of memory");
+            abort();
+        }
+        la->alloc_count = alloc;
+    }
+    struct lookahead_move *m = &la->moves[la->move_count++];
+    memset(m, 0, sizeof(*m));
+    m->is_kinematic_move = is_kinematic_move;
+    m->move_d = move_d;
+    m->axes_d_x = axes_d_x;
+    m->axes_d_y = axes_d_y;
+    m->axes_d_z = axes_d_z;
+    m->accel = accel;
+    m->max_cruise_v2 = max_cruise_v2;
+    m->delta_v2 = delta_v2;
+    m->smooth_delta_v2 = smooth_delta_v2;
+    if (la->move_count > 1)
+        calc_junction(m, m - 1, junction_deviation, extruder_v2);
+    return m->max_start_v2;
+}
+
+// Determine the velocity trapezoid of a move
+static void
+set_junction(struct lookahead_move *m
+             , double start_v2, double cruise_v2, double end_v2)
+{
+    // Determine accel, cruise, and decel portions of the move distance
+    double inv_delta_v2 = 1. / m->delta_v2;
+    double accel_r = (cruise_v2 - start_v2) * inv_delta_v2;
+    double decel_r = (cruise_v2 - end_v2) * inv_delta_v2;
+    double cruise_r = 1. - accel_r - decel_r;
+    // Determine move velocities
+    double start_v = m->start_v = sqrt(start_v2);
+    double cruise_v = m->cruise_v = sqrt(cruise_v2);
+    double end_v = m->end_v = sqrt(end_v2);
+    // Determine time spent in each portion of move (time is the
+    // distance divided by average velocity)
+    m->accel_t = accel_r * m->move_d / ((start_v + cruise_v) * 0.5);
+    m->cruise_t = cruise_r * m->move_d / cruise_v;
+    m->decel_t = decel_r * m->move_d / ((end_v + cruise_v) * 0.5);
+}
+
+// Traverse the queue from last to first move and determine maximum
+// junction speeds assuming the robot comes to a complete stop after
+// the last move.  Returns the number of moves that may be flushed,
+// or -1 if a lazy flush found no moves to flush.
+int __visible
+lookahead_flush(struct lookahead *la, int leftover, int lazy)
+{
+    struct lookahead_move *moves = la->moves;
+    struct lookahead_delayed *delayed = la->delayed;
+    int update_flush_count = lazy, delayed_count = 0;
+    int flush_count = la->move_count, i;
+    double next_end_v2 = 0., next_smoothed_v2 = 0., peak_cruise_v2 = 0.;
+    for (i = flush_count-1; i >= leftover; i--) {
+        struct lookahead_move *m = &moves[i];
+        double reachable_start_v2 = next_end_v2 + m->delta_v2;
+        double start_v2 = min2(m->max_start_v2, reachable_start_v2);
+        double reachable_smoothed_v2 = next_smoothed_v2 + m->smooth_delta_v2;
+        double smoothed_v2 = min2(m->max_smoothed_v2, reachable_smoothed_v2);
+        if (smoothed_v2 < reachable_smoothed_v2) {
+            // It's possible for this move to accelerate
+            if (smoothed_v2 + m->smooth_delta_v2 > next_smoothed_v2
+                || delayed_count) {
+                // This move can decelerate or this is a full accel
+                // move after a full decel move
+                if (update_flush_count && peak_cruise_v2) {
+                    flush_count = i;
+                    update_flush_count = 0;
+                }
+                peak_cruise_v2 = min2(m->max_cruise_v2, (
+                    smoothed_v2 + reachable_smoothed_v2) * .5);
+                if (delayed_count) {
+                    // Propagate peak_cruise_v2 to any delayed moves
+                    if (!update_flush_count && i < flush_count) {
+                        int j;
+                        for (j=0; j<delayed_count; j++) {
+                            struct lookahead_delayed *d = &delayed[j];
+                            double mc_v2 = min2(peak_cruise_v2, d->start_v2);
+                            set_junction(d->move, min2(d->start_v2, mc_v2)
+                                         , mc_v2, min2(d->end_v2, mc_v2));
+                        }
+                    }
+                    delayed_count = 0;
+                }
+            }
+            if (!update_flush_count && i < flush_count) {
+                double cruise_v2 = min2(min2(
+                    (start_v2 + reachable_start_v2) * .5, m->max_cruise_v2)
+                                        , peak_cruise_v2);
+                set_junction(m, min2(start_v2, cruise_v2), cruise_v2
+                             , min2(next_end_v2, cruise_v2));
+            }
+        } else {
+            // Delay calculating this move until peak_cruise_v2 is known
+            struct lookahead_delayed *d = &delayed[delayed_count++];
+            d->move = m;
+            d->start_v2 = start_v2;
+            d->end_v2 = next_end_v2;
+        }
+        next_end_v2 = start_v2;
+        next_smoothed_v2 = smoothed_v2;
+    }
+    if (update_flush_count)
+        return -1;
+    return flush_count;
+}
+
+// Copy the velocity trapezoid of 'count' moves starting at 'start'
+// into 'out' (accel_t, cruise_t, decel_t, start_v, cruise_v, end_v)
+void __visible
+lookahead_get_junctions(struct lookahead *la, int start, int count
+                        , double *out)
+{
+    struct lookahead_move *m = &la->moves[start], *end = m + count;
+    for (; m < end; m++) {
+        *out++ = m->accel_t;
+        *out++ = m->cruise_t;
+        *out++ = m->decel_t;
+        *out++ = m->start_v;
+        *out++ = m->cruise_v;
+        *out++ = m->end_v;
+    }
+}
+
+// Remove 'count' moves from the start of the queue
+void __visible
+lookahead_pop(struct lookahead *la, int count)
+{
+    if (count >= la->move_count) {
+        la->move_count = 0;
+        return;
+    }
+    la->move_count -= count;
+    memmove(la->moves, &la->moves[count]
+            , sizeof(*la->moves) * la->move_count);
+}
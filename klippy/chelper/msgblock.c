@@ -0,0 +1,92 @@
+// Helper code for encoding and decoding mcu protocol message blocks
+//
+// Copyright (C) 2016-2018  Kevin O'Connor <kevin@koconnor.net>
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+//
+// These functions mirror the python implementation in msgproto.py
+// (crc16_ccitt(), PT_uint32.encode(), and PT_uint32.parse()) and must
+// produce identical results.
+
+#include <stdint.h> // uint8_t
+#include "compiler.h" // __visible
+#include "msgblock.h" // MB_PT_UINT32
+
+// Implement the standard crc "ccitt" algorithm on the given buffer
+uint16_t __visible
+msgblock_crc16_ccitt(uint8_t *buf, uint8_t len)
+{
+    uint16_t crc = 0xffff;
+    while (len--) {
+        uint8_t data = *buf++;
+        data ^= crc & 0xff;
+        data ^= data << 4;
+        crc = ((((uint16_t)data << 8) | (crc >> 8)) ^ (uint8_t)(data >> 4)
+               ^ ((uint16_t)data << 3));
+    }
+    return crc;
+}
+
+// Encode an integer as a variable length quantity (vlq).  Unlike
+// encode_int() in serialqueue.c the value is not truncated to 32 bits
+// first - values at or above 0x80000000 are encoded as positive
+// numbers (as done by the python code).
+static uint8_t *
+encode_param(uint8_t *p, int64_t v)
+{
+    if (v >= 0xc000000 || v < -0x4000000) *p++ = ((v>>28) & 0x7f) | 0x80;
+    if (v >= 0x180000 || v < -0x80000)    *p++ = ((v>>21) & 0x7f) | 0x80;
+    if (v >= 0x3000 || v < -0x1000)       *p++ = ((v>>14) & 0x7f) | 0x80;
+    if (v >= 0x60 || v < -0x20)           *p++ = ((v>>7) & 0x7f) | 0x80;
+    *p++ = v & 0x7f;
+    return p;
+}
+
+// Encode a list of integer parameters.  The 'out' buffer must have
+// space for five bytes per parameter.  Returns the encoded length.
+int __visible
+msgblock_encode_params(uint8_t *out, int64_t *data, int count)
+{
+    uint8_t *p = out;
+    while (count--)
+        p = encode_param(p, *data++);
+    return p - out;
+}
+
+// Decode 'count' parameters of the given 'types' starting at offset
+// 'pos' of 'buf'.  Integers are stored in 'out' - for buffer types the
+// offset of the buffer's length byte is stored instead.  Returns the
+// position after the last parameter, or -1 if the data is truncated
+// or malformed.
+int __visible
+msgblock_decode_params(uint8_t *buf, int len, int pos, uint8_t *types
+                       , int count, int64_t *out)
+{
+    int i;
+    for (i=0; i<count; i++) {
+        if (pos >= len)
+            return -1;
+        if (types[i] == MB_PT_BUFFER) {
+            out[i] = pos;
+            pos += buf[pos] + 1;
+            if (pos > len)
+                return -1;
+            continue;
+        }
+        uint8_t c = buf[pos++];
+        uint64_t v = c & 0x7f;
+        if ((c & 0x60) == 0x60)
+            v |= -0x20;
+        int bytes = 1;
+        while (c & 0x80) {
+            if (pos >= len || ++bytes > 5)
+                return -1;
+            c = buf[pos++];
+            v = (v<<7) | (c & 0x7f);
+        }
+        if (types[i] == MB_PT_UINT32)
+            v &= 0xffffffff;
+        out[i] = (int64_t)v;
+    }
+    return pos;
+}
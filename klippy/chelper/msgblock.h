@@ -0,0 +1,16 @@
+#ifndef MSGBLOCK_H
+#define MSGBLOCK_H
+
+#include <stdint.h> // uint8_t
+
+// Parameter types for msgblock_decode_params()
+enum {
+    MB_PT_UINT32, MB_PT_INT32, MB_PT_BUFFER,
+};
+
+uint16_t msgblock_crc16_ccitt(uint8_t *buf, uint8_t len);
+int msgblock_encode_params(uint8_t *out, int64_t *data, int count);
+int msgblock_decode_params(uint8_t *buf, int len, int pos, uint8_t *types
+                           , int count, int64_t *out);
+
+#endif // msgblock.h
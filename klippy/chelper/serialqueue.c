@@ -25,6 +25,7 @@
 #include <unistd.h> // pipe
 #include "compiler.h" // __visible
 #include "list.h" // list_add_tail
+#include "msgblock.h" // msgblock_crc16_ccitt
 #include "pyhelper.h" // get_monotonic
 #include "serialqueue.h" // struct queue_message
 
@@ -200,21 +201,6 @@ set_non_blocking(int fd)
  * Serial protocol helpers
  ****************************************************************/
 
-// Implement the standard crc "ccitt" algorithm on the given buffer
-static uint16_t
-crc16_ccitt(uint8_t *buf, uint8_t len)
-{
-    uint16_t crc = 0xffff;
-    while (len--) {
-        uint8_t data = *buf++;
-        data ^= crc & 0xff;
-        data ^= data << 4;
-        crc = ((((uint16_t)data << 8) | (crc >> 8)) ^ (uint8_t)(data >> 4)
-               ^ ((uint16_t)data << 3));
-    }
-    return crc;
-}
-
 // Verify a buffer starts with a valid mcu message
 static int
 check_message(uint8_t *need_sync, uint8_t *buf, int buf_len)
@@ -237,7 +223,7 @@ check_message(uint8_t *need_sync, uint8_t *buf, int buf_len)
         goto error;
     uint16_t msgcrc = ((buf[msglen-MESSAGE_TRAILER_CRC] << 8)
                        | (uint8_t)buf[msglen-MESSAGE_TRAILER_CRC+1]);
-    uint16_t crc = crc16_ccitt(buf, msglen-MESSAGE_TRAILER_SIZE);
+    uint16_t crc = msgblock_crc16_ccitt(buf, msglen-MESSAGE_TRAILER_SIZE);
     if (crc != msgcrc)
         goto error;
     return msglen;
@@ -347,7 +333,7 @@ message_queue_free(struct list_head *root)
 struct serialqueue {
     // Input reading
     struct pollreactor pr;
-    int serial_fd;
+    int serial_fd, write_only;
     int pipe_fds[2];
     uint8_t input_buf[4096];
     uint8_t need_sync;
@@ -668,7 +654,8 @@ build_and_send_command(struct serialqueue *sq, double eventtime)
     out->len += MESSAGE_TRAILER_SIZE;
     out->msg[MESSAGE_POS_LEN] = out->len;
     out->msg[MESSAGE_POS_SEQ] = MESSAGE_DEST | (sq->send_seq & MESSAGE_SEQ_MASK);
-    uint16_t crc = crc16_ccitt(out->msg, out->len - MESSAGE_TRAILER_SIZE);
+    uint16_t crc = msgblock_crc16_ccitt(out->msg
+                                        , out->len - MESSAGE_TRAILER_SIZE);
     out->msg[out->len - MESSAGE_TRAILER_CRC] = crc >> 8;
     out->msg[out->len - MESSAGE_TRAILER_CRC+1] = crc & 0xff;
     out->msg[out->len - MESSAGE_TRAILER_SYNC] = MESSAGE_SYNC;
@@ -821,6 +808,7 @@ serialqueue_alloc(int serial_fd, int write_only)
 
     // Retransmit setup
     sq->send_seq = 1;
+    sq->write_only = write_only;
     if (write_only) {
         sq->receive_seq = -1;
         sq->rto = PR_NEVER;
@@ -971,6 +959,36 @@ serialqueue_send(struct serialqueue *sq, struct command_queue *cq
     serialqueue_send_batch(sq, cq, &msgs);
 }
 
+// Schedule the transmission of a series of encoded commands.  The
+// commands are packed (in order) into as few messages as possible.
+void __visible
+serialqueue_send_packed(struct serialqueue *sq, struct command_queue *cq
+                        , uint8_t *data, int *lens, int count
+                        , uint64_t min_clock, uint64_t req_clock)
+{
+    struct list_head msgs;
+    list_init(&msgs);
+    struct queue_message *qm = NULL;
+    int i;
+    for (i=0; i<count; i++) {
+        int len = lens[i];
+        if (len > MESSAGE_PAYLOAD_MAX) {
+            errorf("Encode error");
+            break;
+        }
+        if (!qm || qm->len + len > MESSAGE_PAYLOAD_MAX) {
+            qm = message_alloc();
+            qm->min_clock = min_clock;
+            qm->req_clock = req_clock;
+            list_add_tail(&qm->node, &msgs);
+        }
+        memcpy(&qm->msg[qm->len], data, len);
+        qm->len += len;
+        data += len;
+    }
+    serialqueue_send_batch(sq, cq, &msgs);
+}
+
 // Like serialqueue_send() but also builds the message to be sent
 void
 serialqueue_encode_and_send(struct serialqueue *sq, struct command_queue *cq
@@ -987,40 +1005,72 @@ serialqueue_encode_and_send(struct serialqueue *sq, struct command_queue *cq
     serialqueue_send_batch(sq, cq, &msgs);
 }
 
-// Return a message read from the serial port (or wait for one if none
-// available)
+// Like serialqueue_send() but builds the message from the command's
+// parameters (as encoded by msgproto.py - see msgblock_encode_params())
 void __visible
-serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm)
+serialqueue_send_params(struct serialqueue *sq, struct command_queue *cq
+                        , int64_t *data, int len
+                        , uint64_t min_clock, uint64_t req_clock)
+{
+    uint8_t msg[MESSAGE_PAYLOAD_MAX * 5];
+    if (len > MESSAGE_PAYLOAD_MAX)
+        goto fail;
+    int msglen = msgblock_encode_params(msg, data, len);
+    if (msglen > MESSAGE_PAYLOAD_MAX)
+        goto fail;
+    serialqueue_send(sq, cq, msg, msglen, min_clock, req_clock);
+    return;
+
+fail:
+    errorf("Encode error");
+}
+
+// Return up to 'max' messages read from the serial port (or wait for
+// one if none available).  Returns the number of messages or -1 if the
+// serialqueue is exiting.
+int __visible
+serialqueue_pull_batch(struct serialqueue *sq, struct pull_queue_message *pqm
+                       , int max)
 {
     pthread_mutex_lock(&sq->lock);
     // Wait for message to be available
     while (list_empty(&sq->receive_queue)) {
-        if (pollreactor_is_exit(&sq->pr))
-            goto exit;
+        if (pollreactor_is_exit(&sq->pr)) {
+            pthread_mutex_unlock(&sq->lock);
+            return -1;
+        }
         sq->receive_waiting = 1;
         int ret = pthread_cond_wait(&sq->cond, &sq->lock);
         if (ret)
             report_errno("pthread_cond_wait", ret);
     }
 
-    // Remove message from queue
-    struct queue_message *qm = list_first_entry(
-        &sq->receive_queue, struct queue_message, node);
-    list_del(&qm->node);
-
-    // Copy message
-    memcpy(pqm->msg, qm->msg, qm->len);
-    pqm->len = qm->len;
-    pqm->sent_time = qm->sent_time;
-    pqm->receive_time = qm->receive_time;
-    debug_queue_add(&sq->old_receive, qm);
+    // Remove and copy the available messages
+    int count = 0;
+    while (count < max && !list_empty(&sq->receive_queue)) {
+        struct queue_message *qm = list_first_entry(
+            &sq->receive_queue, struct queue_message, node);
+        list_del(&qm->node);
+        memcpy(pqm->msg, qm->msg, qm->len);
+        pqm->len = qm->len;
+        pqm->sent_time = qm->sent_time;
+        pqm->receive_time = qm->receive_time;
+        debug_queue_add(&sq->old_receive, qm);
+        pqm++;
+        count++;
+    }
 
     pthread_mutex_unlock(&sq->lock);
-    return;
+    return count;
+}
 
-exit:
-    pqm->len = -1;
-    pthread_mutex_unlock(&sq->lock);
+// Return a message read from the serial port (or wait for one if none
+// available)
+void __visible
+serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm)
+{
+    if (serialqueue_pull_batch(sq, pqm, 1) < 0)
+        pqm->len = -1;
 }
 
 void __visible
@@ -1052,6 +1102,20 @@ serialqueue_set_clock_est(struct serialqueue *sq, double est_freq
     pthread_mutex_unlock(&sq->lock);
 }
 
+// Return the number of bytes ready to be transmitted but not yet sent
+// (this is always zero when writing to a file, as there is no flow
+// control on the output)
+int
+serialqueue_get_ready_bytes(struct serialqueue *sq)
+{
+    if (sq->write_only)
+        return 0;
+    pthread_mutex_lock(&sq->lock);
+    int ready_bytes = sq->ready_bytes;
+    pthread_mutex_unlock(&sq->lock);
+    return ready_bytes;
+}
+
 // Return a string buffer containing statistics for the serial port
 void __visible
 serialqueue_get_stats(struct serialqueue *sq, char *buf, int len)
@@ -55,13 +55,22 @@ void serialqueue_send_batch(struct serialqueue *sq, struct command_queue *cq
 void serialqueue_send(struct serialqueue *sq, struct command_queue *cq
                       , uint8_t *msg, int len
                       , uint64_t min_clock, uint64_t req_clock);
+void serialqueue_send_packed(struct serialqueue *sq, struct command_queue *cq
+                             , uint8_t *data, int *lens, int count
+                             , uint64_t min_clock, uint64_t req_clock);
 void serialqueue_encode_and_send(struct serialqueue *sq, struct command_queue *cq
                                  , uint32_t *data, int len
                                  , uint64_t min_clock, uint64_t req_clock);
+void serialqueue_send_params(struct serialqueue *sq, struct command_queue *cq
+                             , int64_t *data, int len
+                             , uint64_t min_clock, uint64_t req_clock);
+int serialqueue_pull_batch(struct serialqueue *sq, struct pull_queue_message *pqm
+                           , int max);
 void serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm);
 void serialqueue_set_baud_adjust(struct serialqueue *sq, double baud_adjust);
 void serialqueue_set_clock_est(struct serialqueue *sq, double est_freq
                                , double last_clock_time, uint64_t last_clock);
+int serialqueue_get_ready_bytes(struct serialqueue *sq);
 void serialqueue_get_stats(struct serialqueue *sq, char *buf, int len);
 int serialqueue_extract_old(struct serialqueue *sq, int sentq
                             , struct pull_queue_message *q, int max);
@@ -23,6 +23,7 @@
 #include "pyhelper.h" // errorf
 #include "serialqueue.h" // struct queue_message
 #include "stepcompress.h" // stepcompress_alloc
+#include "threadpool.h" // thread_pool_run
 
 #define CHECK_LINES 1
 #define QUEUE_START_SIZE 1024
@@ -31,13 +32,16 @@ struct stepcompress {
     // Buffer management
     uint32_t *queue, *queue_end, *queue_pos, *queue_next;
     // Internal tracking
-    uint32_t max_error;
+    uint32_t max_error, config_error;
     double mcu_time_offset, mcu_freq;
     // Message generation
     uint64_t last_step_clock, homing_clock;
     struct list_head msg_queue;
     uint32_t queue_step_msgid, set_next_step_dir_msgid, oid;
     int sdir, invert_sdir;
+    // Statistics
+    uint64_t step_count, queue_step_count;
+    double compress_time, max_error_sum;
 };
 
 
@@ -244,7 +248,7 @@ stepcompress_fill(struct stepcompress *sc, uint32_t max_error
                   , uint32_t invert_sdir, uint32_t queue_step_msgid
                   , uint32_t set_next_step_dir_msgid)
 {
-    sc->max_error = max_error;
+    sc->max_error = sc->config_error = max_error;
     sc->invert_sdir = !!invert_sdir;
     sc->queue_step_msgid = queue_step_msgid;
     sc->set_next_step_dir_msgid = set_next_step_dir_msgid;
@@ -267,11 +271,15 @@ stepcompress_flush(struct stepcompress *sc, uint64_t move_clock)
 {
     if (sc->queue_pos >= sc->queue_next)
         return 0;
+    double start_time = get_monotonic();
     while (sc->last_step_clock < move_clock) {
         struct step_move move = compress_bisect_add(sc);
         int ret = check_line(sc, move);
         if (ret)
             return ret;
+        sc->step_count += move.count;
+        sc->queue_step_count++;
+        sc->max_error_sum += (double)sc->max_error * move.count;
 
         uint32_t msg[5] = {
             sc->queue_step_msgid, sc->oid, move.interval, move.count, move.add
@@ -292,6 +300,7 @@ stepcompress_flush(struct stepcompress *sc, uint64_t move_clock)
         }
         sc->queue_pos += move.count;
     }
+    sc->compress_time += get_monotonic() - start_time;
     return 0;
 }
 
@@ -305,6 +314,9 @@ stepcompress_flush_far(struct stepcompress *sc, uint64_t abs_step_clock)
     struct queue_message *qm = message_alloc_and_encode(msg, 5);
     qm->min_clock = sc->last_step_clock;
     sc->last_step_clock = qm->req_clock = abs_step_clock;
+    sc->step_count++;
+    sc->queue_step_count++;
+    sc->max_error_sum += sc->max_error;
     if (sc->homing_clock)
         // When homing, all steps should be sent prior to homing_clock
         qm->min_clock = qm->req_clock = sc->homing_clock;
@@ -389,6 +401,22 @@ stepcompress_get_oid(struct stepcompress *sc)
     return sc->oid;
 }
 
+// Report the step statistics of a 'stepcompress' object - the allowed
+// step compression error (current and averaged over all steps) is
+// reported in seconds
+void __visible
+stepcompress_get_stats(struct stepcompress *sc, char *buf, int len)
+{
+    double avg_max_error = (sc->step_count
+                            ? sc->max_error_sum / sc->step_count : 0.);
+    double mcu_freq = sc->mcu_freq ? sc->mcu_freq : 1.;
+    snprintf(buf, len, "steps=%llu queue_step=%llu"
+             " max_error=%.9f avg_max_error=%.9f"
+             , (unsigned long long)sc->step_count
+             , (unsigned long long)sc->queue_step_count
+             , sc->max_error / mcu_freq, avg_max_error / mcu_freq);
+}
+
 int
 stepcompress_get_step_dir(struct stepcompress *sc)
 {
@@ -518,6 +546,22 @@ queue_append_set_next_step_dir(struct queue_append *qa, int sdir)
 // free so that new commands can be transmitted.  It also ensures the
 // mcu step queue is ordered between steppers so that no stepper
 // starves the other steppers of space in the mcu step queue.
+//
+// The step compression of each stepper is independent, so it may
+// optionally be done on the threads of a thread pool.  The
+// compressed commands are then merged on the calling thread, which
+// keeps the transmitted command order identical to the serial code.
+//
+// The step compression error may optionally adapt to the bandwidth of
+// the serial link.  The bytes transmitted on the link are tracked
+// against the bytes the link can transmit up to the flushed clock -
+// as that backlog (or the backlog reported by the serialqueue) grows,
+// the error of each stepper is widened towards a configured maximum,
+// which reduces the number of commands sent.  The error returns to
+// the configured value when the link is idle.
+
+// Minimum number of pending steps to compress on the thread pool
+#define MIN_POOL_STEPS 2048
 
 struct steppersync {
     // Serial port
@@ -529,6 +573,16 @@ struct steppersync {
     // Storage for list of pending move clocks
     uint64_t *move_clocks;
     int num_move_clocks;
+    // Optional parallel compression
+    struct thread_pool *tp;
+    uint64_t flush_clock;
+    int *flush_ret;
+    // Adaptive step compression error
+    uint32_t adapt_max_error;
+    double link_rate, link_backlog, link_bytes;
+    uint64_t link_clock;
+    // Statistics
+    double send_time;
 };
 
 // Allocate a new 'steppersync' object
@@ -544,6 +598,7 @@ steppersync_alloc(struct serialqueue *sq, struct stepcompress **sc_list
     ss->sc_list = malloc(sizeof(*sc_list)*sc_num);
     memcpy(ss->sc_list, sc_list, sizeof(*sc_list)*sc_num);
     ss->sc_num = sc_num;
+    ss->flush_ret = malloc(sizeof(*ss->flush_ret)*sc_num);
 
     ss->move_clocks = malloc(sizeof(*ss->move_clocks)*move_num);
     memset(ss->move_clocks, 0, sizeof(*ss->move_clocks)*move_num);
@@ -559,6 +614,7 @@ steppersync_free(struct steppersync *ss)
     if (!ss)
         return;
     free(ss->sc_list);
+    free(ss->flush_ret);
     free(ss->move_clocks);
     serialqueue_free_commandqueue(ss->cq);
     free(ss);
@@ -575,6 +631,60 @@ steppersync_set_time(struct steppersync *ss, double time_offset, double mcu_freq
     }
 }
 
+// Compress the steps of stepcompress objects on the threads of the
+// given thread pool (or on the calling thread if NULL)
+void __visible
+steppersync_set_thread_pool(struct steppersync *ss, struct thread_pool *tp)
+{
+    ss->tp = tp;
+}
+
+// Widen the step compression error (up to 'max_error' clock ticks)
+// as the backlog of the serial link grows.  The link transmits
+// 'link_rate' bytes per clock tick and 'max_error' is reached with a
+// backlog of 'link_backlog' bytes.  A 'link_rate' of zero disables
+// the adaptive error.
+void __visible
+steppersync_set_adaptive_error(struct steppersync *ss, uint32_t max_error
+                               , double link_rate, double link_backlog)
+{
+    ss->adapt_max_error = max_error;
+    ss->link_rate = link_backlog > 0. ? link_rate : 0.;
+    ss->link_backlog = link_backlog;
+    ss->link_bytes = 0.;
+    int i;
+    for (i=0; i<ss->sc_num; i++) {
+        struct stepcompress *sc = ss->sc_list[i];
+        sc->max_error = sc->config_error;
+    }
+}
+
+// Set the step compression error of each stepper from the backlog of
+// the serial link at 'move_clock'
+static void
+steppersync_update_error(struct steppersync *ss, uint64_t move_clock)
+{
+    if (move_clock > ss->link_clock) {
+        ss->link_bytes -= (move_clock - ss->link_clock) * ss->link_rate;
+        if (ss->link_bytes < 0.)
+            ss->link_bytes = 0.;
+    }
+    // The flush clock may move backwards (eg, after homing)
+    ss->link_clock = move_clock;
+    double backlog = ss->link_bytes;
+    int ready_bytes = serialqueue_get_ready_bytes(ss->sq);
+    if (ready_bytes > backlog)
+        backlog = ready_bytes;
+    double scale = backlog < ss->link_backlog ? backlog / ss->link_backlog : 1.;
+    int i;
+    for (i=0; i<ss->sc_num; i++) {
+        struct stepcompress *sc = ss->sc_list[i];
+        sc->max_error = sc->config_error;
+        if (ss->adapt_max_error > sc->config_error)
+            sc->max_error += (ss->adapt_max_error - sc->config_error) * scale;
+    }
+}
+
 // Implement a binary heap algorithm to track when the next available
 // 'struct move' in the mcu will be available
 static void
@@ -600,21 +710,54 @@ heap_replace(struct steppersync *ss, uint64_t req_clock)
     }
 }
 
+// Return the number of steps queued but not yet compressed
+static int
+steppersync_pending_steps(struct steppersync *ss)
+{
+    int i, count = 0;
+    for (i=0; i<ss->sc_num; i++) {
+        struct stepcompress *sc = ss->sc_list[i];
+        count += sc->queue_next - sc->queue_pos;
+    }
+    return count;
+}
+
+// Flush a stepcompress object from a thread of the thread pool
+static void
+steppersync_flush_sc(void *data, int idx)
+{
+    struct steppersync *ss = data;
+    ss->flush_ret[idx] = stepcompress_flush(ss->sc_list[idx], ss->flush_clock);
+}
+
 // Find and transmit any scheduled steps prior to the given 'move_clock'
 int __visible
 steppersync_flush(struct steppersync *ss, uint64_t move_clock)
 {
+    if (ss->link_rate)
+        steppersync_update_error(ss, move_clock);
+
     // Flush each stepcompress to the specified move_clock
     int i;
-    for (i=0; i<ss->sc_num; i++) {
-        int ret = stepcompress_flush(ss->sc_list[i], move_clock);
-        if (ret)
-            return ret;
+    if (ss->tp && steppersync_pending_steps(ss) >= MIN_POOL_STEPS) {
+        ss->flush_clock = move_clock;
+        thread_pool_run(ss->tp, steppersync_flush_sc, ss, ss->sc_num);
+        for (i=0; i<ss->sc_num; i++)
+            if (ss->flush_ret[i])
+                return ss->flush_ret[i];
+    } else {
+        for (i=0; i<ss->sc_num; i++) {
+            int ret = stepcompress_flush(ss->sc_list[i], move_clock);
+            if (ret)
+                return ret;
+        }
     }
 
     // Order commands by the reqclock of each pending command
+    double start_time = get_monotonic();
     struct list_head msgs;
     list_init(&msgs);
+    int msgs_len = 0;
     for (;;) {
         // Find message with lowest reqclock
         uint64_t req_clock = MAX_CLOCK;
@@ -645,10 +788,37 @@ steppersync_flush(struct steppersync *ss, uint64_t move_clock)
         // Batch this command
         list_del(&qm->node);
         list_add_tail(&qm->node, &msgs);
+        msgs_len += qm->len;
     }
 
+    // Account for the bytes (including the message block framing)
+    // added to the serial link
+    if (ss->link_rate)
+        ss->link_bytes += (double)msgs_len * MESSAGE_MAX / MESSAGE_PAYLOAD_MAX;
+
     // Transmit commands
     if (!list_empty(&msgs))
         serialqueue_send_batch(ss->sq, ss->cq, &msgs);
+    ss->send_time += get_monotonic() - start_time;
     return 0;
 }
+
+// Report the step generation statistics of the associated steppers
+void __visible
+steppersync_get_stats(struct steppersync *ss, char *buf, int len)
+{
+    uint64_t step_count = 0, queue_step_count = 0;
+    double compress_time = 0.;
+    int i;
+    for (i=0; i<ss->sc_num; i++) {
+        struct stepcompress *sc = ss->sc_list[i];
+        step_count += sc->step_count;
+        queue_step_count += sc->queue_step_count;
+        compress_time += sc->compress_time;
+    }
+    snprintf(buf, len, "steps=%llu queue_step=%llu"
+             " compress_time=%.6f send_time=%.6f"
+             , (unsigned long long)step_count
+             , (unsigned long long)queue_step_count
+             , compress_time, ss->send_time);
+}
@@ -16,6 +16,7 @@ int stepcompress_queue_msg(struct stepcompress *sc, uint32_t *data, int len);
 double stepcompress_get_mcu_freq(struct stepcompress *sc);
 uint32_t stepcompress_get_oid(struct stepcompress *sc);
 int stepcompress_get_step_dir(struct stepcompress *sc);
+void stepcompress_get_stats(struct stepcompress *sc, char *buf, int len);
 
 struct queue_append {
     struct stepcompress *sc;
@@ -35,6 +36,13 @@ struct steppersync *steppersync_alloc(
 void steppersync_free(struct steppersync *ss);
 void steppersync_set_time(struct steppersync *ss, double time_offset
                           , double mcu_freq);
+struct thread_pool;
+void steppersync_set_thread_pool(struct steppersync *ss
+                                 , struct thread_pool *tp);
+void steppersync_set_adaptive_error(struct steppersync *ss
+                                    , uint32_t max_error, double link_rate
+                                    , double link_backlog);
 int steppersync_flush(struct steppersync *ss, uint64_t move_clock);
+void steppersync_get_stats(struct steppersync *ss, char *buf, int len);
 
 #endif // stepcompress.h
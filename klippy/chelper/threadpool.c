@@ -0,0 +1,138 @@
+// Pool of worker threads for processing independent work items
+//
+// Copyright (C) 2026  agent <agent@local>
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <pthread.h> // pthread_create
+#include <stdlib.h> // malloc
+#include <string.h> // memset
+#include "compiler.h" // __visible
+#include "pyhelper.h" // report_errno
+#include "threadpool.h" // thread_pool_alloc
+
+struct thread_pool {
+    pthread_mutex_t lock;
+    pthread_cond_t cond, done_cond;
+    pthread_t *threads;
+    int thread_count, exit, generation, active;
+    // Current work
+    thread_pool_func func;
+    void *data;
+    int count, next_idx;
+};
+
+// Process work items not yet taken by another thread
+static void
+thread_pool_work(struct thread_pool *tp)
+{
+    for (;;) {
+        int idx = __atomic_fetch_add(&tp->next_idx, 1, __ATOMIC_RELAXED);
+        if (idx >= tp->count)
+            break;
+        tp->func(tp->data, idx);
+    }
+}
+
+// Main code for the worker threads
+static void *
+thread_pool_thread(void *data)
+{
+    struct thread_pool *tp = data;
+    int generation = 0;
+    pthread_mutex_lock(&tp->lock);
+    for (;;) {
+        while (!tp->exit && tp->generation == generation)
+            pthread_cond_wait(&tp->cond, &tp->lock);
+        if (tp->exit)
+            break;
+        generation = tp->generation;
+        pthread_mutex_unlock(&tp->lock);
+        thread_pool_work(tp);
+        pthread_mutex_lock(&tp->lock);
+        if (!--tp->active)
+            pthread_cond_signal(&tp->done_cond);
+    }
+    pthread_mutex_unlock(&tp->lock);
+    return NULL;
+}
+
+// Create a pool that processes work using 'num_threads' threads (the
+// calling thread is one of them)
+struct thread_pool * __visible
+thread_pool_alloc(int num_threads)
+{
+    struct thread_pool *tp = malloc(sizeof(*tp));
+    memset(tp, 0, sizeof(*tp));
+    if (num_threads < 1)
+        num_threads = 1;
+    int ret = pthread_mutex_init(&tp->lock, NULL);
+    if (ret)
+        goto fail;
+    ret = pthread_cond_init(&tp->cond, NULL);
+    if (ret)
+        goto fail;
+    ret = pthread_cond_init(&tp->done_cond, NULL);
+    if (ret)
+        goto fail;
+    tp->threads = malloc(sizeof(*tp->threads) * num_threads);
+    for (; tp->thread_count < num_threads - 1; tp->thread_count++) {
+        ret = pthread_create(&tp->threads[tp->thread_count], NULL
+                             , thread_pool_thread, tp);
+        if (ret)
+            goto fail;
+    }
+    return tp;
+
+fail:
+    report_errno("thread_pool_alloc", ret);
+    return tp;
+}
+
+// Stop the worker threads and free all resources
+void __visible
+thread_pool_free(struct thread_pool *tp)
+{
+    if (!tp)
+        return;
+    pthread_mutex_lock(&tp->lock);
+    tp->exit = 1;
+    pthread_cond_broadcast(&tp->cond);
+    pthread_mutex_unlock(&tp->lock);
+    int i;
+    for (i = 0; i < tp->thread_count; i++) {
+        int ret = pthread_join(tp->threads[i], NULL);
+        if (ret)
+            report_errno("pthread_join", ret);
+    }
+    free(tp->threads);
+    free(tp);
+}
+
+// Call 'func' for each index in the range [0, count) and wait for all
+// calls to complete.  The calls may be made in any order and from any
+// thread of the pool.
+void
+thread_pool_run(struct thread_pool *tp, thread_pool_func func
+                , void *data, int count)
+{
+    tp->func = func;
+    tp->data = data;
+    tp->count = count;
+    tp->next_idx = 0;
+    int use_threads = tp->thread_count && count > 1;
+    if (use_threads) {
+        pthread_mutex_lock(&tp->lock);
+        tp->active = tp->thread_count;
+        tp->generation++;
+        pthread_cond_broadcast(&tp->cond);
+        pthread_mutex_unlock(&tp->lock);
+    }
+    thread_pool_work(tp);
+    if (use_threads) {
+        pthread_mutex_lock(&tp->lock);
+        while (tp->active)
+            pthread_cond_wait(&tp->done_cond, &tp->lock);
+        pthread_mutex_unlock(&tp->lock);
+    }
+}
@@ -0,0 +1,11 @@
+#ifndef THREADPOOL_H
+#define THREADPOOL_H
+
+typedef void (*thread_pool_func)(void *data, int idx);
+
+struct thread_pool *thread_pool_alloc(int num_threads);
+void thread_pool_free(struct thread_pool *tp);
+void thread_pool_run(struct thread_pool *tp, thread_pool_func func
+                     , void *data, int count);
+
+#endif // threadpool.h
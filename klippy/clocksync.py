@@ -4,6 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging, math
+from . import serialhdl
 
 RTT_AGE = .000010 / (60. * 60.)
 DECAY = 1. / 30.
@@ -27,6 +28,7 @@ class ClockSync:
         self.clock_avg = self.clock_covariance = 0.
         self.prediction_variance = 0.
         self.last_prediction_time = 0.
+        self.is_connected = self.is_aborted = False
     def connect(self, serial):
         self.serial = serial
         self.mcu_freq = serial.msgparser.get_constant_float('CLOCK_FREQ')
@@ -46,6 +48,7 @@ class ClockSync:
             self.reactor.pause(0.100)
         serial.register_callback(self._handle_clock, 'clock')
         self.reactor.update_timer(self.get_clock_timer, self.reactor.NOW)
+        self.is_connected = True
     def connect_file(self, serial, pace=False):
         self.serial = serial
         self.mcu_freq = serial.msgparser.get_constant_float('CLOCK_FREQ')
@@ -54,6 +57,9 @@ class ClockSync:
         if pace:
             freq = self.mcu_freq
         serial.set_clock_est(freq, self.reactor.monotonic(), 0)
+        self.is_connected = True
+    def abort_connect(self):
+        self.is_aborted = True
     # MCU clock querying (_handle_clock is invoked from background thread)
     def _get_clock_event(self, eventtime):
         self.get_clock_cmd.send()
@@ -127,6 +133,8 @@ class ClockSync:
         return clock / self.mcu_freq
     def get_adjusted_freq(self):
         return self.mcu_freq
+    def get_clock_adj(self):
+        return 0., self.mcu_freq
     # system time conversions
     def get_clock(self, eventtime):
         sample_time, clock, freq = self.clock_est
@@ -169,6 +177,11 @@ class SecondarySync(ClockSync):
         self.last_sync_time = 0.
     def connect(self, serial):
         ClockSync.connect(self, serial)
+        # The main mcu may still be connecting (mcus connect in parallel)
+        while not self.main_sync.is_connected:
+            if self.is_aborted or self.main_sync.is_aborted:
+                raise serialhdl.error("Clock sync aborted")
+            self.reactor.pause(self.reactor.monotonic() + 0.050)
         self.clock_adj = (0., self.mcu_freq)
         curtime = self.reactor.monotonic()
         main_print_time = self.main_sync.estimated_print_time(curtime)
@@ -188,6 +201,8 @@ class SecondarySync(ClockSync):
     def get_adjusted_freq(self):
         adjusted_offset, adjusted_freq = self.clock_adj
         return adjusted_freq
+    def get_clock_adj(self):
+        return self.clock_adj
     # misc commands
     def dump_debug(self):
         adjusted_offset, adjusted_freq = self.clock_adj
@@ -7,8 +7,19 @@
 import logging
 import math
 import json
+import os
+import re
+import struct
 from . import probe
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Minimum number of points for which get_z_many() uses numpy
+NUMPY_MIN_POINTS = 32
+
 class BedMeshError(Exception):
     pass
 
@@ -24,6 +35,81 @@ def constrain(val, min_val, max_val):
 def lerp(t, v0, v1):
     return (1. - t) * v0 + t * v1
 
+# Mesh profile files - a header, the probe parameters (json) and then
+# the probed and interpolated z tables as little endian doubles
+PROFILE_MAGIC = b"KBEDMESH"
+PROFILE_VERSION = 1
+PROFILE_HEADER = struct.Struct("<8sIIIIII")
+PROFILE_NAME_RE = re.compile(r'^[A-Za-z0-9_\-]+$')
+
+def save_profile(filename, mesh, probed_z_table):
+    params = json.dumps(mesh.probe_params, sort_keys=True).encode()
+    params += b" " * (-len(params) % 8)
+    px_cnt = len(probed_z_table[0])
+    py_cnt = len(probed_z_table)
+    probed = [z for row in probed_z_table for z in row]
+    mesh_z = [z for row in mesh.mesh_z_table for z in row]
+    data = (PROFILE_HEADER.pack(
+        PROFILE_MAGIC, PROFILE_VERSION, len(params), px_cnt, py_cnt,
+        mesh.mesh_x_count, mesh.mesh_y_count)
+            + params + struct.pack("<%dd" % (len(probed),), *probed)
+            + struct.pack("<%dd" % (len(mesh_z),), *mesh_z))
+    # Write to a temporary file so that a profile is never left
+    # partially written
+    tmp_filename = filename + ".tmp"
+    f = open(tmp_filename, 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    os.rename(tmp_filename, filename)
+
+# Load a profile saved with save_profile() - returns the ZMesh and the
+# probed z table.  The interpolated table is used as is (the mesh is
+# not rebuilt from the probed points).
+def load_profile(filename):
+    f = open(filename, 'rb')
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    size = len(data)
+    if size < PROFILE_HEADER.size:
+        raise BedMeshError("bed_mesh: invalid profile file %s" % (
+            filename,))
+    (magic, version, params_len, px_cnt, py_cnt, mx_cnt, my_cnt
+     ) = PROFILE_HEADER.unpack_from(data, 0)
+    pos = PROFILE_HEADER.size + params_len
+    if (magic != PROFILE_MAGIC or version != PROFILE_VERSION
+        or size != pos + 8 * (px_cnt * py_cnt + mx_cnt * my_cnt)):
+        raise BedMeshError("bed_mesh: invalid profile file %s" % (
+            filename,))
+    params_data = data[PROFILE_HEADER.size:pos]
+    probed = struct.unpack_from("<%dd" % (px_cnt * py_cnt,), data, pos)
+    pos += 8 * px_cnt * py_cnt
+    mesh_z = struct.unpack_from("<%dd" % (mx_cnt * my_cnt,), data, pos)
+    # The parameters of a corrupt file may be invalid in many ways
+    try:
+        params = json.loads(params_data.decode())
+        params = dict([(str(k), v) for k, v in params.items()])
+        params['algo'] = str(params['algo'])
+        mesh = ZMesh(params)
+        valid = (mesh.mesh_x_count == mx_cnt and mesh.mesh_y_count == my_cnt
+                 and params['x_count'] == px_cnt
+                 and params['y_count'] == py_cnt)
+    except (ValueError, KeyError, TypeError, AttributeError,
+            ZeroDivisionError, struct.error) as e:
+        raise BedMeshError("bed_mesh: invalid parameters in profile file"
+                           " %s: %s" % (filename, str(e)))
+    if not valid:
+        raise BedMeshError("bed_mesh: profile file %s does not match its"
+                           " parameters" % (filename,))
+    mesh._set_mesh_table([list(mesh_z[i:i+mx_cnt])
+                          for i in range(0, mx_cnt * my_cnt, mx_cnt)])
+    probed_z_table = [list(probed[i:i+px_cnt])
+                      for i in range(0, px_cnt * py_cnt, px_cnt)]
+    return mesh, probed_z_table
+
 # retreive commma separated pair from config
 def parse_pair(config, param, check=True, cast=float,
                minval=None, maxval=None):
@@ -63,17 +149,37 @@ class BedMesh:
         if self.fade_dist <= 0.:
             self.fade_start = self.fade_end = self.FADE_DISABLE
         self.gcode = self.printer.lookup_object('gcode')
-        self.splitter = MoveSplitter(config, self.gcode)
+        splitters = {'cell': CellMoveSplitter, 'sample': MoveSplitter}
+        split_method = config.get('split_method', 'sample').strip().lower()
+        if split_method not in splitters:
+            raise config.error(
+                "bed_mesh: Unknown split_method <%s>" % (split_method,))
+        self.splitter = splitters[split_method](config, self.gcode)
+        config_dir = os.path.dirname(os.path.abspath(
+            self.printer.get_start_args()['config_file']))
+        self.profile_path = os.path.normpath(os.path.expanduser(config.get(
+            'profile_path', os.path.join(config_dir, 'bed_mesh'))))
         self.gcode.register_command(
             'BED_MESH_OUTPUT', self.cmd_BED_MESH_OUTPUT,
             desc=self.cmd_BED_MESH_OUTPUT_help)
         self.gcode.register_command(
             'BED_MESH_CLEAR', self.cmd_BED_MESH_CLEAR,
             desc=self.cmd_BED_MESH_CLEAR_help)
+        self.gcode.register_command(
+            'BED_MESH_PROFILE', self.cmd_BED_MESH_PROFILE,
+            desc=self.cmd_BED_MESH_PROFILE_help)
         self.gcode.set_move_transform(self)
     def printer_state(self, state):
         if state == 'connect':
             self.toolhead = self.printer.lookup_object('toolhead')
+        elif state == 'ready':
+            # Restore the "default" profile (if one has been saved)
+            if os.path.exists(self.get_profile_filename('default')):
+                try:
+                    self.load_profile('default')
+                except self.gcode.error:
+                    logging.exception("bed_mesh: unable to load default"
+                                      " profile")
     def set_mesh(self, mesh):
         # Assign the current mesh.  If set to None, no transform
         # is applied
@@ -124,6 +230,70 @@ class BedMesh:
     cmd_BED_MESH_CLEAR_help = "Clear the Mesh so no z-adjusment is made"
     def cmd_BED_MESH_CLEAR(self, params):
         self.set_mesh(None)
+    # Mesh profiles
+    def get_profile_filename(self, name):
+        return os.path.join(self.profile_path, name + ".mesh")
+    def get_profile_names(self):
+        try:
+            filenames = os.listdir(self.profile_path)
+        except OSError:
+            return []
+        return sorted([fname[:-5] for fname in filenames
+                       if fname.endswith(".mesh")])
+    def save_profile(self, name):
+        # The probed table must match the current mesh
+        mesh = self.z_mesh
+        probed_z_table = self.calibrate.probed_z_table
+        if (mesh is None or not probed_z_table
+            or len(probed_z_table) != mesh.probe_params['y_count']
+            or len(probed_z_table[0]) != mesh.probe_params['x_count']):
+            raise self.gcode.error("bed_mesh: no mesh to save")
+        try:
+            if not os.path.exists(self.profile_path):
+                os.makedirs(self.profile_path)
+            save_profile(self.get_profile_filename(name), mesh,
+                         probed_z_table)
+        except (IOError, OSError):
+            logging.exception("bed_mesh: profile save")
+            raise self.gcode.error("bed_mesh: unable to save profile '%s'"
+                                   % (name,))
+        self.gcode.respond_info("Mesh profile '%s' saved" % (name,))
+    def load_profile(self, name):
+        try:
+            mesh, probed_z_table = load_profile(
+                self.get_profile_filename(name))
+        except (IOError, OSError):
+            raise self.gcode.error("bed_mesh: unable to load profile '%s'"
+                                   % (name,))
+        except BedMeshError as e:
+            raise self.gcode.error(str(e))
+        self.calibrate.probed_z_table = probed_z_table
+        self.set_mesh(mesh)
+        self.gcode.respond_info("Mesh profile '%s' loaded" % (name,))
+    def remove_profile(self, name):
+        try:
+            os.remove(self.get_profile_filename(name))
+        except OSError:
+            raise self.gcode.error("bed_mesh: unable to remove profile '%s'"
+                                   % (name,))
+        self.gcode.respond_info("Mesh profile '%s' removed" % (name,))
+    cmd_BED_MESH_PROFILE_help = "Save, load, or remove a mesh profile"
+    def cmd_BED_MESH_PROFILE(self, params):
+        actions = [('SAVE', self.save_profile), ('LOAD', self.load_profile),
+                   ('REMOVE', self.remove_profile)]
+        for key, func in actions:
+            name = self.gcode.get_str(key, params, None)
+            if name is None:
+                continue
+            if not PROFILE_NAME_RE.match(name):
+                raise self.gcode.error(
+                    "bed_mesh: invalid profile name '%s'" % (name,))
+            func(name)
+            return
+        self.gcode.respond_info(
+            "Usage: BED_MESH_PROFILE [SAVE|LOAD|REMOVE]=<name>\n"
+            "Saved profiles: %s" % (
+                ", ".join(self.get_profile_names()) or "none",))
 
 
 class BedMeshCalibrate:
@@ -300,10 +470,24 @@ class MoveSplitter:
             self.z_factor \
             * self.z_mesh.get_z(self.prev_pos[0], self.prev_pos[1])
         self.traverse_complete = False
-        self.distance_checked = 0.
         axes_d = [self.next_pos[i] - self.prev_pos[i] for i in range(4)]
         self.total_move_length = math.sqrt(sum([d*d for d in axes_d[:3]]))
         self.axis_move = [not isclose(d, 0., abs_tol=1e-10) for d in axes_d]
+        # Look up the z adjustment of all check points in one batch
+        self.check_dists = []
+        self.check_z = []
+        self.check_index = 0
+        if self.axis_move[0] or self.axis_move[1]:
+            distance_checked = 0.
+            while distance_checked + self.move_check_distance \
+                    < self.total_move_length:
+                distance_checked += self.move_check_distance
+                self.check_dists.append(distance_checked)
+            xs, ys = [[lerp(d / self.total_move_length, self.prev_pos[i],
+                            self.next_pos[i]) if self.axis_move[i]
+                       else self.prev_pos[i] for d in self.check_dists]
+                      for i in range(2)]
+            self.check_z = self.z_mesh.get_z_many(xs, ys)
     def _set_next_move(self, distance_from_prev):
         t = distance_from_prev / self.total_move_length
         if t > 1. or t < 0.:
@@ -316,21 +500,17 @@ class MoveSplitter:
                     t, self.prev_pos[i], self.next_pos[i])
     def split(self):
         if not self.traverse_complete:
-            if self.axis_move[0] or self.axis_move[1]:
-                # X and/or Y axis move, traverse if necessary
-                while self.distance_checked + self.move_check_distance \
-                        < self.total_move_length:
-                    self.distance_checked += self.move_check_distance
-                    self._set_next_move(self.distance_checked)
-                    next_z = \
-                        self.z_factor \
-                        * self.z_mesh.get_z(
-                            self.current_pos[0], self.current_pos[1])
-                    if abs(next_z - self.z_offset) >= self.split_delta_z:
-                        self.z_offset = next_z
-                        return self.current_pos[0], self.current_pos[1], \
-                            self.current_pos[2] + self.z_offset, \
-                            self.current_pos[3]
+            # X and/or Y axis move, traverse if necessary
+            while self.check_index < len(self.check_dists):
+                idx = self.check_index
+                self.check_index += 1
+                next_z = self.z_factor * self.check_z[idx]
+                if abs(next_z - self.z_offset) >= self.split_delta_z:
+                    self._set_next_move(self.check_dists[idx])
+                    self.z_offset = next_z
+                    return self.current_pos[0], self.current_pos[1], \
+                        self.current_pos[2] + self.z_offset, \
+                        self.current_pos[3]
             # end of move reached
             self.current_pos[:] = self.next_pos
             self.z_offset = \
@@ -346,12 +526,123 @@ class MoveSplitter:
             return None
 
 
+# Split moves at the points where they cross the cells of the mesh
+# grid.  Within a cell the bilinear mesh is a quadratic function of the
+# distance along a move, so the sub-moves needed to follow the mesh
+# within split_delta_z can be calculated directly.
+class CellMoveSplitter:
+    def __init__(self, config, gcode):
+        self.split_delta_z = config.getfloat(
+            'split_delta_z', .025, minval=0.01)
+        # Only used by the "sample" method - read so that a config
+        # written for it is still accepted
+        config.getfloat('move_check_distance', 5., minval=3.)
+        self.z_mesh = None
+        self.gcode = gcode
+        self.traverse_complete = True
+    def set_mesh(self, mesh):
+        self.z_mesh = mesh
+    def build_move(self, prev_pos, next_pos, factor):
+        self.prev_pos = tuple(prev_pos)
+        self.next_pos = tuple(next_pos)
+        self.z_factor = factor
+        self.split_points = self._calc_split_points()
+        self.split_points.reverse()
+        self.traverse_complete = False
+    def _get_grid_crossings(self, c0, d, mesh_min, mesh_dist, mesh_cnt):
+        # Return the positions along the move (0. to 1.) where it
+        # crosses a grid line of an axis
+        if isclose(d, 0., abs_tol=1e-10):
+            return []
+        c1 = c0 + d
+        first = max(0, int(math.ceil((min(c0, c1) - mesh_min) / mesh_dist)))
+        last = min(mesh_cnt - 1,
+                   int(math.floor((max(c0, c1) - mesh_min) / mesh_dist)))
+        out = []
+        for i in range(first, last + 1):
+            t = (mesh_min + i * mesh_dist - c0) / d
+            if t > 0. and t < 1.:
+                out.append(t)
+        return out
+    def _get_z_many(self, ts):
+        xs = [lerp(t, self.prev_pos[0], self.next_pos[0]) for t in ts]
+        ys = [lerp(t, self.prev_pos[1], self.next_pos[1]) for t in ts]
+        factor = self.z_factor
+        return [factor * z for z in self.z_mesh.get_z_many(xs, ys)]
+    def _calc_split_points(self):
+        # Returns a list of (position along move, z adjustment)
+        mesh = self.z_mesh
+        x0, y0 = self.prev_pos[:2]
+        dx = self.next_pos[0] - x0
+        dy = self.next_pos[1] - y0
+        if isclose(dx, 0., abs_tol=1e-10) and isclose(dy, 0., abs_tol=1e-10):
+            return []
+        crossings = sorted(
+            self._get_grid_crossings(x0, dx, mesh.mesh_x_min,
+                                     mesh.mesh_x_dist, mesh.mesh_x_count)
+            + self._get_grid_crossings(y0, dy, mesh.mesh_y_min,
+                                       mesh.mesh_y_dist, mesh.mesh_y_count))
+        cells = [0.]
+        for t in crossings:
+            if t - cells[-1] >= 1e-9 and 1. - t >= 1e-9:
+                cells.append(t)
+        cells.append(1.)
+        # The z along a move is quadratic within a cell - the largest
+        # deviation from a straight line is at the middle of the cell
+        mids = [.5 * (t0 + t1) for t0, t1 in zip(cells[:-1], cells[1:])]
+        zs = self._get_z_many(cells + mids)
+        cell_z, mid_z = zs[:len(cells)], zs[len(cells):]
+        # Half of the tolerance is allowed for the curvature within a
+        # cell and half for the merging of sub-moves below
+        max_dev = .5 * self.split_delta_z
+        extra = []
+        for i, z in enumerate(mid_z):
+            dev = abs(z - .5 * (cell_z[i] + cell_z[i+1]))
+            count = int(math.ceil(math.sqrt(dev / max_dev)))
+            t0, t1 = cells[i], cells[i+1]
+            extra.extend([t0 + (t1 - t0) * j / count for j in range(1, count)])
+        points = sorted(list(zip(cells, cell_z))
+                        + list(zip(extra, self._get_z_many(extra))))
+        # Only split where a single move would deviate from the points
+        out = []
+        start = 0
+        for end in range(2, len(points)):
+            ts, zs = points[start]
+            te, ze = points[end]
+            slope = (ze - zs) / (te - ts)
+            for t, z in points[start+1:end]:
+                if abs(zs + slope * (t - ts) - z) > max_dev:
+                    start = end - 1
+                    out.append(points[start])
+                    break
+        out.append(points[-1])
+        return out
+    def split(self):
+        if self.traverse_complete:
+            return None
+        if not self.split_points:
+            # No X/Y movement
+            pos = list(self.next_pos)
+            pos[2] += self.z_factor * self.z_mesh.get_z(pos[0], pos[1])
+            self.traverse_complete = True
+            return pos
+        t, z = self.split_points.pop()
+        if not self.split_points:
+            pos = list(self.next_pos)
+            self.traverse_complete = True
+        else:
+            pos = [lerp(t, p, n) if p != n else p
+                   for p, n in zip(self.prev_pos, self.next_pos)]
+        pos[2] += z
+        return pos
+
+
 class ZMesh:
     def __init__(self, params):
-        self.mesh_z_table = None
+        self.mesh_z_table = self.np_z_table = None
         self.probe_params = params
         logging.debug('bed_mesh: probe/mesh parameters:')
-        for key, value in self.probe_params.iteritems():
+        for key, value in self.probe_params.items():
             logging.debug("%s :  %s" % (key, value))
         self.mesh_x_min = params['min_x'] + params['x_offset']
         self.mesh_x_max = params['max_x'] + params['x_offset']
@@ -406,6 +697,47 @@ class ZMesh:
         else:
             # No mesh table generated, no z-adjustment
             return 0.
+    def get_z_many(self, xs, ys):
+        # Batch version of get_z() - returns identical results
+        if not self.mesh_z_table:
+            return [0.] * len(xs)
+        if numpy is not None and len(xs) >= NUMPY_MIN_POINTS:
+            return self._get_z_many_numpy(xs, ys)
+        tbl = self.mesh_z_table
+        x_min, x_dist, x_last = (
+            self.mesh_x_min, self.mesh_x_dist, self.mesh_x_count - 2)
+        y_min, y_dist, y_last = (
+            self.mesh_y_min, self.mesh_y_dist, self.mesh_y_count - 2)
+        floor = math.floor
+        out = []
+        for x, y in zip(xs, ys):
+            xidx = min(x_last, max(0, int(floor((x - x_min) / x_dist))))
+            tx = min(1., max(0., (x - (x_min + x_dist * xidx)) / x_dist))
+            yidx = min(y_last, max(0, int(floor((y - y_min) / y_dist))))
+            ty = min(1., max(0., (y - (y_min + y_dist * yidx)) / y_dist))
+            row0 = tbl[yidx]
+            row1 = tbl[yidx+1]
+            z0 = (1. - tx) * row0[xidx] + tx * row0[xidx+1]
+            z1 = (1. - tx) * row1[xidx] + tx * row1[xidx+1]
+            out.append((1. - ty) * z0 + ty * z1)
+        return out
+    def _get_z_many_numpy(self, xs, ys):
+        if self.np_z_table is None:
+            self.np_z_table = numpy.array(self.mesh_z_table, dtype=float)
+        tbl = self.np_z_table
+        def get_index(coords, mesh_min, mesh_dist, mesh_cnt):
+            c = numpy.asarray(coords, dtype=float)
+            idx = numpy.floor((c - mesh_min) / mesh_dist)
+            idx = numpy.clip(idx, 0, mesh_cnt - 2).astype(int)
+            t = (c - (mesh_min + mesh_dist * idx)) / mesh_dist
+            return numpy.clip(t, 0., 1.), idx
+        tx, xidx = get_index(
+            xs, self.mesh_x_min, self.mesh_x_dist, self.mesh_x_count)
+        ty, yidx = get_index(
+            ys, self.mesh_y_min, self.mesh_y_dist, self.mesh_y_count)
+        z0 = (1. - tx) * tbl[yidx, xidx] + tx * tbl[yidx, xidx+1]
+        z1 = (1. - tx) * tbl[yidx+1, xidx] + tx * tbl[yidx+1, xidx+1]
+        return ((1. - ty) * z0 + ty * z1).tolist()
     def print_mesh(self, print_func, move_z=None):
         if self.mesh_z_table is not None:
             msg = "Mesh X,Y: %d,%d\n" % (self.mesh_x_count, self.mesh_y_count)
@@ -439,161 +771,88 @@ class ZMesh:
         idx = constrain(idx, 0, mesh_cnt - 2)
         t = (coord - cfunc(idx)) / mesh_dist
         return constrain(t, 0., 1.), idx
-    def _sample_direct(self, z_table):
+    def _set_mesh_table(self, z_table):
         self.mesh_z_table = z_table
-    def _sample_lagrange(self, z_table):
-        x_mult = self.x_mult
-        y_mult = self.y_mult
-        self.mesh_z_table = \
-            [[0. if ((i % x_mult) or (j % y_mult))
-             else z_table[j/y_mult][i/x_mult]
-             for i in range(self.mesh_x_count)]
-             for j in range(self.mesh_y_count)]
-        xpts, ypts = self._get_lagrange_coords(z_table)
-        # Interpolate X coordinates
-        for i in range(self.mesh_y_count):
-            # only interpolate X-rows that have probed coordinates
-            if i % y_mult != 0:
+        self.np_z_table = None
+    def _sample_direct(self, z_table):
+        self._set_mesh_table(z_table)
+    # Both upsampling algorithms are separable - each interpolated
+    # point is a weighted sum of the probed points on its row (or
+    # column).  The weights only depend on the mesh geometry, so the
+    # full table is calculated as Wy * Z * Wx^T.
+    def _apply_weights(self, z_table, x_weights, y_weights):
+        if numpy is not None:
+            z = numpy.array(z_table, dtype=float)
+            wx = numpy.array(x_weights, dtype=float)
+            wy = numpy.array(y_weights, dtype=float)
+            return numpy.dot(numpy.dot(wy, z), wx.T).tolist()
+        cols = list(zip(*z_table))
+        rows = [[sum([w * z for w, z in zip(wrow, col)]) for col in cols]
+                for wrow in y_weights]
+        return [[sum([w * z for w, z in zip(wrow, row)])
+                 for wrow in x_weights] for row in rows]
+    def _get_lagrange_weights(self, probe_cnt, mult, cfunc):
+        lpts = [cfunc(i * mult) for i in range(probe_cnt)]
+        weights = []
+        for j in range(probe_cnt * mult - (mult - 1)):
+            w = [0.] * probe_cnt
+            if j % mult == 0:
+                # Probed point
+                w[j // mult] = 1.
+                weights.append(w)
                 continue
-            for j in range(self.mesh_x_count):
-                if j % x_mult == 0:
-                    continue
-                x = self.get_x_coordinate(j)
-                self.mesh_z_table[i][j] = self._calc_lagrange(xpts, x, i, 0)
-        # Interpolate Y coordinates
-        for i in range(self.mesh_x_count):
-            for j in range(self.mesh_y_count):
-                if j % y_mult == 0:
-                    continue
-                y = self.get_y_coordinate(j)
-                self.mesh_z_table[j][i] = self._calc_lagrange(ypts, y, i, 1)
+            c = cfunc(j)
+            for i in range(probe_cnt):
+                n = d = 1.
+                for k in range(probe_cnt):
+                    if k != i:
+                        n *= (c - lpts[k])
+                        d *= (lpts[i] - lpts[k])
+                w[i] = n / d
+            weights.append(w)
+        return weights
+    def _sample_lagrange(self, z_table):
+        x_weights = self._get_lagrange_weights(
+            self.probe_params['x_count'], self.x_mult, self.get_x_coordinate)
+        y_weights = self._get_lagrange_weights(
+            self.probe_params['y_count'], self.y_mult, self.get_y_coordinate)
+        self._set_mesh_table(
+            self._apply_weights(z_table, x_weights, y_weights))
         self.print_mesh(logging.debug)
-    def _get_lagrange_coords(self, z_table):
-        xpts = []
-        ypts = []
-        for i in range(self.probe_params['x_count']):
-            xpts.append(self.get_x_coordinate(i * self.x_mult))
-        for j in range(self.probe_params['y_count']):
-            ypts.append(self.get_y_coordinate(j * self.y_mult))
-        return xpts, ypts
-    def _calc_lagrange(self, lpts, c, vec, axis=0):
-        pt_cnt = len(lpts)
-        total = 0.
-        for i in range(pt_cnt):
-            n = 1.
-            d = 1.
-            for j in range(pt_cnt):
-                if j == i:
-                    continue
-                n *= (c - lpts[j])
-                d *= (lpts[i] - lpts[j])
-            if axis == 0:
-                # Calc X-Axis
-                z = self.mesh_z_table[vec][i*self.x_mult]
-            else:
-                # Calc Y-Axis
-                z = self.mesh_z_table[i*self.y_mult][vec]
-            total += z * n / d
-        return total
+    def _get_bicubic_weights(self, probe_cnt, mult, tension):
+        # Cardinal spline weights - the end segments repeat the first
+        # (or last) probed point as the outer control point
+        weights = []
+        for j in range(probe_cnt * mult - (mult - 1)):
+            w = [0.] * probe_cnt
+            if j % mult == 0:
+                w[j // mult] = 1.
+                weights.append(w)
+                continue
+            seg = j // mult
+            t = (j - seg * mult) / float(mult)
+            t2 = t*t
+            t3 = t2*t
+            h00 = 2*t3 - 3*t2 + 1
+            h01 = -2*t3 + 3*t2
+            h10 = t3 - 2*t2 + t
+            h11 = t3 - t2
+            w[max(seg - 1, 0)] -= tension * h10
+            w[seg] += h00 - tension * h11
+            w[seg + 1] += h01 + tension * h10
+            w[min(seg + 2, probe_cnt - 1)] += tension * h11
+            weights.append(w)
+        return weights
     def _sample_bicubic(self, z_table):
         # should work for any number of probe points above 3x3
-        x_mult = self.x_mult
-        y_mult = self.y_mult
         c = self.probe_params['tension']
-        self.mesh_z_table = \
-            [[0. if ((i % x_mult) or (j % y_mult))
-             else z_table[j/y_mult][i/x_mult]
-             for i in range(self.mesh_x_count)]
-             for j in range(self.mesh_y_count)]
-        # Interpolate X values
-        for y in range(self.mesh_y_count):
-            if y % y_mult != 0:
-                continue
-            for x in range(self.mesh_x_count):
-                if x % x_mult == 0:
-                    continue
-                pts = self._get_x_ctl_pts(x, y)
-                self.mesh_z_table[y][x] = self._cardinal_spline(pts, c)
-        # Interpolate Y values
-        for x in range(self.mesh_x_count):
-            for y in range(self.mesh_y_count):
-                if y % y_mult == 0:
-                    continue
-                pts = self._get_y_ctl_pts(x, y)
-                self.mesh_z_table[y][x] = self._cardinal_spline(pts, c)
+        x_weights = self._get_bicubic_weights(
+            self.probe_params['x_count'], self.x_mult, c)
+        y_weights = self._get_bicubic_weights(
+            self.probe_params['y_count'], self.y_mult, c)
+        self._set_mesh_table(
+            self._apply_weights(z_table, x_weights, y_weights))
         self.print_mesh(logging.debug)
-    def _get_x_ctl_pts(self, x, y):
-        # Fetch control points and t for a X value in the mesh
-        x_mult = self.x_mult
-        x_row = self.mesh_z_table[y]
-        last_pt = self.mesh_x_count - 1 - x_mult
-        if x < x_mult:
-            p0 = p1 = x_row[0]
-            p2 = x_row[x_mult]
-            p3 = x_row[2*x_mult]
-            t = x / float(x_mult)
-        elif x > last_pt:
-            p0 = x_row[last_pt - x_mult]
-            p1 = x_row[last_pt]
-            p2 = p3 = x_row[last_pt + x_mult]
-            t = (x - last_pt) / float(x_mult)
-        else:
-            found = False
-            for i in range(x_mult, last_pt, x_mult):
-                if x > i and x < (i + x_mult):
-                    p0 = x_row[i - x_mult]
-                    p1 = x_row[i]
-                    p2 = x_row[i + x_mult]
-                    p3 = x_row[i + 2*x_mult]
-                    t = (x - i) / float(x_mult)
-                    found = True
-                    break
-            if not found:
-                raise BedMeshError(
-                    "bed_mesh: Error finding x control points")
-        return p0, p1, p2, p3, t
-    def _get_y_ctl_pts(self, x, y):
-        # Fetch control points and t for a Y value in the mesh
-        y_mult = self.y_mult
-        last_pt = self.mesh_y_count - 1 - y_mult
-        y_col = self.mesh_z_table
-        if y < y_mult:
-            p0 = p1 = y_col[0][x]
-            p2 = y_col[y_mult][x]
-            p3 = y_col[2*y_mult][x]
-            t = y / float(y_mult)
-        elif y > last_pt:
-            p0 = y_col[last_pt - y_mult][x]
-            p1 = y_col[last_pt][x]
-            p2 = p3 = y_col[last_pt + y_mult][x]
-            t = (y - last_pt) / float(y_mult)
-        else:
-            found = False
-            for i in range(y_mult, last_pt, y_mult):
-                if y > i and y < (i + y_mult):
-                    p0 = y_col[i - y_mult][x]
-                    p1 = y_col[i][x]
-                    p2 = y_col[i + y_mult][x]
-                    p3 = y_col[i + 2*y_mult][x]
-                    t = (y - i) / float(y_mult)
-                    found = True
-                    break
-            if not found:
-                raise BedMeshError(
-                    "bed_mesh: Error finding y control points")
-        return p0, p1, p2, p3, t
-    def _cardinal_spline(self, p, tension):
-        t = p[4]
-        t2 = t*t
-        t3 = t2*t
-        m1 = tension * (p[2] - p[0])
-        m2 = tension * (p[3] - p[1])
-        a = p[1] * (2*t3 - 3*t2 + 1)
-        b = p[2] * (-2*t3 + 3*t2)
-        c = m1 * (t3 - 2*t2 + t)
-        d = m2 * (t3 - t2)
-        return a + b + c + d
-
 
 def load_config(config):
     return BedMesh(config)
@@ -24,6 +24,7 @@ class PrinterLCD:
         # menu
         self.menu = menu.MenuManager(config, self.lcd_chip)
         # printer objects
+        self.status = self.printer.lookup_object('status')
         self.gcode = self.toolhead = self.sdcard = None
         self.fan = self.extruder0 = self.extruder1 = self.heater_bed = None
         # screen updating
@@ -86,31 +87,32 @@ class PrinterLCD:
         return eventtime + .500
     def screen_update_hd44780(self, eventtime):
         lcd_chip = self.lcd_chip
+        status = self.status
         # Heaters
         if self.extruder0 is not None:
-            info = self.extruder0.get_heater().get_status(eventtime)
+            info = status.lookup_status('extruder0', eventtime)
             lcd_chip.write_glyph(0, 0, 'extruder')
             self.draw_heater(1, 0, info)
         if self.extruder1 is not None:
-            info = self.extruder1.get_heater().get_status(eventtime)
+            info = status.lookup_status('extruder1', eventtime)
             lcd_chip.write_glyph(0, 1, 'extruder')
             self.draw_heater(1, 1, info)
         if self.heater_bed is not None:
-            info = self.heater_bed.get_status(eventtime)
+            info = status.lookup_status('heater_bed', eventtime)
             lcd_chip.write_glyph(10, 0, 'bed')
             self.draw_heater(11, 0, info)
         # Fan speed
         if self.fan is not None:
-            info = self.fan.get_status(eventtime)
+            info = status.lookup_status('fan', eventtime)
             lcd_chip.write_text(10, 1, "Fan")
             self.draw_percent(14, 1, 4, info['speed'])
         # G-Code speed factor
-        gcode_info = self.gcode.get_status(eventtime)
+        gcode_info = status.lookup_status('gcode', eventtime)
         lcd_chip.write_glyph(0, 2, 'feedrate')
         self.draw_percent(1, 2, 4, gcode_info['speed_factor'])
         # Print progress
         progress = None
-        toolhead_info = self.toolhead.get_status(eventtime)
+        toolhead_info = status.lookup_status('toolhead', eventtime)
         if self.progress is not None:
             progress = self.progress / 100.
             lcd_chip.write_glyph(8, 2, 'usb')
@@ -120,7 +122,7 @@ class PrinterLCD:
                 if self.prg_time <= 0.:
                     self.progress = None
         elif self.sdcard is not None:
-            info = self.sdcard.get_status(eventtime)
+            info = status.lookup_status('virtual_sdcard', eventtime)
             progress = info['progress']
             lcd_chip.write_glyph(8, 2, 'sd')
         if progress is not None:
@@ -139,19 +141,20 @@ class PrinterLCD:
         else:
             self.draw_status(0, 3, gcode_info, toolhead_info)
     def screen_update_128x64(self, eventtime):
+        status = self.status
         # Heaters
         if self.extruder0 is not None:
-            info = self.extruder0.get_heater().get_status(eventtime)
+            info = status.lookup_status('extruder0', eventtime)
             self.lcd_chip.write_glyph(0, 0, 'extruder')
             self.draw_heater(2, 0, info)
         extruder_count = 1
         if self.extruder1 is not None:
-            info = self.extruder1.get_heater().get_status(eventtime)
+            info = status.lookup_status('extruder1', eventtime)
             self.lcd_chip.write_glyph(0, 1, 'extruder')
             self.draw_heater(2, 1, info)
             extruder_count = 2
         if self.heater_bed is not None:
-            info = self.heater_bed.get_status(eventtime)
+            info = status.lookup_status('heater_bed', eventtime)
             if info['target']:
                 self.animate_glyphs(eventtime, 0, extruder_count,
                                     'bed_heat', True)
@@ -160,12 +163,12 @@ class PrinterLCD:
             self.draw_heater(2, extruder_count, info)
         # Fan speed
         if self.fan is not None:
-            info = self.fan.get_status(eventtime)
+            info = status.lookup_status('fan', eventtime)
             self.animate_glyphs(eventtime, 10, 0, 'fan', info['speed'] != 0.)
             self.draw_percent(12, 0, 4, info['speed'], '>')
         # SD card print progress
         progress = None
-        toolhead_info = self.toolhead.get_status(eventtime)
+        toolhead_info = status.lookup_status('toolhead', eventtime)
         if self.progress is not None:
             progress = self.progress / 100.
             if toolhead_info['status'] != "Printing":
@@ -174,7 +177,7 @@ class PrinterLCD:
                 if self.prg_time <= 0.:
                     self.progress = None
         elif self.sdcard is not None:
-            info = self.sdcard.get_status(eventtime)
+            info = status.lookup_status('virtual_sdcard', eventtime)
             progress = info['progress']
         if progress is not None:
             if extruder_count == 1:
@@ -184,7 +187,7 @@ class PrinterLCD:
             self.draw_percent(x, y, width, progress, '^')
             self.draw_progress_bar(x, y, width, progress)
         # G-Code speed factor
-        gcode_info = self.gcode.get_status(eventtime)
+        gcode_info = status.lookup_status('gcode', eventtime)
         if extruder_count == 1:
             self.lcd_chip.write_glyph(10, 1, 'feedrate')
             self.draw_percent(12, 1, 4, gcode_info['speed_factor'], '>')
@@ -25,7 +25,7 @@ class IdleTimeout:
         gcode = self.printer.lookup_object('gcode')
         for line in self.idle_script.split('\n'):
             try:
-                res = gcode.process_batch(line)
+                res = gcode.process_batch([line])
             except:
                 break
             if not res:
@@ -3,20 +3,250 @@
 # Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, logging
+import os, sys, logging, threading, collections, struct, marshal, hashlib
+from .. import gcode
+
+READ_CHUNK_SIZE = 64 * 1024
+READ_AHEAD_CHUNKS = 8
+
+# Read the file from a background thread so that slow storage does not
+# stall the reactor.  At most READ_AHEAD_CHUNKS chunks are buffered.
+class FileReadAhead:
+    def __init__(self, filename, position):
+        self.lock = threading.Condition()
+        self.chunks = collections.deque()
+        self.read_error = self.must_exit = False
+        self.file = open(filename, 'rb')
+        self.seek(position)
+        self.thread = threading.Thread(target=self._bg_thread)
+        self.thread.daemon = True
+        self.thread.start()
+    def _bg_thread(self):
+        while 1:
+            with self.lock:
+                while (len(self.chunks) >= READ_AHEAD_CHUNKS
+                       and not self.must_exit):
+                    self.lock.wait()
+                if self.must_exit:
+                    break
+            try:
+                data = self.read_data()
+            except:
+                logging.exception("virtual_sdcard read")
+                self.read_error = True
+                data = ""
+            with self.lock:
+                self.chunks.append(data)
+            if not data:
+                break
+        self.file.close()
+    def seek(self, position):
+        self.file.seek(position)
+    def read_data(self):
+        data = self.file.read(READ_CHUNK_SIZE)
+        if bytes is not str:
+            # Keep one character per byte so that file positions can
+            # be derived from line lengths
+            data = data.decode('latin-1')
+        return data
+    def get_data(self):
+        # Returns None if no data is available yet and an empty string
+        # at the end of the file (or on a read error)
+        with self.lock:
+            if not self.chunks:
+                return None
+            data = self.chunks[0]
+            if data:
+                self.chunks.popleft()
+                self.lock.notify()
+            return data
+    def stop(self):
+        with self.lock:
+            self.must_exit = True
+            self.lock.notify()
+        self.thread.join()
+
+######################################################################
+# Pre-parsed g-code cache
+######################################################################
+
+# A cache file holds the lines of a g-code file with the G0/G1 moves
+# already tokenized (see gcode.tokenize_move).  After a header that
+# identifies the source file, it contains one block per chunk of
+# lines: the file position of the first line, followed by the
+# marshal'ed lengths of each line (for M26/M27) and the lines.
+
+CACHE_MAGIC = b"KGCACHE2"
+CACHE_HEADER = struct.Struct("<I")
+CACHE_BLOCK = struct.Struct("<QI")
+CACHE_HASH_SIZE = 64 * 1024
+
+def get_cache_filename(cache_dirname, filename):
+    return os.path.join(cache_dirname, os.path.basename(filename) + ".cache")
+
+# Identify a file by its size, modification time, and a hash of its
+# start and end (hashing a large file in full takes too long)
+def get_file_key(filename):
+    st = os.stat(filename)
+    h = hashlib.sha1()
+    f = open(filename, 'rb')
+    try:
+        h.update(f.read(CACHE_HASH_SIZE))
+        if st.st_size > CACHE_HASH_SIZE:
+            f.seek(max(CACHE_HASH_SIZE, st.st_size - CACHE_HASH_SIZE))
+            h.update(f.read(CACHE_HASH_SIZE))
+    finally:
+        f.close()
+    return (tuple(sys.version_info[:2]), st.st_size, st.st_mtime,
+            h.hexdigest())
+
+# Return the file offset of the first block if the cache is valid
+def check_cache(cache_filename, key):
+    try:
+        f = open(cache_filename, 'rb')
+    except EnvironmentError:
+        return None
+    try:
+        header = f.read(len(CACHE_MAGIC) + CACHE_HEADER.size)
+        if header[:len(CACHE_MAGIC)] != CACHE_MAGIC:
+            return None
+        length, = CACHE_HEADER.unpack(header[len(CACHE_MAGIC):])
+        if marshal.loads(f.read(length)) != key:
+            return None
+        return f.tell()
+    except (EnvironmentError, ValueError, EOFError, TypeError, struct.error):
+        return None
+    finally:
+        f.close()
+
+def tokenize_lines(lines):
+    entries = []
+    for line in lines:
+        sline = line.strip()
+        args = None
+        if sline[:1] == 'G':
+            args = gcode.tokenize_move(sline)
+        if args is None:
+            entries.append(line)
+        else:
+            entries.append((args, sline))
+    return entries
+
+class CacheWriter:
+    def __init__(self, cache_filename, key):
+        self.cache_filename = cache_filename
+        self.tmp_filename = cache_filename + ".tmp"
+        self.file = open(self.tmp_filename, 'wb')
+        data = marshal.dumps(key)
+        self.file.write(CACHE_MAGIC + CACHE_HEADER.pack(len(data)) + data)
+        self.position = 0
+    def add_lines(self, lines, is_final=False):
+        # Store the next chunk of lines - returns the cache entries.
+        # The final line of a file may not have a trailing newline.
+        lengths = [len(line) + 1 for line in lines]
+        if is_final:
+            lengths[-1] -= 1
+        entries = tokenize_lines(lines)
+        data = marshal.dumps((lengths, entries))
+        self.file.write(CACHE_BLOCK.pack(self.position, len(data)) + data)
+        self.position += sum(lengths)
+        return entries, lengths
+    def finish(self):
+        self.file.close()
+        os.rename(self.tmp_filename, self.cache_filename)
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.tmp_filename)
+        except OSError:
+            pass
+
+# Build a cache file for a g-code file (eg, from scripts/buildgcodecache.py)
+def build_cache(filename, cache_filename):
+    writer = CacheWriter(cache_filename, get_file_key(filename))
+    try:
+        f = open(filename, 'rb')
+        partial_input = ""
+        while 1:
+            data = f.read(READ_CHUNK_SIZE)
+            if bytes is not str:
+                data = data.decode('latin-1')
+            if not data:
+                if partial_input:
+                    writer.add_lines([partial_input], is_final=True)
+                break
+            lines = data.split('\n')
+            lines[0] = partial_input + lines[0]
+            partial_input = lines.pop()
+            writer.add_lines(lines)
+        f.close()
+    except:
+        writer.abort()
+        raise
+    writer.finish()
+
+# Read cache blocks from a background thread
+class CacheReadAhead(FileReadAhead):
+    def __init__(self, cache_filename, data_offset, position):
+        self.data_offset = data_offset
+        self.is_corrupt = False
+        FileReadAhead.__init__(self, cache_filename, position)
+    def seek(self, position):
+        # Find the block containing the requested file position
+        offset = block_offset = self.data_offset
+        while 1:
+            self.file.seek(offset)
+            header = self.file.read(CACHE_BLOCK.size)
+            if len(header) < CACHE_BLOCK.size:
+                break
+            block_pos, length = CACHE_BLOCK.unpack(header)
+            if block_pos > position:
+                break
+            block_offset = offset
+            offset += CACHE_BLOCK.size + length
+        self.file.seek(block_offset)
+    def read_data(self):
+        header = self.file.read(CACHE_BLOCK.size)
+        if not header:
+            return ""
+        try:
+            position, length = CACHE_BLOCK.unpack(header)
+            data = self.file.read(length)
+            if len(data) != length:
+                raise EOFError("truncated block")
+            lengths, entries = marshal.loads(data)
+            if len(lengths) != len(entries):
+                raise ValueError("invalid block")
+        except (ValueError, EOFError, TypeError, struct.error) as e:
+            # Report a corrupt cache as the end of the data
+            logging.warning("virtual_sdcard cache read: %s", e)
+            self.is_corrupt = True
+            return ""
+        return position, lengths, entries
+
+######################################################################
+# Virtual sdcard
+######################################################################
 
 class VirtualSD:
     def __init__(self, config):
-        printer = config.get_printer()
+        self.printer = printer = config.get_printer()
         # sdcard state
         sd = config.get('path')
         self.sdcard_dirname = os.path.normpath(os.path.expanduser(sd))
         self.current_file = None
         self.file_position = self.file_size = 0
+        # Pre-parsed g-code cache
+        self.cache_dirname = config.get('cache_path', None)
+        if self.cache_dirname is not None:
+            self.cache_dirname = os.path.normpath(
+                os.path.expanduser(self.cache_dirname))
+        self.cache_filename = self.cache_key = self.cache_offset = None
         # Work timer
         self.reactor = printer.get_reactor()
         self.must_pause_work = False
         self.work_timer = None
+        self.toolhead = None
         # Register commands
         self.gcode = printer.lookup_object('gcode')
         self.gcode.register_command('M21', None)
@@ -25,6 +255,8 @@ class VirtualSD:
         for cmd in ['M28', 'M29', 'M30']:
             self.gcode.register_command(cmd, self.cmd_error)
     def printer_state(self, state):
+        if state == 'ready':
+            self.toolhead = self.printer.lookup_object('toolhead')
         if state == 'shutdown' and self.work_timer is not None:
             self.must_pause_work = True
             try:
@@ -77,6 +309,7 @@ class VirtualSD:
             self.current_file.close()
             self.current_file = None
             self.file_position = self.file_size = 0
+            self.cache_filename = self.cache_key = self.cache_offset = None
         try:
             orig = params['#original']
             filename = orig[orig.find("M23") + 4:].split()[0].strip()
@@ -103,6 +336,19 @@ class VirtualSD:
         self.current_file = f
         self.file_position = 0
         self.file_size = fsize
+        if self.cache_dirname is not None:
+            self.load_cache(fname)
+    def load_cache(self, fname):
+        self.cache_filename = get_cache_filename(self.cache_dirname, fname)
+        try:
+            self.cache_key = get_file_key(fname)
+        except:
+            logging.exception("virtual_sdcard cache key")
+            self.cache_filename = None
+            return
+        self.cache_offset = check_cache(self.cache_filename, self.cache_key)
+        logging.info("Virtual sdcard cache %s: %s", self.cache_filename,
+                     "valid" if self.cache_offset is not None else "missing")
     def cmd_M24(self, params):
         # Start/resume SD print
         if self.work_timer is not None:
@@ -128,43 +374,173 @@ class VirtualSD:
         self.gcode.respond("SD printing byte %d/%d" % (
             self.file_position, self.file_size))
     # Background work timer
+    YIELD_TIME = 0.100
+    READ_WAIT_TIME = 0.005
+    def batch_lines(self, lines):
+        # Feed lines to the gcode batch processor - the file position
+        # is advanced once a line has been successfully processed
+        while lines and not self.must_pause_work:
+            line = lines[-1]
+            yield line
+            lines.pop()
+            # The final line may not have a trailing newline
+            self.file_position = min(self.file_position + len(line) + 1,
+                                     self.file_size)
+            if self.gcode.has_pending_input():
+                # Let the gcode parser run commands from the input fd
+                return
+    def batch_entries(self, entries, lengths):
+        # Same as batch_lines() for entries from the g-code cache
+        while entries and not self.must_pause_work:
+            yield entries[-1]
+            entries.pop()
+            self.file_position += lengths.pop()
+            if self.gcode.has_pending_input():
+                return
+    def remove_cache(self):
+        # The cache is invalid - remove it so that it is rebuilt
+        self.cache_offset = None
+        try:
+            os.remove(self.cache_filename)
+        except OSError:
+            logging.exception("virtual_sdcard cache remove")
+    def reopen_file(self, reader):
+        # Continue reading from the g-code file (at the file position)
+        reader.stop()
+        try:
+            return FileReadAhead(self.current_file.name, self.file_position)
+        except:
+            logging.exception("virtual_sdcard seek")
+            self.gcode.respond_error("Unable to seek file")
+            return None
+    def open_reader(self):
+        # Returns the reader and (if the cache is being built) a writer
+        if self.cache_offset is not None:
+            return CacheReadAhead(self.cache_filename, self.cache_offset,
+                                  self.file_position), None
+        reader = FileReadAhead(self.current_file.name, self.file_position)
+        writer = None
+        if self.cache_filename is not None and not self.file_position:
+            # Build the cache while printing the file
+            try:
+                writer = CacheWriter(self.cache_filename, self.cache_key)
+            except:
+                logging.exception("virtual_sdcard cache create")
+        return reader, writer
     def work_handler(self, eventtime):
         logging.info("Starting SD card print (position %d)", self.file_position)
         self.reactor.unregister_timer(self.work_timer)
         try:
-            self.current_file.seek(self.file_position)
+            reader, writer = self.open_reader()
         except:
             logging.exception("virtual_sdcard seek")
             self.gcode.respond_error("Unable to seek file")
             self.work_timer = None
             return self.reactor.NEVER
+        is_cached = self.cache_offset is not None
         partial_input = ""
+        is_final = False
         lines = []
+        lengths = None
+        stall_count = self.toolhead.get_stall_count()
+        next_yield = eventtime + self.YIELD_TIME
         while not self.must_pause_work:
             if not lines:
                 # Read more data
-                try:
-                    data = self.current_file.read(8192)
-                except:
-                    logging.exception("virtual_sdcard read")
+                data = reader.get_data()
+                if data is None:
+                    # Wait for the background reader
+                    eventtime = self.reactor.pause(
+                        self.reactor.monotonic() + self.READ_WAIT_TIME)
+                    next_yield = eventtime + self.YIELD_TIME
+                    continue
+                if data:
+                    if is_cached:
+                        position, lengths, lines = data
+                    else:
+                        lines = data.split('\n')
+                        lines[0] = partial_input + lines[0]
+                        partial_input = lines.pop()
+                elif is_cached and (reader.is_corrupt
+                                    or self.file_position != self.file_size):
+                    # Corrupt or incomplete cache
+                    logging.info("Virtual sdcard cache %s invalid at"
+                                 " position %d - using g-code file",
+                                 self.cache_filename, self.file_position)
+                    self.remove_cache()
+                    new_reader = self.reopen_file(reader)
+                    if new_reader is None:
+                        break
+                    reader = new_reader
+                    is_cached = False
+                    lengths = None
+                    continue
+                elif reader.read_error:
                     self.gcode.respond_error("Error on virtual sdcard read")
                     break
-                if not data:
+                elif partial_input:
+                    # Final line without a trailing newline
+                    lines = [partial_input]
+                    partial_input = ""
+                    is_final = True
+                else:
                     # End of file
+                    if writer is not None:
+                        writer.finish()
+                        writer = None
                     self.current_file.close()
                     self.current_file = None
                     logging.info("Finished SD card print")
                     self.gcode.respond("Done printing file")
                     break
-                lines = data.split('\n')
-                lines[0] = partial_input + lines[0]
-                partial_input = lines.pop()
-                lines.reverse()
-                self.reactor.pause(self.reactor.NOW)
+                if is_cached:
+                    lines.reverse()
+                    lengths.reverse()
+                    # Skip to the current file position (after M26)
+                    while lengths and position < self.file_position:
+                        position += lengths.pop()
+                        lines.pop()
+                    if lines and position != self.file_position:
+                        logging.info("Virtual sdcard position %d not in"
+                                     " cache - using g-code file",
+                                     self.file_position)
+                        new_reader = self.reopen_file(reader)
+                        if new_reader is None:
+                            break
+                        reader = new_reader
+                        is_cached = False
+                        lines = []
+                        lengths = None
+                        continue
+                elif writer is not None:
+                    try:
+                        lines, lengths = writer.add_lines(lines, is_final)
+                    except:
+                        logging.exception("virtual_sdcard cache write")
+                        writer.abort()
+                        writer = lengths = None
+                    lines.reverse()
+                    if lengths is not None:
+                        lengths.reverse()
+                else:
+                    lines.reverse()
+                # The toolhead yields to the reactor when the move queue
+                # is full - only yield here if that has not happened
+                eventtime = self.reactor.monotonic()
+                if self.toolhead.get_stall_count() != stall_count:
+                    stall_count = self.toolhead.get_stall_count()
+                    next_yield = eventtime + self.YIELD_TIME
+                elif eventtime >= next_yield:
+                    eventtime = self.reactor.pause(self.reactor.NOW)
+                    next_yield = eventtime + self.YIELD_TIME
                 continue
-            # Dispatch command
+            # Dispatch commands
+            if lengths is None:
+                batch = self.batch_lines(lines)
+            else:
+                batch = self.batch_entries(lines, lengths)
             try:
-                res = self.gcode.process_batch(lines[-1])
+                res = self.gcode.process_batch(batch)
                 if not res:
                     self.reactor.pause(self.reactor.monotonic() + 0.100)
                     continue
@@ -173,7 +549,10 @@ class VirtualSD:
             except:
                 logging.exception("virtual_sdcard dispatch")
                 break
-            self.file_position += len(lines.pop()) + 1
+        reader.stop()
+        if writer is not None:
+            # The cache is only stored for complete prints
+            writer.abort()
         logging.info("Exiting SD card print (position %d)", self.file_position)
         self.work_timer = None
         return self.reactor.NEVER
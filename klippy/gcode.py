@@ -10,6 +10,27 @@ from .kinematics import extruder
 class error(Exception):
     pass
 
+# Tokenize a plain G0/G1 move into its X, Y, Z, E, F arguments - returns
+# None if the line is not a simple move
+def tokenize_move(line):
+    parts = line.split()
+    cmd = parts[0]
+    if cmd != 'G1' and cmd != 'G0':
+        return None
+    args = [None, None, None, None, None]
+    for part in parts[1:]:
+        if part[0] == ';':
+            break
+        pos = 'XYZEF'.find(part[0])
+        value = part[1:]
+        if pos < 0 or value.lstrip('-+').strip('0123456789.'):
+            return None
+        try:
+            args[pos] = float(value)
+        except ValueError as e:
+            return None
+    return args
+
 # Parse and handle G-Code commands
 class GCodeParser:
     error = error
@@ -24,6 +45,7 @@ class GCodeParser:
         self.fd_handle = None
         if not self.is_fileinput:
             self.fd_handle = self.reactor.register_fd(self.fd, self.process_data)
+        self.is_input_paused = False
         self.partial_input = ""
         self.pending_commands = []
         self.bytes_read = 0
@@ -41,6 +63,7 @@ class GCodeParser:
             self.register_command(cmd, func, wnr, desc)
             for a in getattr(self, 'cmd_' + cmd + '_aliases', []):
                 self.register_command(a, func, wnr)
+        self.move_handler = self.ready_gcode_handlers['G1']
         # G-Code coordinate manipulation
         self.absolutecoord = self.absoluteextrude = True
         self.base_position = [0.0, 0.0, 0.0, 0.0]
@@ -163,28 +186,50 @@ class GCodeParser:
         logging.info("\n".join(out))
     # Parse input into commands
     args_r = re.compile('([A-Z_]+|[A-Z*/])')
+    def parse_move(self, line):
+        # Fast path for plain G0/G1 moves - returns None if the line
+        # needs the full parser
+        args = tokenize_move(line)
+        if args is None or self.gcode_handlers.get(
+                line[:2]) is not self.move_handler:
+            return None
+        return args, line
     def process_commands(self, commands, need_ack=True):
         for line in commands:
-            # Ignore comments and leading/trailing spaces
-            line = origline = line.strip()
-            cpos = line.find(';')
-            if cpos >= 0:
-                line = line[:cpos]
-            # Break command into parts
-            parts = self.args_r.split(line.upper())[1:]
-            params = { parts[i]: parts[i+1].strip()
-                       for i in range(0, len(parts), 2) }
-            params['#original'] = origline
-            if parts and parts[0] == 'N':
-                # Skip line number at start of command
-                del parts[:2]
-            if not parts:
-                # Treat empty line as empty command
-                parts = ['', '']
-            params['#command'] = cmd = parts[0] + parts[1].strip()
+            params = None
+            if line.__class__ is tuple:
+                # Move tokenized in advance (eg, from a g-code cache)
+                params = line
+                line = origline = params[1]
+                if self.gcode_handlers.get(line[:2]) is not self.move_handler:
+                    params = None
+            else:
+                # Ignore comments and leading/trailing spaces
+                line = origline = line.strip()
+                if line[:1] == 'G':
+                    params = self.parse_move(line)
+            if params is not None:
+                cmd = line[:2]
+                handler = self.move_fast
+            else:
+                cpos = line.find(';')
+                if cpos >= 0:
+                    line = line[:cpos]
+                # Break command into parts
+                parts = self.args_r.split(line.upper())[1:]
+                params = { parts[i]: parts[i+1].strip()
+                           for i in range(0, len(parts), 2) }
+                params['#original'] = origline
+                if parts and parts[0] == 'N':
+                    # Skip line number at start of command
+                    del parts[:2]
+                if not parts:
+                    # Treat empty line as empty command
+                    parts = ['', '']
+                params['#command'] = cmd = parts[0] + parts[1].strip()
+                handler = self.gcode_handlers.get(cmd, self.cmd_default)
             # Invoke handler for command
             self.need_ack = need_ack
-            handler = self.gcode_handlers.get(cmd, self.cmd_default)
             try:
                 handler(params)
             except error as e:
@@ -230,8 +275,8 @@ class GCodeParser:
             if self.is_processing_data:
                 if len(pending_commands) >= 20:
                     # Stop reading input
-                    self.reactor.unregister_fd(self.fd_handle)
-                    self.fd_handle = None
+                    self.reactor.set_fd_wake(self.fd_handle, False)
+                    self.is_input_paused = True
                 return
         # Process commands
         self.is_processing_data = True
@@ -246,19 +291,25 @@ class GCodeParser:
             self.pending_commands = []
             self.process_commands(pending_commands)
             pending_commands = self.pending_commands
-        if self.fd_handle is None:
-            self.fd_handle = self.reactor.register_fd(self.fd, self.process_data)
-    def process_batch(self, command):
+        if self.is_input_paused:
+            self.reactor.set_fd_wake(self.fd_handle, True)
+            self.is_input_paused = False
+    def process_batch(self, commands):
+        # Run a list (or iterator) of commands from a batch source.  An
+        # iterator may stop early when has_pending_input() reports that
+        # commands arrived on the input fd - these are run on return.
         if self.is_processing_data:
             return False
         self.is_processing_data = True
         try:
-            self.process_commands([command], need_ack=False)
+            self.process_commands(commands, need_ack=False)
         finally:
             if self.pending_commands:
                 self.process_pending()
             self.is_processing_data = False
         return True
+    def has_pending_input(self):
+        return not not self.pending_commands
     def run_script_from_command(self, script):
         prev_need_ack = self.need_ack
         try:
@@ -270,7 +321,7 @@ class GCodeParser:
         for line in script.split('\n'):
             while 1:
                 try:
-                    res = self.process_batch(line)
+                    res = self.process_batch([line])
                 except:
                     break
                 if res:
@@ -470,31 +521,38 @@ class GCodeParser:
     def cmd_G1(self, params):
         # Move
         try:
-            for axis in 'XYZ':
-                if axis in params:
-                    v = float(params[axis])
-                    pos = self.axis2pos[axis]
-                    if not self.absolutecoord:
-                        # value relative to position of last move
-                        self.last_position[pos] += v
-                    else:
-                        # value relative to base coordinate position
-                        self.last_position[pos] = v + self.base_position[pos]
-            if 'E' in params:
-                v = float(params['E']) * self.extrude_factor
-                if not self.absolutecoord or not self.absoluteextrude:
+            args = [float(params[axis]) if axis in params else None
+                    for axis in 'XYZEF']
+        except ValueError as e:
+            raise error("Unable to parse move '%s'" % (params['#original'],))
+        self.do_move(args, params['#original'])
+    def move_fast(self, params):
+        # Move already tokenized by parse_move()
+        args, origline = params
+        self.do_move(args, origline)
+    def do_move(self, args, origline):
+        x, y, z, e, f = args
+        for pos, v in ((0, x), (1, y), (2, z)):
+            if v is not None:
+                if not self.absolutecoord:
                     # value relative to position of last move
-                    self.last_position[3] += v
+                    self.last_position[pos] += v
                 else:
                     # value relative to base coordinate position
-                    self.last_position[3] = v + self.base_position[3]
-            if 'F' in params:
-                speed = float(params['F']) * self.speed_factor
-                if speed <= 0.:
-                    raise error("Invalid speed in '%s'" % (params['#original'],))
-                self.speed = speed
-        except ValueError as e:
-            raise error("Unable to parse move '%s'" % (params['#original'],))
+                    self.last_position[pos] = v + self.base_position[pos]
+        if e is not None:
+            v = e * self.extrude_factor
+            if not self.absolutecoord or not self.absoluteextrude:
+                # value relative to position of last move
+                self.last_position[3] += v
+            else:
+                # value relative to base coordinate position
+                self.last_position[3] = v + self.base_position[3]
+        if f is not None:
+            speed = f * self.speed_factor
+            if speed <= 0.:
+                raise error("Invalid speed in '%s'" % (origline,))
+            self.speed = speed
         try:
             self.move_with_transform(self.last_position, self.speed)
         except homing.EndstopError as e:
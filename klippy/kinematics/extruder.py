@@ -4,7 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import math, logging
-from .. import stepper, homing, chelper
+from .. import stepper, homing
 
 EXTRUDE_DIFF_IGNORE = 1.02
 
@@ -48,9 +48,9 @@ class PrinterExtruder:
         self.need_motor_enable = True
         self.extrude_pos = 0.
         # Setup iterative solver
-        ffi_main, ffi_lib = chelper.get_ffi()
-        self.cmove = ffi_main.gc(ffi_lib.move_alloc(), ffi_lib.free)
-        self.extruder_move_fill = ffi_lib.extruder_move_fill
+        move_batch = toolhead.get_move_batch()
+        self.cmove = move_batch.alloc_move()
+        self.extruder_move_fill = move_batch.extruder_move_fill
         self.stepper.setup_itersolve('extruder_stepper_alloc')
         # Setup SET_PRESSURE_ADVANCE command
         gcode = self.printer.lookup_object('gcode')
@@ -71,6 +71,8 @@ class PrinterExtruder:
         return self.deactivate_gcode
     def stats(self, eventtime):
         return self.heater.stats(eventtime)
+    def get_status(self, eventtime):
+        return self.heater.get_status(eventtime)
     def motor_off(self, print_time):
         self.stepper.motor_enable(print_time, 0)
         self.need_motor_enable = True
@@ -16,6 +16,7 @@ class MCU_stepper:
         self._mcu = mcu
         self._oid = oid = self._mcu.create_oid()
         self._mcu.register_config_callback(self._build_config)
+        self._name = "stepper%d" % (oid,)
         self._step_pin = pin_params['pin']
         self._invert_step = pin_params['invert']
         self._dir_pin = self._invert_dir = None
@@ -23,14 +24,22 @@ class MCU_stepper:
         self._step_dist = 0.
         self._min_stop_interval = 0.
         self._reset_cmd_id = self._get_position_cmd = None
-        ffi_main, self._ffi_lib = chelper.get_ffi()
-        self._stepqueue = ffi_main.gc(self._ffi_lib.stepcompress_alloc(oid),
-                                      self._ffi_lib.stepcompress_free)
+        self._ffi_main, self._ffi_lib = chelper.get_ffi()
+        self._stepqueue = self._ffi_main.gc(
+            self._ffi_lib.stepcompress_alloc(oid),
+            self._ffi_lib.stepcompress_free)
         self._mcu.register_stepqueue(self._stepqueue)
+        self._mcu.register_stepper(self)
         self._stepper_kinematics = self._itersolve_gen_steps = None
+        self._gen_steps = self._ffi_lib.itersolve_gen_steps
+        self._analytic_solver = False
         self.set_ignore_move(False)
     def get_mcu(self):
         return self._mcu
+    def get_name(self):
+        return self._name
+    def setup_name(self, name):
+        self._name = name
     def setup_dir_pin(self, pin_params):
         if pin_params['chip'] is not self._mcu:
             raise pins.error("Stepper dir pin must be on same mcu as step pin")
@@ -92,15 +101,28 @@ class MCU_stepper:
         self._stepper_kinematics = sk
         self._ffi_lib.itersolve_set_stepcompress(
             sk, self._stepqueue, self._step_dist)
+        self._ffi_lib.itersolve_set_analytic(sk, self._analytic_solver)
         return old_sk
+    def set_analytic_solver(self, analytic_solver):
+        # Calculate step times directly on linear kinematics (the
+        # iterative solver is still used on other kinematics)
+        self._analytic_solver = analytic_solver
+        if self._stepper_kinematics is not None:
+            self._ffi_lib.itersolve_set_analytic(
+                self._stepper_kinematics, analytic_solver)
     def set_ignore_move(self, ignore_move):
-        was_ignore = (self._itersolve_gen_steps
-                      is not self._ffi_lib.itersolve_gen_steps)
+        was_ignore = self._itersolve_gen_steps is not self._gen_steps
         if ignore_move:
             self._itersolve_gen_steps = (lambda *args: 0)
         else:
-            self._itersolve_gen_steps = self._ffi_lib.itersolve_gen_steps
+            self._itersolve_gen_steps = self._gen_steps
         return was_ignore
+    def set_move_batch(self, move_batch):
+        # Queue the steps of toolhead moves in a batch that is generated
+        # with a single call to the C helper (see toolhead.MoveBatch)
+        was_ignore = self.set_ignore_move(False)
+        self._gen_steps = move_batch.gen_steps
+        self.set_ignore_move(was_ignore)
     def note_homing_start(self, homing_clock):
         ret = self._ffi_lib.stepcompress_set_homing(
             self._stepqueue, homing_clock)
@@ -131,6 +153,14 @@ class MCU_stepper:
         ret = self._itersolve_gen_steps(self._stepper_kinematics, cmove)
         if ret:
             raise error("Internal error in stepcompress")
+    def get_stats(self):
+        # Steps generated, queue_step commands, and the current and
+        # average allowed step compression error (in seconds)
+        sbuf = self._ffi_main.new('char[256]')
+        self._ffi_lib.stepcompress_get_stats(self._stepqueue, sbuf, len(sbuf))
+        stats = self._ffi_main.string(sbuf).decode()
+        return dict([(k, float(v)) for k, v in [
+            s.split('=', 1) for s in stats.split()]])
 
 class MCU_endstop:
     class TimeoutError(Exception):
@@ -403,7 +433,7 @@ class MCU_adc:
                 self._report_clock, min_sample, max_sample,
                 self._range_check_count), is_init=True)
         self._mcu.register_msg(self._handle_analog_in_state, "analog_in_state"
-                               , self._oid)
+                               , self._oid, batch=True)
     def _handle_analog_in_state(self, params):
         last_value = params['value'] * self._inv_max_adc
         next_clock = self._mcu.clock32_to_clock64(params['next_clock'])
@@ -412,6 +442,9 @@ class MCU_adc:
         if self._callback is not None:
             self._callback(last_read_time, last_value)
 
+# Encoded config and init commands of each mcu (kept across restarts)
+encoded_commands_cache = {}
+
 class MCU:
     error = error
     def __init__(self, config, clocksync):
@@ -428,7 +461,9 @@ class MCU:
                 or self._serialport.startswith("/tmp/klipper_host_")):
             baud = config.getint('baud', 250000, minval=2400)
         self._serial = serialhdl.SerialReader(
-            self._reactor, self._serialport, baud)
+            self._reactor, self._serialport, baud,
+            config.get('dictionary_cache', None))
+        self._batch_responses = config.getboolean('batch_responses', False)
         # Restarts
         self._restart_method = 'command'
         if baud:
@@ -449,12 +484,23 @@ class MCU:
         self._custom = config.get('custom', '')
         self._mcu_freq = 0.
         # Move command queuing
-        ffi_main, self._ffi_lib = chelper.get_ffi()
+        self._ffi_main, self._ffi_lib = chelper.get_ffi()
+        self._stats_buf = self._ffi_main.new('char[4096]')
         self._max_stepper_error = config.getfloat(
             'max_stepper_error', 0.000025, minval=0.)
+        self._baud = baud
+        self._adaptive_stepper_error = 0.
+        self._adaptive_backlog_time = 0.
+        if baud:
+            self._adaptive_stepper_error = config.getfloat(
+                'adaptive_stepper_error', 0., minval=self._max_stepper_error)
+            self._adaptive_backlog_time = config.getfloat(
+                'adaptive_backlog_time', .100, above=0.)
         self._move_count = 0
         self._stepqueues = []
+        self._steppers = []
         self._steppersync = None
+        self._thread_pool = None
         # Stats
         self._stats_sumsq_base = 0.
         self._mcu_tick_avg = 0.
@@ -543,14 +589,27 @@ class MCU:
         if prev_crc is None:
             logging.info("Sending MCU '%s' printer configuration...",
                          self._name)
-            for c in self._config_cmds:
-                self._serial.send(c)
+            self._serial.send_encoded(
+                self._encode_commands('config', self._config_cmds))
         elif config_crc != prev_crc:
             self._check_restart("CRC mismatch")
             raise error("MCU '%s' CRC does not match config" % (self._name,))
         # Transmit init messages
-        for c in self._init_cmds:
-            self._serial.send(c)
+        self._serial.send_encoded(
+            self._encode_commands('init', self._init_cmds))
+    def _encode_commands(self, cmd_type, cmds):
+        # Reuse the commands encoded before a restart if neither the
+        # commands nor the data dictionary have changed
+        identify_data = self._serial.msgparser.raw_identify_data
+        cmds_text = '\n'.join(cmds)
+        key = (self._name, cmd_type)
+        cached = encoded_commands_cache.get(key)
+        if (cached is not None and cached[0] == cmds_text
+            and cached[1] == identify_data):
+            return cached[2]
+        encoded = self._serial.encode_commands(cmds)
+        encoded_commands_cache[key] = (cmds_text, identify_data, encoded)
+        return encoded
     def _send_get_config(self):
         get_config_cmd = self.lookup_command("get_config")
         if self.is_fileoutput():
@@ -588,16 +647,32 @@ class MCU:
             self._move_count)
         self._ffi_lib.steppersync_set_time(
             self._steppersync, 0., self._mcu_freq)
-    def _connect(self):
+        if self._thread_pool is not None:
+            self._ffi_lib.steppersync_set_thread_pool(
+                self._steppersync, self._thread_pool)
+        if self._adaptive_stepper_error:
+            # Widen the step compression error when the serial link
+            # can not keep up (each byte is sent as 10 bits)
+            link_rate = self._baud / 10.
+            self._ffi_lib.steppersync_set_adaptive_error(
+                self._steppersync,
+                self.seconds_to_clock(self._adaptive_stepper_error),
+                link_rate / self._mcu_freq,
+                link_rate * self._adaptive_backlog_time)
+    def connect(self):
+        start_time = self._reactor.monotonic()
         if self.is_fileoutput():
             self._connect_file()
+            identify_time = clocksync_time = self._reactor.monotonic()
         else:
             if (self._restart_method == 'rpi_usb'
                 and not os.path.exists(self._serialport)):
                 # Try toggling usb power
                 self._check_restart("enable power")
             self._serial.connect()
+            identify_time = self._reactor.monotonic()
             self._clocksync.connect(self._serial)
+            clocksync_time = self._reactor.monotonic()
         msgparser = self._serial.msgparser
         name = self._name
         log_info = [
@@ -621,10 +696,20 @@ class MCU:
         self.register_msg(self._handle_shutdown, 'is_shutdown')
         self.register_msg(self._handle_mcu_stats, 'stats')
         self._check_config()
+        end_time = self._reactor.monotonic()
         move_msg = "Configured MCU '%s' (%d moves)" % (name, self._move_count)
         logging.info(move_msg)
+        logging.info("MCU '%s' startup time %.3fs: identify=%.3fs (%s)"
+                     " clocksync=%.3fs config=%.3fs", name,
+                     end_time - start_time, identify_time - start_time,
+                     self._serial.identify_cached and "cached" or "downloaded",
+                     clocksync_time - identify_time, end_time - clocksync_time)
         log_info.append(move_msg)
         self._printer.set_rollover_info(name, "\n".join(log_info), log=False)
+    def abort_connect(self):
+        # Stop a connect() that is in progress
+        self._serial.abort_connect()
+        self._clocksync.abort_connect()
     # Config creation helpers
     def setup_pin(self, pin_type, pin_params):
         pcs = {'stepper': MCU_stepper, 'endstop': MCU_endstop,
@@ -648,13 +733,31 @@ class MCU:
         return self.print_time_to_clock(t) + slot
     def register_stepqueue(self, stepqueue):
         self._stepqueues.append(stepqueue)
+    def register_stepper(self, stepper):
+        self._steppers.append(stepper)
+    def set_move_batch(self, move_batch):
+        for stepper in self._steppers:
+            stepper.set_move_batch(move_batch)
+    def set_analytic_solver(self, analytic_solver):
+        for stepper in self._steppers:
+            stepper.set_analytic_solver(analytic_solver)
+    def set_thread_pool(self, thread_pool):
+        # Compress the steps of each stepper in parallel on the threads
+        # of the given pool
+        self._thread_pool = thread_pool
+        if self._steppersync is not None:
+            self._ffi_lib.steppersync_set_thread_pool(
+                self._steppersync, thread_pool)
     def seconds_to_clock(self, time):
         return int(time * self._mcu_freq)
     def get_max_stepper_error(self):
         return self._max_stepper_error
     # Wrapper functions
-    def register_msg(self, cb, msg, oid=None):
-        self._serial.register_callback(cb, msg, oid)
+    def register_msg(self, cb, msg, oid=None, batch=False):
+        # High rate responses may optionally be processed in batches
+        # by the reactor (instead of in the serial background thread)
+        self._serial.register_callback(cb, msg, oid,
+                                       batch and self._batch_responses)
     def alloc_command_queue(self):
         return self._serial.alloc_command_queue()
     def lookup_command(self, msgformat, cq=None):
@@ -734,6 +837,12 @@ class MCU:
         return self._printer.get_start_args().get('debugoutput') is not None
     def is_shutdown(self):
         return self._is_shutdown
+    def get_steppersync(self):
+        # Return the steppersync and the clock adjustment used by
+        # flush_moves() to convert a print time to a clock
+        if self._steppersync is None:
+            return None
+        return self._steppersync, self._clocksync.get_clock_adj()
     def flush_moves(self, print_time):
         if self._steppersync is None:
             return
@@ -762,11 +871,26 @@ class MCU:
             self._name, self._mcu_tick_awake, self._mcu_tick_avg,
             self._mcu_tick_stddev)
         return False, ' '.join([msg, self._serial.stats(eventtime),
-                                self._clocksync.stats(eventtime)])
+                                self._clocksync.stats(eventtime),
+                                self.step_stats()])
+    def step_stats(self):
+        # Steps generated, queue_step commands, and time spent in step
+        # compression and in ordering the commands for transmit
+        if self._steppersync is None:
+            return ""
+        self._ffi_lib.steppersync_get_stats(
+            self._steppersync, self._stats_buf, len(self._stats_buf))
+        out = [self._ffi_main.string(self._stats_buf).decode()]
+        if self._adaptive_stepper_error:
+            # Report the allowed step compression error of each stepper
+            for stepper in self._steppers:
+                stats = stepper.get_stats()
+                out.append("%s_max_error=%.9f %s_avg_max_error=%.9f" % (
+                    stepper.get_name(), stats['max_error'],
+                    stepper.get_name(), stats['avg_max_error']))
+        return ' '.join(out)
     def printer_state(self, state):
-        if state == 'connect':
-            self._connect()
-        elif state == 'disconnect':
+        if state == 'disconnect':
             self._disconnect()
         elif state == 'shutdown':
             self._shutdown()
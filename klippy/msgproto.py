@@ -3,7 +3,7 @@
 # Copyright (C) 2016,2017  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import json, zlib, logging
+import json, zlib, logging, threading
 
 DefaultMessages = {
     0: "identify_response offset=%u data=%.*s",
@@ -22,6 +22,7 @@ MESSAGE_PAYLOAD_MAX = MESSAGE_MAX - MESSAGE_MIN
 MESSAGE_SEQ_MASK = 0x0f
 MESSAGE_DEST = 0x10
 MESSAGE_SYNC = '\x7E'
+COMMAND_CACHE_SIZE = 256
 
 class error(Exception):
     pass
@@ -40,6 +41,7 @@ class PT_uint32:
     is_int = 1
     max_length = 5
     signed = 0
+    native_type = 0 # MB_PT_UINT32
     def encode(self, out, v):
         if v >= 0xc000000 or v < -0x4000000: out.append((v>>28) & 0x7f | 0x80)
         if v >= 0x180000 or v < -0x80000:    out.append((v>>21) & 0x7f | 0x80)
@@ -62,6 +64,7 @@ class PT_uint32:
 
 class PT_int32(PT_uint32):
     signed = 1
+    native_type = 1 # MB_PT_INT32
 class PT_uint16(PT_uint32):
     max_length = 3
 class PT_int16(PT_int32):
@@ -73,6 +76,7 @@ class PT_byte(PT_uint32):
 class PT_string:
     is_int = 0
     max_length = 64
+    native_type = 2 # MB_PT_BUFFER
     def encode(self, out, v):
         out.append(len(v))
         out.extend(bytearray(v))
@@ -91,6 +95,118 @@ MessageTypes = {
     '%s': PT_string(), '%.*s': PT_progmem_buffer(), '%*s': PT_buffer(),
 }
 
+# Message encoding and decoding using the C helper code (see
+# chelper/msgblock.c).  The python code above remains the reference
+# implementation and is used when the C helper is not available.
+class NativeCodec:
+    def __init__(self):
+        from . import chelper
+        self.ffi_main, ffi_lib = chelper.get_ffi()
+        self.crc16 = ffi_lib.msgblock_crc16_ccitt
+        self.encode_params = ffi_lib.msgblock_encode_params
+        self.decode_params = ffi_lib.msgblock_decode_params
+        # Messages are decoded in the serial background thread and
+        # occasionally in the main thread
+        self.thread_data = threading.local()
+    def crc16_ccitt(self, buf):
+        if not isinstance(buf, bytes) or len(buf) > 0xff:
+            return crc16_ccitt(buf)
+        crc = self.crc16(buf, len(buf))
+        return chr(crc >> 8) + chr(crc & 0xff)
+    def encode(self, data):
+        # Returns the bytes serialqueue_send_params() would send
+        out = self.ffi_main.new('uint8_t[]', 5 * len(data))
+        count = self.encode_params(out, data, len(data))
+        return self.ffi_main.unpack(out, count)
+    def decode(self, buf, length, pos, types):
+        # The returned values are only valid until the next call to
+        # decode() from the same thread
+        try:
+            out = self.thread_data.out
+        except AttributeError:
+            out = self.thread_data.out = self.ffi_main.new(
+                'int64_t[]', MESSAGE_PAYLOAD_MAX)
+        count = len(types)
+        pos = self.decode_params(buf, length, pos, types, count, out)
+        if pos < 0:
+            return None, pos
+        return out[0:count], pos
+
+native_codec = None
+
+def get_native_codec():
+    global native_codec
+    if native_codec is None:
+        try:
+            native_codec = NativeCodec()
+        except (ImportError, OSError, AttributeError) as e:
+            logging.warning("Using python message codec: %s", e)
+            native_codec = False
+    return native_codec or None
+
+# Generate python code specialized for a given message format.  The
+# generated functions produce the same results as the generic
+# MessageFormat.encode() and MessageFormat.parse() methods, but avoid
+# the per parameter loop and method calls.
+def _gen_encode_param(code, t, value):
+    code.append("    v = %s" % (value,))
+    if not t.is_int:
+        code.append("    append(len(v))")
+        code.append("    out.extend(bytearray(v))")
+        return
+    code.append("    if v >= 0x60 or v < -0x20:")
+    for limit, neg, shift in [(0xc000000, 0x4000000, 28),
+                              (0x180000, 0x80000, 21), (0x3000, 0x1000, 14)]:
+        code.append("        if v >= %#x or v < -%#x:"
+                    " append((v>>%d) & 0x7f | 0x80)" % (limit, neg, shift))
+    code.append("        append((v>>7) & 0x7f | 0x80)")
+    code.append("    append(v & 0x7f)")
+
+def _gen_parse_param(code, t, var):
+    if not t.is_int:
+        code.append("    l = s[pos]")
+        code.append("    %s = str(bytearray(s[pos+1:pos+l+1]))" % (var,))
+        code.append("    pos += l+1")
+        return
+    code.append("    c = s[pos]")
+    code.append("    pos += 1")
+    code.append("    %s = c & 0x7f" % (var,))
+    code.append("    if c >= 0x60:")
+    code.append("        if (c & 0x60) == 0x60:")
+    code.append("            %s |= -0x20" % (var,))
+    code.append("        while c & 0x80:")
+    code.append("            c = s[pos]")
+    code.append("            pos += 1")
+    code.append("            %s = (%s<<7) | (c & 0x7f)" % (var, var))
+    if not t.signed:
+        code.append("        %s &= 0xffffffff" % (var,))
+
+def compile_message_format(msgid, msgname, param_names):
+    code = ["def encode(params):",
+            "    out = [%d]" % (msgid,),
+            "    append = out.append"]
+    for i, (name, t) in enumerate(param_names):
+        _gen_encode_param(code, t, "params[%d]" % (i,))
+    code.append("    return out")
+    code += ["def encode_by_name(**params):",
+             "    out = [%d]" % (msgid,),
+             "    append = out.append"]
+    for name, t in param_names:
+        _gen_encode_param(code, t, "params[%r]" % (str(name),))
+    code.append("    return out")
+    code += ["def parse(s, pos):", "    pos += 1"]
+    pvars = ["p%d" % (i,) for i in range(len(param_names))]
+    for var, (name, t) in zip(pvars, param_names):
+        _gen_parse_param(code, t, var)
+    code.append("    return {%s}, pos" % (", ".join([
+        "%r: %s" % (str(name), var)
+        for var, (name, t) in zip(pvars, param_names)]),))
+    namespace = {}
+    exec(compile('\n'.join(code) + '\n',
+                 '<msgproto %s>' % (msgname,), 'exec'), namespace)
+    return (namespace['encode'], namespace['encode_by_name'],
+            namespace['parse'])
+
 # Update the message format to be compatible with python's % operator
 def convert_msg_format(msgformat):
     mf = msgformat.replace('%c', '%u')
@@ -98,7 +214,7 @@ def convert_msg_format(msgformat):
     return mf
 
 class MessageFormat:
-    def __init__(self, msgid, msgformat):
+    def __init__(self, msgid, msgformat, codec=None, compiled=False):
         self.msgid = msgid
         self.msgformat = msgformat
         self.debugformat = convert_msg_format(msgformat)
@@ -108,6 +224,23 @@ class MessageFormat:
         self.param_types = [MessageTypes[fmt] for name, fmt in argparts]
         self.param_names = [(name, MessageTypes[fmt]) for name, fmt in argparts]
         self.name_to_type = dict(self.param_names)
+        # Native decoding
+        self.codec = codec
+        self.native_names = [name for name, fmt in argparts]
+        self.native_types = bytes(bytearray(
+            [t.native_type for t in self.param_types]))
+        self.native_buffers = [(name, t) for name, t in self.param_names
+                               if not t.is_int]
+        if compiled:
+            # Replace the generic encode and parse methods
+            self.encode, self.encode_by_name, self.parse = (
+                compile_message_format(msgid, self.name, self.param_names))
+        # The overhead of calling the C code is only recovered on
+        # messages with several integer parameters (and the generated
+        # python parser is faster still)
+        self.use_native_parse = (codec is not None and not compiled
+                                 and not self.native_buffers
+                                 and len(self.param_types) > 1)
     def encode(self, params):
         out = []
         out.append(self.msgid)
@@ -127,6 +260,18 @@ class MessageFormat:
             v, pos = t.parse(s, pos)
             out[name] = v
         return out, pos
+    def parse_cdata(self, buf, length, pos):
+        values, npos = self.codec.decode(buf, length, pos + 1,
+                                         self.native_types)
+        if values is None:
+            # Truncated or invalid data - use python code to report it
+            return self.parse(buf[0:length], pos)
+        out = dict(zip(self.native_names, values))
+        if self.native_buffers:
+            s = buf[0:length]
+            for name, t in self.native_buffers:
+                out[name] = t.parse(s, out[name])[0]
+        return out, npos
     def format_params(self, params):
         out = []
         for name, t in self.param_names:
@@ -181,11 +326,20 @@ class UnknownFormat:
 
 class MessageParser:
     error = error
-    def __init__(self):
+    def __init__(self, use_native=True, use_compiled=True):
+        self.use_compiled = use_compiled
+        self.codec = None
+        self.crc16_ccitt = crc16_ccitt
+        if use_native:
+            self.codec = get_native_codec()
+            if self.codec is not None:
+                self.crc16_ccitt = self.codec.crc16_ccitt
         self.unknown = UnknownFormat()
         self.command_ids = []
         self.messages_by_id = {}
         self.messages_by_name = {}
+        self.native_messages = {}
+        self.command_cache = {}
         self.static_strings = {}
         self.config = {}
         self.version = self.build_versions = ""
@@ -206,7 +360,7 @@ class MessageParser:
         if s[msglen-MESSAGE_TRAILER_SYNC] != MESSAGE_SYNC:
             return -1
         msgcrc = s[msglen-MESSAGE_TRAILER_CRC:msglen-MESSAGE_TRAILER_CRC+2]
-        crc = crc16_ccitt(s[:msglen-MESSAGE_TRAILER_SIZE])
+        crc = self.crc16_ccitt(s[:msglen-MESSAGE_TRAILER_SIZE])
         if crc != msgcrc:
             #logging.debug("got crc %s vs %s", repr(crc), repr(msgcrc))
             return -1
@@ -236,7 +390,24 @@ class MessageParser:
         msgid = s[MESSAGE_HEADER_SIZE]
         mid = self.messages_by_id.get(msgid, self.unknown)
         params, pos = mid.parse(s, MESSAGE_HEADER_SIZE)
-        if pos != len(s)-MESSAGE_TRAILER_SIZE:
+        return self._finish_parse(mid, params, pos, len(s))
+    def parse_cdata(self, buf, length):
+        # Parse a message block stored in a C buffer - the message is
+        # decoded from the buffer itself (without copying it)
+        msgid = buf[MESSAGE_HEADER_SIZE]
+        mid = self.native_messages.get(msgid)
+        if mid is not None:
+            params, pos = mid.parse_cdata(buf, length, MESSAGE_HEADER_SIZE)
+            return self._finish_parse(mid, params, pos, length)
+        mid = self.messages_by_id.get(msgid)
+        if mid is None:
+            return self.parse(buf[0:length])
+        # Reading past the end of the message is caught by the final
+        # position check in _finish_parse()
+        params, pos = mid.parse(buf, MESSAGE_HEADER_SIZE)
+        return self._finish_parse(mid, params, pos, length)
+    def _finish_parse(self, mid, params, pos, length):
+        if pos != length-MESSAGE_TRAILER_SIZE:
             raise error("Extra data at end of message")
         params['#name'] = mid.name
         static_string_id = params.get('static_string_id')
@@ -247,7 +418,7 @@ class MessageParser:
         msglen = MESSAGE_MIN + len(cmd)
         seq = (seq & MESSAGE_SEQ_MASK) | MESSAGE_DEST
         out = [chr(msglen), chr(seq), cmd]
-        out.append(crc16_ccitt(''.join(out)))
+        out.append(self.crc16_ccitt(''.join(out)))
         out.append(MESSAGE_SYNC)
         return ''.join(out)
     def _parse_buffer(self, value):
@@ -271,6 +442,17 @@ class MessageParser:
                 msgformat, mp.msgformat))
         return mp
     def create_command(self, msg):
+        # Commands sent as text (eg, config commands) are often repeated
+        cmd = self.command_cache.get(msg)
+        if cmd is not None:
+            return list(cmd)
+        cmd = self._create_command(msg)
+        if cmd:
+            if len(self.command_cache) >= COMMAND_CACHE_SIZE:
+                self.command_cache.clear()
+            self.command_cache[msg] = list(cmd)
+        return cmd
+    def _create_command(self, msg):
         parts = msg.strip().split()
         if not parts:
             return ""
@@ -297,20 +479,32 @@ class MessageParser:
             raise error("Unable to encode: %s" % (msgname,))
         return cmd
     def _init_messages(self, messages, parsers):
+        self.command_cache.clear()
         for msgid, msgformat in messages.items():
             msgid = int(msgid)
+            self.native_messages.pop(msgid, None)
             if msgid not in parsers:
                 self.messages_by_id[msgid] = OutputFormat(msgid, msgformat)
                 continue
-            msg = MessageFormat(msgid, msgformat)
+            msg = MessageFormat(msgid, msgformat, self.codec,
+                                self.use_compiled)
             self.messages_by_id[msgid] = msg
             self.messages_by_name[msg.name] = msg
+            if msg.use_native_parse:
+                self.native_messages[msgid] = msg
     def process_identify(self, data, decompress=True):
         try:
             if decompress:
                 data = zlib.decompress(data)
             self.raw_identify_data = data
             data = json.loads(data)
+        except Exception as e:
+            logging.exception("process_identify error")
+            raise error("Error during identify: %s" % (str(e),))
+        self.load_identify(data)
+    def load_identify(self, data):
+        # Load the message definitions of a decoded data dictionary
+        try:
             messages = data.get('messages')
             commands = data.get('commands')
             self.command_ids = commands
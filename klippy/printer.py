@@ -1,4 +1,5 @@
 import collections
+import functools
 import importlib
 import logging
 import os
@@ -15,6 +16,23 @@ from .strings import message_ready, message_startup, message_restart, message_pr
 from .config import ConfigWrapper, ConfigLogger
 
 
+# Cache of the status of the printer objects
+class PrinterStatus:
+    # A status is reused for requests within this time of its creation
+    # (so that all requests made while handling an event share it)
+    CACHE_TIME = 0.010
+    def __init__(self, printer):
+        self.printer = printer
+        self.entries = {}
+    def lookup_status(self, name, eventtime):
+        # The returned dictionary is shared and must not be modified
+        entry = self.entries.get(name)
+        if entry is not None and eventtime < entry[0] + self.CACHE_TIME:
+            return entry[1]
+        status = self.printer.lookup_object(name).get_status(eventtime)
+        self.entries[name] = (eventtime, status)
+        return status
+
 class Printer:
     config_error = ConfigParser.Error
     def __init__(self, input_fd, bglogger, start_args):
@@ -23,6 +41,7 @@ class Printer:
         self.reactor = reactor.Reactor()
         gc = gcode.GCodeParser(self, input_fd)
         self.objects = collections.OrderedDict({'gcode': gc})
+        self.objects['status'] = PrinterStatus(self)
         self.reactor.register_callback(self._connect)
         self.state_message = message_startup
         self.is_shutdown = False
@@ -117,18 +136,62 @@ class Printer:
         # Determine which printer objects have state callbacks
         self.state_cb = [o.printer_state for o in self.objects.values()
                          if hasattr(o, 'printer_state')]
+    def _connect_mcus(self):
+        # Connect to all micro-controllers in parallel (each in its own
+        # reactor greenlet)
+        mcus = self.lookup_objects(module='mcu')
+        results = {}
+        aborted = []
+        def connect_mcu(name, m, eventtime):
+            try:
+                m.connect()
+            except Exception as e:
+                # The traceback is lost when the error is raised again
+                # below, so log it here
+                if aborted:
+                    logging.info("MCU '%s' connect aborted: %s", name, e)
+                else:
+                    logging.exception("MCU '%s' error during connect", name)
+                results[m] = e
+            else:
+                results[m] = None
+        for name, m in mcus:
+            self.reactor.register_callback(
+                functools.partial(connect_mcu, name, m))
+        # Wait for each mcu in config order so that the reported error
+        # does not depend on which mcu failed first
+        for name, m in mcus:
+            while m not in results:
+                self.reactor.pause(self.reactor.monotonic() + 0.010)
+            if results[m] is not None:
+                # Stop the mcus that are still connecting
+                aborted.append(name)
+                for other_name, other in mcus:
+                    if other not in results:
+                        other.abort_connect()
+                raise results[m]
     def _connect(self, eventtime):
         try:
+            start_time = self.reactor.monotonic()
             self._read_config()
+            config_time = self.reactor.monotonic()
+            self._connect_mcus()
+            mcu_time = self.reactor.monotonic()
             for cb in self.state_cb:
                 if self.state_message is not message_startup:
                     return self.reactor.NEVER
                 cb('connect')
+            connect_time = self.reactor.monotonic()
             self._set_state(message_ready)
             for cb in self.state_cb:
                 if self.state_message is not message_ready:
                     return self.reactor.NEVER
                 cb('ready')
+            ready_time = self.reactor.monotonic()
+            logging.info("Startup time %.3fs: config=%.3fs mcu_connect=%.3fs"
+                         " connect=%.3fs ready=%.3fs", ready_time - start_time,
+                         config_time - start_time, mcu_time - config_time,
+                         connect_time - mcu_time, ready_time - connect_time)
         except (self.config_error, pins.error) as e:
             logging.exception("Config error")
             self._set_state("%s%s" % (str(e), message_restart))
@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, select, math, time
+import os, select, math, time, errno, heapq, collections
 import greenlet
 from . import chelper, util
 
@@ -16,6 +16,8 @@ class ReactorTimer:
     def __init__(self, callback, waketime):
         self.callback = callback
         self.waketime = waketime
+        self.heap_entry = None
+        self.registered = True
 
 class ReactorCallback:
     def __init__(self, reactor, callback):
@@ -31,6 +33,7 @@ class ReactorFileHandler:
     def __init__(self, fd, callback):
         self.fd = fd
         self.callback = callback
+        self.is_readable = True
     def fileno(self):
         return self.fd
 
@@ -46,8 +49,11 @@ class SelectReactor:
         # Main code
         self._process = False
         self.monotonic = chelper.get_ffi()[1].get_monotonic
-        # Timers
-        self._timers = []
+        # Timers (a heap of [waketime, seq, timer] with lazy removal)
+        self._timer_heap = []
+        self._timer_seq = 0
+        self._timer_stale = 0
+        self._timer_due = collections.deque()
         self._next_timer = self.NEVER
         # Callbacks
         self._pipe_fds = None
@@ -58,37 +64,87 @@ class SelectReactor:
         self._g_dispatch = None
         self._greenlets = []
     # Timers
-    def _note_time(self, t):
-        nexttime = t.waketime
-        if nexttime < self._next_timer:
-            self._next_timer = nexttime
+    def _invalidate_entry(self, t):
+        entry = t.heap_entry
+        if entry is not None:
+            entry[2] = None
+            t.heap_entry = None
+            self._timer_stale += 1
+    def _schedule_timer(self, t, waketime):
+        self._invalidate_entry(t)
+        t.waketime = waketime
+        if waketime >= self.NEVER:
+            return
+        heap = self._timer_heap
+        if self._timer_stale > 32 and self._timer_stale * 2 > len(heap):
+            # Too many invalidated entries - rebuild the heap
+            heap[:] = [e for e in heap if e[2] is not None]
+            heapq.heapify(heap)
+            self._timer_stale = len([e for e in self._timer_due
+                                     if e[2] is None])
+        self._timer_seq += 1
+        entry = [waketime, self._timer_seq, t]
+        t.heap_entry = entry
+        heapq.heappush(heap, entry)
+        if waketime < self._next_timer:
+            self._next_timer = waketime
+    def _update_next_timer(self):
+        heap = self._timer_heap
+        while heap and heap[0][2] is None:
+            heapq.heappop(heap)
+            self._timer_stale -= 1
+        if self._timer_due:
+            self._next_timer = self.NOW
+        elif heap:
+            self._next_timer = heap[0][0]
+        else:
+            self._next_timer = self.NEVER
     def update_timer(self, t, nexttime):
-        t.waketime = nexttime
-        self._note_time(t)
+        if t.registered:
+            self._schedule_timer(t, nexttime)
+        else:
+            t.waketime = nexttime
     def register_timer(self, callback, waketime = NEVER):
         handler = ReactorTimer(callback, waketime)
-        timers = list(self._timers)
-        timers.append(handler)
-        self._timers = timers
-        self._note_time(handler)
+        self._schedule_timer(handler, waketime)
         return handler
     def unregister_timer(self, handler):
-        timers = list(self._timers)
-        timers.pop(timers.index(handler))
-        self._timers = timers
+        if not handler.registered:
+            raise ValueError("Timer not registered")
+        handler.registered = False
+        self._invalidate_entry(handler)
     def _check_timers(self, eventtime):
         if eventtime < self._next_timer:
             return min(1., max(.001, self._next_timer - eventtime))
-        self._next_timer = self.NEVER
+        # Move expired timers to the dispatch queue (the queue is shared
+        # so that a greenlet started by pause() can continue it)
+        heap = self._timer_heap
+        due = self._timer_due
+        while heap and heap[0][0] <= eventtime:
+            entry = heapq.heappop(heap)
+            if entry[2] is None:
+                self._timer_stale -= 1
+                continue
+            due.append(entry)
+        self._next_timer = self.NOW
         g_dispatch = self._g_dispatch
-        for t in self._timers:
-            if eventtime >= t.waketime:
-                t.waketime = self.NEVER
-                t.waketime = t.callback(eventtime)
-                if g_dispatch is not self._g_dispatch:
-                    self._end_greenlet(g_dispatch)
-                    return 0.
-            self._note_time(t)
+        while due:
+            t = due.popleft()[2]
+            if t is None:
+                # Timer was unregistered or rescheduled by a prior callback
+                self._timer_stale -= 1
+                continue
+            t.heap_entry = None
+            t.waketime = self.NEVER
+            waketime = t.callback(eventtime)
+            if t.registered:
+                self._schedule_timer(t, waketime)
+            else:
+                t.waketime = waketime
+            if g_dispatch is not self._g_dispatch:
+                self._end_greenlet(g_dispatch)
+                return 0.
+        self._update_next_timer()
         if eventtime >= self._next_timer:
             return 0.
         return min(1., max(.001, self._next_timer - self.monotonic()))
@@ -157,7 +213,16 @@ class SelectReactor:
         self._fds.append(handler)
         return handler
     def unregister_fd(self, handler):
-        self._fds.pop(self._fds.index(handler))
+        if handler.is_readable:
+            self._fds.pop(self._fds.index(handler))
+    def set_fd_wake(self, handler, is_readable=True):
+        if handler.is_readable == is_readable:
+            return
+        handler.is_readable = is_readable
+        if is_readable:
+            self._fds.append(handler)
+        else:
+            self._fds.pop(self._fds.index(handler))
     # Main loop
     def _dispatch_loop(self):
         self._g_dispatch = g_dispatch = greenlet.getcurrent()
@@ -190,16 +255,23 @@ class PollReactor(SelectReactor):
     # File descriptors
     def register_fd(self, fd, callback):
         handler = ReactorFileHandler(fd, callback)
-        fds = self._fds.copy()
-        fds[fd] = callback
-        self._fds = fds
-        self._poll.register(handler, select.POLLIN | select.POLLHUP)
+        self._fds[fd] = handler
+        self._poll.register(fd, select.POLLIN | select.POLLHUP)
         return handler
     def unregister_fd(self, handler):
-        self._poll.unregister(handler)
-        fds = self._fds.copy()
-        del fds[handler.fd]
-        self._fds = fds
+        if handler.is_readable:
+            self._poll.unregister(handler.fd)
+        del self._fds[handler.fd]
+    def set_fd_wake(self, handler, is_readable=True):
+        if handler.is_readable == is_readable:
+            return
+        handler.is_readable = is_readable
+        # The poll object is rebuilt on every poll() call, so simply
+        # dropping the fd is cheaper than a modify() with no events
+        if is_readable:
+            self._poll.register(handler.fd, select.POLLIN | select.POLLHUP)
+        else:
+            self._poll.unregister(handler.fd)
     # Main loop
     def _dispatch_loop(self):
         self._g_dispatch = g_dispatch = greenlet.getcurrent()
@@ -209,7 +281,10 @@ class PollReactor(SelectReactor):
             res = self._poll.poll(int(math.ceil(timeout * 1000.)))
             eventtime = self.monotonic()
             for fd, event in res:
-                self._fds[fd](eventtime)
+                handler = self._fds.get(fd)
+                if handler is None:
+                    continue
+                handler.callback(eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
@@ -221,38 +296,73 @@ class EPollReactor(SelectReactor):
         SelectReactor.__init__(self)
         self._epoll = select.epoll()
         self._fds = {}
+        # Regular files can not be added to an epoll set (EPERM), but
+        # they are always readable - track them separately
+        self._files = {}
     # File descriptors
     def register_fd(self, fd, callback):
         handler = ReactorFileHandler(fd, callback)
-        fds = self._fds.copy()
-        fds[fd] = callback
-        self._fds = fds
-        self._epoll.register(fd, select.EPOLLIN | select.EPOLLHUP)
+        try:
+            self._epoll.register(fd, select.EPOLLIN | select.EPOLLHUP)
+        except (IOError, OSError) as e:
+            if e.errno != errno.EPERM:
+                raise
+            self._files[fd] = handler
+        self._fds[fd] = handler
         return handler
     def unregister_fd(self, handler):
-        self._epoll.unregister(handler.fd)
-        fds = self._fds.copy()
-        del fds[handler.fd]
-        self._fds = fds
+        if handler.fd in self._files:
+            del self._files[handler.fd]
+        else:
+            self._epoll.unregister(handler.fd)
+        del self._fds[handler.fd]
+    def set_fd_wake(self, handler, is_readable=True):
+        if handler.is_readable == is_readable:
+            return
+        handler.is_readable = is_readable
+        if handler.fd in self._files:
+            return
+        # Modify the existing registration in place.  The fd is level
+        # triggered while readable.  While paused it is switched to edge
+        # triggered with no events so that a hangup (which epoll always
+        # reports) wakes the reactor at most once instead of spinning.
+        if is_readable:
+            self._epoll.modify(handler.fd, select.EPOLLIN | select.EPOLLHUP)
+        else:
+            self._epoll.modify(handler.fd, select.EPOLLET)
     # Main loop
     def _dispatch_loop(self):
         self._g_dispatch = g_dispatch = greenlet.getcurrent()
         eventtime = self.monotonic()
         while self._process:
             timeout = self._check_timers(eventtime)
+            files = [fd for fd, handler in self._files.items()
+                     if handler.is_readable]
+            if files:
+                timeout = 0.
             res = self._epoll.poll(timeout)
             eventtime = self.monotonic()
+            if files:
+                res = res + [(fd, select.EPOLLIN) for fd in files]
             for fd, event in res:
-                self._fds[fd](eventtime)
+                handler = self._fds.get(fd)
+                if handler is None or not handler.is_readable:
+                    continue
+                handler.callback(eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
                     break
         self._g_dispatch = None
 
-# Use the poll based reactor if it is available
+# Use the epoll based reactor if it is available (Linux), otherwise
+# fallback to poll and then select
 try:
-    select.poll
-    Reactor = PollReactor
+    select.epoll
+    Reactor = EPollReactor
 except:
-    Reactor = SelectReactor
+    try:
+        select.poll
+        Reactor = PollReactor
+    except:
+        Reactor = SelectReactor
@@ -3,7 +3,8 @@
 # Copyright (C) 2016,2017  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, threading
+import sys, os, re, zlib, json, marshal, logging, threading
+import collections, functools
 import serial
 
 from . import msgproto, chelper, util
@@ -13,10 +14,18 @@ class error(Exception):
 
 class SerialReader:
     BITS_PER_BYTE = 10.
-    def __init__(self, reactor, serialport, baud):
+    BATCH_QUEUE_SIZE = 4096
+    PULL_BATCH_SIZE = 64
+    def __init__(self, reactor, serialport, baud, cache_dir=None):
         self.reactor = reactor
         self.serialport = serialport
         self.baud = baud
+        # Data dictionary cache
+        self.identify_cache = None
+        if cache_dir is not None:
+            self.identify_cache = IdentifyCache(cache_dir, serialport)
+        self.identify_cached = False
+        self.connect_aborted = False
         # Serial port
         self.ser = None
         self.msgparser = msgproto.MessageParser()
@@ -28,33 +37,62 @@ class SerialReader:
         # Threading
         self.lock = threading.Lock()
         self.background_thread = None
-        # Message handlers
+        # Message handlers (the handler table is replaced instead of
+        # modified, so the background thread reads it without a lock)
         handlers = {
             '#unknown': self.handle_unknown, '#output': self.handle_output,
             'shutdown': self.handle_output, 'is_shutdown': self.handle_output
         }
         self.handlers = { (k, None): v for k, v in handlers.items() }
+        # Responses queued for processing in the reactor
+        self.batch_queue = collections.deque(maxlen=self.BATCH_QUEUE_SIZE)
+        self.batch_pending = False
+        self.batch_dropped = 0
     def _bg_thread(self):
-        response = self.ffi_main.new('struct pull_queue_message *')
+        # Handle all the responses available at each wakeup (the
+        # responses are decoded in place from the pulled C buffers)
+        responses = self.ffi_main.new('struct pull_queue_message[]',
+                                      self.PULL_BATCH_SIZE)
+        pull_batch = self.ffi_lib.serialqueue_pull_batch
         while 1:
-            self.ffi_lib.serialqueue_pull(self.serialqueue, response)
-            count = response.len
-            if count <= 0:
+            count = pull_batch(self.serialqueue, responses, len(responses))
+            if count < 0:
                 break
-            params = self.msgparser.parse(response.msg[0:count])
-            params['#sent_time'] = response.sent_time
-            params['#receive_time'] = response.receive_time
-            hdl = (params['#name'], params.get('oid'))
-            with self.lock:
-                hdl = self.handlers.get(hdl, self.handle_default)
+            for i in range(count):
+                response = responses[i]
+                params = self.msgparser.parse_cdata(response.msg, response.len)
+                params['#sent_time'] = response.sent_time
+                params['#receive_time'] = response.receive_time
+                hdl = self.handlers.get((params['#name'], params.get('oid')),
+                                        self.handle_default)
+                try:
+                    hdl(params)
+                except:
+                    logging.exception("Exception in serial callback")
+    def _queue_batch(self, callback, params):
+        # Queue a response for the reactor (the oldest response is
+        # discarded if the reactor falls too far behind)
+        if len(self.batch_queue) >= self.BATCH_QUEUE_SIZE:
+            self.batch_dropped += 1
+        self.batch_queue.append((callback, params))
+        if not self.batch_pending:
+            self.batch_pending = True
+            self.reactor.register_async_callback(self._process_batch)
+    def _process_batch(self, eventtime):
+        self.batch_pending = False
+        batch_queue = self.batch_queue
+        while batch_queue:
+            callback, params = batch_queue.popleft()
             try:
-                hdl(params)
+                callback(params)
             except:
                 logging.exception("Exception in serial callback")
     def connect(self):
         # Initial connection
         logging.info("Starting serial connect")
         while 1:
+            if self.connect_aborted:
+                raise error("Serial connect aborted")
             starttime = self.reactor.monotonic()
             try:
                 if self.baud:
@@ -73,7 +111,10 @@ class SerialReader:
             self.background_thread = threading.Thread(target=self._bg_thread)
             self.background_thread.start()
             # Obtain and load the data dictionary from the firmware
-            sbs = SerialBootStrap(self)
+            cached = None
+            if self.identify_cache is not None:
+                cached = self.identify_cache.load()
+            sbs = SerialBootStrap(self, cached and cached[0])
             identify_data = sbs.get_identify_data(starttime + 5.)
             if identify_data is None:
                 logging.warn("Timeout on serial connect")
@@ -81,7 +122,16 @@ class SerialReader:
                 continue
             break
         msgparser = msgproto.MessageParser()
-        msgparser.process_identify(identify_data)
+        self.identify_cached = sbs.is_cached
+        if sbs.is_cached:
+            # The firmware matches the cached data dictionary
+            msgparser.raw_identify_data = zlib.decompress(identify_data)
+            msgparser.load_identify(cached[1])
+        else:
+            msgparser.process_identify(identify_data)
+            if self.identify_cache is not None:
+                self.identify_cache.save(
+                    identify_data, json.loads(msgparser.raw_identify_data))
         self.msgparser = msgparser
         self.register_callback(self.handle_unknown, '#unknown')
         # Setup baud adjust
@@ -94,6 +144,9 @@ class SerialReader:
         if receive_window is not None:
             self.ffi_lib.serialqueue_set_receive_window(
                 self.serialqueue, receive_window)
+    def abort_connect(self):
+        # Stop retrying the connection (another mcu failed to connect)
+        self.connect_aborted = True
     def connect_file(self, debugoutput, dictionary, pace=False):
         self.ser = debugoutput
         self.msgparser.process_identify(dictionary, decompress=False)
@@ -116,21 +169,53 @@ class SerialReader:
             return ""
         self.ffi_lib.serialqueue_get_stats(
             self.serialqueue, self.stats_buf, len(self.stats_buf))
-        return self.ffi_main.string(self.stats_buf)
+        stats = self.ffi_main.string(self.stats_buf)
+        if self.batch_dropped:
+            stats = "%s batch_dropped=%d" % (stats, self.batch_dropped)
+        return stats
     # Serial response callbacks
-    def register_callback(self, callback, name, oid=None):
+    def register_callback(self, callback, name, oid=None, batch=False):
+        # Callbacks are run in the background thread, unless 'batch' is
+        # set, in which case they are run in batches by the reactor
+        if batch:
+            callback = functools.partial(self._queue_batch, callback)
         with self.lock:
-            self.handlers[name, oid] = callback
+            handlers = dict(self.handlers)
+            handlers[name, oid] = callback
+            self.handlers = handlers
     def unregister_callback(self, name, oid=None):
         with self.lock:
-            del self.handlers[name, oid]
+            handlers = dict(self.handlers)
+            del handlers[name, oid]
+            self.handlers = handlers
     # Command sending
     def raw_send(self, cmd, minclock, reqclock, cmd_queue):
         self.ffi_lib.serialqueue_send(
             self.serialqueue, cmd_queue, cmd, len(cmd), minclock, reqclock)
+    def raw_send_params(self, data, minclock, reqclock, cmd_queue):
+        self.ffi_lib.serialqueue_send_params(
+            self.serialqueue, cmd_queue, data, len(data), minclock, reqclock)
     def send(self, msg, minclock=0, reqclock=0):
         cmd = self.msgparser.create_command(msg)
         self.raw_send(cmd, minclock, reqclock, self.default_cmd_queue)
+    def encode_commands(self, msgs):
+        # Encode a list of commands for send_encoded()
+        data = []
+        lens = []
+        for msg in msgs:
+            cmd = self.msgparser.create_command(msg)
+            if len(cmd) > msgproto.MESSAGE_PAYLOAD_MAX:
+                raise msgproto.error("Command too long: %s" % (msg,))
+            data.extend(cmd)
+            lens.append(len(cmd))
+        return data, lens
+    def send_encoded(self, encoded, minclock=0, reqclock=0):
+        # Send the commands from encode_commands() in as few message
+        # blocks as possible
+        data, lens = encoded
+        self.ffi_lib.serialqueue_send_packed(
+            self.serialqueue, self.default_cmd_queue, data, lens, len(lens),
+            minclock, reqclock)
     def lookup_command(self, msgformat, cq=None):
         if cq is None:
             cq = self.default_cmd_queue
@@ -180,7 +265,19 @@ class SerialCommand:
         self.serial = serial
         self.cmd_queue = cmd_queue
         self.cmd = cmd
+        # Commands with only integer parameters are encoded in C
+        self.native_send = (serial.msgparser.codec is not None
+                            and not cmd.native_buffers)
     def send(self, data=(), minclock=0, reqclock=0):
+        if self.native_send:
+            try:
+                self.serial.raw_send_params(
+                    [self.cmd.msgid] + list(data), minclock, reqclock,
+                    self.cmd_queue)
+                return
+            except (OverflowError, TypeError):
+                # Out of range value - let the python encoder handle it
+                pass
         cmd = self.cmd.encode(data)
         self.serial.raw_send(cmd, minclock, reqclock, self.cmd_queue)
     def send_with_response(self, data=(), response=None, response_oid=None):
@@ -227,12 +324,21 @@ class SerialRetryCommand:
 # Code to start communication and download message type dictionary
 class SerialBootStrap:
     RETRY_TIME = 0.500
-    def __init__(self, serial):
+    CHUNK_SIZE = 40
+    def __init__(self, serial, cached_data=None):
         self.serial = serial
         self.identify_data = ""
         self.identify_cmd = self.serial.lookup_command(
             "identify offset=%u count=%c")
-        self.is_done = False
+        self.is_done = self.is_cached = False
+        # A cached data dictionary is checked against the first and
+        # last chunks of the firmware data (the zlib data ends with a
+        # checksum of the whole dictionary) and the end of the data
+        self.verify_offsets = []
+        if cached_data:
+            self.identify_data = cached_data
+            size = len(cached_data)
+            self.verify_offsets = [0, max(0, size - self.CHUNK_SIZE), size]
         self.serial.register_callback(self.handle_identify, 'identify_response')
         self.serial.register_callback(self.handle_unknown, '#unknown')
         self.send_timer = self.serial.reactor.register_timer(
@@ -246,24 +352,89 @@ class SerialBootStrap:
         if not self.is_done:
             return None
         return self.identify_data
+    def send_request(self):
+        offset = len(self.identify_data)
+        if self.verify_offsets:
+            offset = self.verify_offsets[0]
+        self.identify_cmd.send([offset, self.CHUNK_SIZE])
+    def handle_verify(self, params):
+        offset = self.verify_offsets[0]
+        if params['offset'] != offset:
+            return
+        expected = self.identify_data[offset:offset+self.CHUNK_SIZE]
+        if params['data'] != expected:
+            # Firmware has changed - download the data dictionary
+            logging.info("Cached data dictionary does not match firmware")
+            self.verify_offsets = []
+            self.identify_data = ""
+        else:
+            del self.verify_offsets[0]
+            if not self.verify_offsets:
+                self.is_done = self.is_cached = True
+                return
+        self.send_request()
     def handle_identify(self, params):
-        if self.is_done or params['offset'] != len(self.identify_data):
+        if self.is_done:
+            return
+        if self.verify_offsets:
+            self.handle_verify(params)
+            return
+        if params['offset'] != len(self.identify_data):
             return
         msgdata = params['data']
         if not msgdata:
             self.is_done = True
             return
         self.identify_data += msgdata
-        self.identify_cmd.send([len(self.identify_data), 40])
+        self.send_request()
     def send_event(self, eventtime):
         if self.is_done:
             return self.serial.reactor.NEVER
-        self.identify_cmd.send([len(self.identify_data), 40])
+        self.send_request()
         return eventtime + self.RETRY_TIME
     def handle_unknown(self, params):
         logging.debug("Unknown message %d (len %d) while identifying",
                       params['#msgid'], len(params['#msg']))
 
+# Persistent storage of the data dictionary of an mcu
+class IdentifyCache:
+    CACHE_VERSION = 1
+    def __init__(self, cache_dir, serialport):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        name = re.sub('[^A-Za-z0-9_.-]', '_', serialport.strip('/'))
+        self.filename = os.path.join(self.cache_dir, "identify-%s" % (name,))
+    def load(self):
+        # Return the compressed and the decoded data dictionary
+        try:
+            f = open(self.filename, 'rb')
+            try:
+                data = marshal.load(f)
+            finally:
+                f.close()
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+        if (not isinstance(data, dict)
+            or data.get('version') != self.CACHE_VERSION
+            or data.get('python') != tuple(sys.version_info[:2])):
+            return None
+        return data['identify_data'], data['dictionary']
+    def save(self, identify_data, dictionary):
+        data = {'version': self.CACHE_VERSION,
+                'python': tuple(sys.version_info[:2]),
+                'identify_data': identify_data, 'dictionary': dictionary}
+        tmpname = "%s.tmp" % (self.filename,)
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            f = open(tmpname, 'wb')
+            try:
+                marshal.dump(data, f)
+            finally:
+                f.close()
+            os.rename(tmpname, self.filename)
+        except (IOError, OSError) as e:
+            logging.warn("Unable to write data dictionary cache: %s", e)
+
 # Attempt to place an AVR stk500v2 style programmer into normal mode
 def stk500v2_leave(ser, reactor):
     logging.debug("Starting stk500v2 leave programmer sequence")
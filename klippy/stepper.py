@@ -53,6 +53,7 @@ class PrinterStepper:
         ppins = printer.lookup_object('pins')
         step_pin = config.get('step_pin')
         self.mcu_stepper = mcu_stepper = ppins.setup_pin('stepper', step_pin)
+        mcu_stepper.setup_name(self.name)
         dir_pin = config.get('dir_pin')
         dir_pin_params = ppins.lookup_pin(dir_pin, can_invert=True)
         mcu_stepper.setup_dir_pin(dir_pin_params)
@@ -11,8 +11,17 @@ from .kinematics import extruder
 #   mm/second), _v2 is velocity squared (mm^2/s^2), _t is time (in
 #   seconds), _r is ratio (scalar between 0.0 and 1.0)
 
-# Class to track each move request
-class Move:
+# Class to track each move request.  Moves are created for every g-code
+# move, so the attributes are fixed with __slots__ to avoid a per-move
+# dictionary.
+class Move(object):
+    __slots__ = (
+        'toolhead', 'start_pos', 'end_pos', 'accel', 'cmove',
+        'is_kinematic_move', 'axes_d', 'move_d', 'min_move_t',
+        'max_start_v2', 'max_cruise_v2', 'delta_v2', 'max_smoothed_v2',
+        'smooth_delta_v2', 'accel_r', 'decel_r', 'cruise_r',
+        'start_v', 'cruise_v', 'end_v', 'accel_t', 'cruise_t', 'decel_t',
+        'extrude_r', 'extrude_max_corner_v')
     def __init__(self, toolhead, start_pos, end_pos, speed):
         self.toolhead = toolhead
         self.start_pos = tuple(start_pos)
@@ -20,8 +29,13 @@ class Move:
         self.accel = toolhead.max_accel
         self.cmove = toolhead.cmove
         self.is_kinematic_move = True
-        self.axes_d = axes_d = [end_pos[i] - start_pos[i] for i in (0, 1, 2, 3)]
-        self.move_d = move_d = math.sqrt(sum([d*d for d in axes_d[:3]]))
+        self.axes_d = axes_d = [end_pos[0] - start_pos[0],
+                                end_pos[1] - start_pos[1],
+                                end_pos[2] - start_pos[2],
+                                end_pos[3] - start_pos[3]]
+        self.move_d = move_d = math.sqrt(axes_d[0]*axes_d[0]
+                                         + axes_d[1]*axes_d[1]
+                                         + axes_d[2]*axes_d[2])
         if move_d < .000000001:
             # Extrude only move
             self.end_pos = (start_pos[0], start_pos[1], start_pos[2],
@@ -38,6 +52,8 @@ class Move:
         self.delta_v2 = 2.0 * move_d * self.accel
         self.max_smoothed_v2 = 0.
         self.smooth_delta_v2 = 2.0 * move_d * toolhead.max_accel_to_decel
+        # Updated by the extruder (see extruder.py)
+        self.extrude_r = self.extrude_max_corner_v = 0.
     def limit_speed(self, speed, accel):
         speed2 = speed**2
         if speed2 < self.max_cruise_v2:
@@ -115,6 +131,7 @@ LOOKAHEAD_FLUSH_TIME = 0.250
 class MoveQueue:
     def __init__(self):
         self.extruder_lookahead = None
+        self.move_batch = None
         self.queue = []
         self.leftover = 0
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
@@ -126,6 +143,8 @@ class MoveQueue:
         self.junction_flush = flush_time
     def set_extruder(self, extruder):
         self.extruder_lookahead = extruder.lookahead
+    def set_move_batch(self, move_batch):
+        self.move_batch = move_batch
     def flush(self, lazy=False):
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
         update_flush_count = lazy
@@ -178,6 +197,8 @@ class MoveQueue:
         # Generate step times for all moves ready to be flushed
         for move in queue[:move_count]:
             move.move()
+        if self.move_batch is not None:
+            self.move_batch.flush()
         # Remove processed moves from the queue
         self.leftover = flush_count - move_count
         del queue[:move_count]
@@ -193,6 +214,185 @@ class MoveQueue:
             # least one move can be flushed.
             self.flush(lazy=True)
 
+# Move queue that performs the junction speed calculations in C.  The
+# MoveQueue class above is the reference implementation.
+class CMoveQueue(MoveQueue):
+    def __init__(self):
+        MoveQueue.__init__(self)
+        ffi_main, ffi_lib = chelper.get_ffi()
+        self.lookahead = ffi_main.gc(ffi_lib.lookahead_alloc(),
+                                     ffi_lib.lookahead_free)
+        self.lookahead_add_move = ffi_lib.lookahead_add_move
+        self.lookahead_flush = ffi_lib.lookahead_flush
+        self.lookahead_get_junctions = ffi_lib.lookahead_get_junctions
+        self.lookahead_pop = ffi_lib.lookahead_pop
+        self.lookahead_reset = ffi_lib.lookahead_reset
+        self.ffi_main = ffi_main
+        self.junctions_buf = ffi_main.new('double[]', 6 * 64)
+    def reset(self):
+        MoveQueue.reset(self)
+        self.lookahead_reset(self.lookahead)
+    def flush(self, lazy=False):
+        self.junction_flush = LOOKAHEAD_FLUSH_TIME
+        queue = self.queue
+        leftover = self.leftover
+        flush_count = self.lookahead_flush(self.lookahead, leftover, lazy)
+        if flush_count < 0:
+            return
+        # Copy the calculated velocity trapezoids to the Move objects
+        count = flush_count - leftover
+        if count > 0:
+            if len(self.junctions_buf) < 6 * count:
+                self.junctions_buf = self.ffi_main.new(
+                    'double[]', 6 * max(count, 2 * len(self.junctions_buf)))
+            buf = self.junctions_buf
+            self.lookahead_get_junctions(self.lookahead, leftover, count, buf)
+            junctions = self.ffi_main.unpack(buf, 6 * count)
+            for i in range(count):
+                move = queue[leftover + i]
+                (move.accel_t, move.cruise_t, move.decel_t, move.start_v,
+                 move.cruise_v, move.end_v) = junctions[i*6:i*6+6]
+        # Allow extruder to do its lookahead
+        move_count = self.extruder_lookahead(queue, flush_count, lazy)
+        # Generate step times for all moves ready to be flushed
+        for move in queue[:move_count]:
+            move.move()
+        if self.move_batch is not None:
+            self.move_batch.flush()
+        # Remove processed moves from the queue
+        self.leftover = flush_count - move_count
+        del queue[:move_count]
+        self.lookahead_pop(self.lookahead, move_count)
+    def add_move(self, move):
+        queue = self.queue
+        queue.append(move)
+        extruder_v2 = 0.
+        if (len(queue) > 1 and move.is_kinematic_move
+            and queue[-2].is_kinematic_move):
+            # Allow extruder to calculate its maximum junction
+            extruder_v2 = move.toolhead.extruder.calc_junction(queue[-2], move)
+        axes_d = move.axes_d
+        move.max_start_v2 = self.lookahead_add_move(
+            self.lookahead, move.is_kinematic_move, move.move_d,
+            axes_d[0], axes_d[1], axes_d[2], move.accel, move.max_cruise_v2,
+            move.delta_v2, move.smooth_delta_v2,
+            move.toolhead.junction_deviation, extruder_v2)
+        if len(queue) == 1:
+            return
+        self.junction_flush -= move.min_move_t
+        if self.junction_flush <= 0.:
+            # There are enough queued moves to return to zero velocity
+            # from the first move's maximum possible velocity, so at
+            # least one move can be flushed.
+            self.flush(lazy=True)
+
+# Batch of moves whose steps are generated with a single call to the C
+# helper.  The toolhead and extruders fill moves and the steppers queue
+# their steps here; the resulting calls to move_fill(),
+# itersolve_gen_steps(), and steppersync_flush() are made in order by
+# move_batch_gen_steps() when the look-ahead queue is flushed.
+MB_MOVE, MB_EXTRUDE_MOVE, MB_FLUSH = 0., 1., 2.
+MB_RECORD_SIZE = 14
+
+class BatchMove(object):
+    __slots__ = ('record',)
+    def __init__(self):
+        self.record = -1
+
+class MoveBatch:
+    def __init__(self, all_mcus, stepgen_pool=None):
+        self.all_mcus = all_mcus
+        self.ffi_main, ffi_lib = chelper.get_ffi()
+        self.stepgen_pool = stepgen_pool
+        if stepgen_pool is None:
+            self.stepgen_pool = self.ffi_main.NULL
+        self.itersolve_gen_steps = ffi_lib.itersolve_gen_steps
+        self.move_batch_gen_steps = ffi_lib.move_batch_gen_steps
+        self.records = []
+        self.record_count = 0
+        self.job_sks = []
+        self.job_records = []
+        self.flush_pad = (0.,) * (MB_RECORD_SIZE - 2)
+        # Buffers passed to the C code (grown as needed)
+        self.records_buf = self.job_sks_buf = self.job_records_buf = None
+        self.records_buf_size = self.jobs_buf_size = 0
+    def alloc_move(self):
+        return BatchMove()
+    def reset(self):
+        del self.records[:]
+        del self.job_sks[:]
+        del self.job_records[:]
+        self.record_count = 0
+    # Replacements for the move_fill() and extruder_move_fill() helpers
+    def move_fill(self, cmove, print_time, accel_t, cruise_t, decel_t,
+                  start_pos_x, start_pos_y, start_pos_z,
+                  axes_d_x, axes_d_y, axes_d_z, start_v, cruise_v, accel):
+        cmove.record = self.record_count
+        self.record_count += 1
+        self.records.extend((
+            MB_MOVE, print_time, accel_t, cruise_t, decel_t,
+            start_pos_x, start_pos_y, start_pos_z,
+            axes_d_x, axes_d_y, axes_d_z, start_v, cruise_v, accel))
+    def extruder_move_fill(self, cmove, print_time, accel_t, cruise_t,
+                           decel_t, start_pos, start_v, cruise_v, accel,
+                           extra_accel_v, extra_decel_v):
+        cmove.record = self.record_count
+        self.record_count += 1
+        self.records.extend((
+            MB_EXTRUDE_MOVE, print_time, accel_t, cruise_t, decel_t,
+            start_pos, start_v, cruise_v, accel, extra_accel_v,
+            extra_decel_v, 0., 0., 0.))
+    # Replacement for itersolve_gen_steps() (see MCU_stepper)
+    def gen_steps(self, sk, cmove):
+        if cmove.__class__ is not BatchMove:
+            return self.itersolve_gen_steps(sk, cmove)
+        self.job_sks.append(sk)
+        self.job_records.append(cmove.record)
+        return 0
+    def flush_moves(self, flush_time):
+        if not self.record_count:
+            for m in self.all_mcus:
+                m.flush_moves(flush_time)
+            return
+        self.record_count += 1
+        self.records.append(MB_FLUSH)
+        self.records.append(flush_time)
+        self.records.extend(self.flush_pad)
+    def _alloc_buffers(self):
+        ffi_main = self.ffi_main
+        if len(self.records) > self.records_buf_size:
+            self.records_buf_size = max(len(self.records),
+                                        2 * self.records_buf_size)
+            self.records_buf = ffi_main.new('double[]', self.records_buf_size)
+        if len(self.job_sks) > self.jobs_buf_size:
+            self.jobs_buf_size = max(len(self.job_sks), 2 * self.jobs_buf_size)
+            self.job_sks_buf = ffi_main.new(
+                'struct stepper_kinematics *[]', self.jobs_buf_size)
+            self.job_records_buf = ffi_main.new('int[]', self.jobs_buf_size)
+    def flush(self):
+        if not self.record_count:
+            return
+        self._alloc_buffers()
+        records = self.records
+        self.records_buf[0:len(records)] = records
+        job_count = len(self.job_sks)
+        self.job_sks_buf[0:job_count] = self.job_sks
+        self.job_records_buf[0:job_count] = self.job_records
+        ss_list = []
+        ss_clock_adj = []
+        for m in self.all_mcus:
+            ss_info = m.get_steppersync()
+            if ss_info is not None:
+                ss_list.append(ss_info[0])
+                ss_clock_adj.extend(ss_info[1])
+        ret = self.move_batch_gen_steps(
+            self.records_buf, self.record_count,
+            self.job_sks_buf, self.job_records_buf, job_count,
+            self.stepgen_pool, ss_list, ss_clock_adj, len(ss_list))
+        self.reset()
+        if ret:
+            raise mcu.error("Internal error in stepcompress")
+
 STALL_TIME = 0.100
 
 # Main code to track events (and their timing) on the printer toolhead
@@ -203,7 +403,7 @@ class ToolHead:
         self.all_mcus = [
             m for n, m in self.printer.lookup_objects(module='mcu')]
         self.mcu = self.all_mcus[0]
-        self.move_queue = MoveQueue()
+        self.move_queue = CMoveQueue()
         self.commanded_pos = [0., 0., 0., 0.]
         # Velocity and acceleration control
         self.max_velocity = config.getfloat('max_velocity', above=0.)
@@ -232,16 +432,36 @@ class ToolHead:
         self.last_print_start_time = 0.
         self.need_check_stall = -1.
         self.print_stall = 0
+        self.stall_count = 0
         self.sync_print_time = True
         self.idle_flush_print_time = 0.
         self.flush_timer = self.reactor.register_timer(self._flush_handler)
         self.move_queue.set_flush_time(self.buffer_time_high)
         self.printer.try_load_module(config, "idle_timeout")
         self.printer.try_load_module(config, "statistics")
-        # Setup iterative solver
+        # Setup iterative solver (moves are processed in batches, which
+        # may optionally generate the steps of each move in parallel)
         ffi_main, ffi_lib = chelper.get_ffi()
-        self.cmove = ffi_main.gc(ffi_lib.move_alloc(), ffi_lib.free)
-        self.move_fill = ffi_lib.move_fill
+        solvers = {'iterative': False, 'analytic': True}
+        self.analytic_solver = config.getchoice(
+            'step_solver', solvers, 'iterative')
+        stepgen_pool = None
+        stepgen_threads = config.getint('step_generation_threads', 0, minval=0)
+        if stepgen_threads:
+            stepgen_pool = ffi_main.gc(
+                ffi_lib.stepgen_pool_alloc(stepgen_threads),
+                ffi_lib.stepgen_pool_free)
+        self.move_batch = MoveBatch(self.all_mcus, stepgen_pool)
+        self.move_queue.set_move_batch(self.move_batch)
+        self.cmove = self.move_batch.alloc_move()
+        self.move_fill = self.move_batch.move_fill
+        # Optional parallel step compression
+        self.compress_pool = None
+        compress_threads = config.getint('step_compress_threads', 0, minval=0)
+        if compress_threads:
+            self.compress_pool = ffi_main.gc(
+                ffi_lib.thread_pool_alloc(compress_threads),
+                ffi_lib.thread_pool_free)
         # Create kinematics class
         self.extruder = extruder.DummyExtruder()
         self.move_queue.set_extruder(self.extruder)
@@ -266,8 +486,7 @@ class ToolHead:
     def update_move_time(self, movetime):
         self.print_time += movetime
         flush_to_time = self.print_time - self.move_flush_time
-        for m in self.all_mcus:
-            m.flush_moves(flush_to_time)
+        self.move_batch.flush_moves(flush_to_time)
     def get_next_move_time(self):
         if not self.sync_print_time:
             return self.print_time
@@ -317,6 +536,7 @@ class ToolHead:
             if self.mcu.is_fileoutput():
                 self.need_check_stall = self.reactor.NEVER
                 return
+            self.stall_count += 1
             eventtime = self.reactor.pause(eventtime + min(1., stall_time))
         self.need_check_stall = est_print_time + self.buffer_time_high + 0.100
     def _flush_handler(self, eventtime):
@@ -384,6 +604,8 @@ class ToolHead:
         self.commanded_pos[3] = extrude_pos
     def get_extruder(self):
         return self.extruder
+    def get_move_batch(self):
+        return self.move_batch
     # Misc commands
     def stats(self, eventtime):
         for m in self.all_mcus:
@@ -392,6 +614,10 @@ class ToolHead:
         is_active = buffer_time > -60. or not self.sync_print_time
         return is_active, "print_time=%.3f buffer_time=%.3f print_stall=%d" % (
             self.print_time, max(buffer_time, 0.), self.print_stall)
+    def get_stall_count(self):
+        # Number of times the move queue was full and the toolhead
+        # yielded to the reactor waiting for the mcu to catch up
+        return self.stall_count
     def get_status(self, eventtime):
         print_time = self.print_time
         estimated_print_time = self.mcu.estimated_print_time(eventtime)
@@ -405,8 +631,15 @@ class ToolHead:
                  'estimated_print_time': estimated_print_time,
                  'printing_time': print_time - last_print_start_time }
     def printer_state(self, state):
+        if state == 'connect':
+            for m in self.all_mcus:
+                m.set_move_batch(self.move_batch)
+                m.set_analytic_solver(self.analytic_solver)
+                if self.compress_pool is not None:
+                    m.set_thread_pool(self.compress_pool)
         if state == 'shutdown':
             try:
+                self.move_batch.reset()
                 self.move_queue.reset()
                 self.reset_print_time()
             except:
@@ -0,0 +1,157 @@
+#!/usr/bin/env python2
+# Benchmark of the bed_mesh move splitters
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, math, random
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from klippy.extras import bed_mesh
+
+class BenchConfig:
+    def __init__(self, options):
+        self.options = options
+    def getfloat(self, name, default, minval=None):
+        return self.options.get(name, default)
+
+def make_mesh(count, pps, algo):
+    mesh, z_table = make_params_mesh(count, pps, algo)
+    mesh.build_mesh(z_table)
+    return mesh
+
+def make_params_mesh(count, pps, algo):
+    rnd = random.Random(0)
+    params = {
+        'min_x': 10., 'max_x': 190., 'min_y': 10., 'max_y': 190.,
+        'x_offset': 0., 'y_offset': 0., 'x_count': count, 'y_count': count,
+        'mesh_x_pps': pps, 'mesh_y_pps': pps, 'algo': algo, 'tension': .2}
+    mesh = bed_mesh.ZMesh(params)
+    # A warped bed with some random variation
+    z_table = []
+    for j in range(count):
+        row = []
+        for i in range(count):
+            x = i / (count - 1.) - .5
+            y = j / (count - 1.) - .5
+            row.append(.4 * (x*x - y*y) + rnd.uniform(-.05, .05))
+        z_table.append(row)
+    return mesh, z_table
+
+# Diagonal infill lines clipped to a 180x180 area
+def gen_infill(count, spacing):
+    moves = []
+    pos = [10., 10., .2, 0.]
+    offset = 0.
+    while len(moves) < count:
+        offset += spacing
+        if offset >= 360.:
+            offset = spacing
+        start = (10. + max(0., offset - 180.), 10. + min(offset, 180.))
+        end = (10. + min(offset, 180.), 10. + max(0., offset - 180.))
+        if len(moves) % 2:
+            start, end = end, start
+        for x, y in (start, end):
+            newpos = [x, y, pos[2], pos[3]]
+            dist = math.sqrt((x - pos[0])**2 + (y - pos[1])**2)
+            newpos[3] += dist * .03
+            moves.append((pos, newpos))
+            pos = newpos
+    return moves[:count]
+
+def run_splitter(splitter, mesh, moves):
+    splitter.set_mesh(mesh)
+    out = []
+    start = time.time()
+    for prev_pos, next_pos in moves:
+        splitter.build_move(prev_pos, next_pos, 1.)
+        sub_moves = []
+        while not splitter.traverse_complete:
+            sub_moves.append(list(splitter.split()))
+        out.append(sub_moves)
+    return out, time.time() - start
+
+# Largest difference between the generated moves and the mesh surface
+def max_deviation(mesh, moves, results, samples):
+    dev = 0.
+    for (prev_pos, next_pos), sub_moves in zip(moves, results):
+        start = list(prev_pos)
+        start[2] += mesh.get_z(start[0], start[1])
+        for end in sub_moves:
+            for i in range(1, samples):
+                t = float(i) / samples
+                x, y, z = [bed_mesh.lerp(t, s, e)
+                           for s, e in zip(start[:3], end[:3])]
+                dev = max(dev, abs(z - prev_pos[2] - mesh.get_z(x, y)))
+            start = end
+    return dev
+
+# Time the construction of the interpolated mesh and the lookup of
+# 'count' random points with get_z() and get_z_many()
+def bench_mesh(count, pps, algo, points):
+    mesh, z_table = make_params_mesh(count, pps, algo)
+    start = time.time()
+    mesh.build_mesh(z_table)
+    build_time = time.time() - start
+    rnd = random.Random(1)
+    xs = [rnd.uniform(0., 200.) for i in range(points)]
+    ys = [rnd.uniform(0., 200.) for i in range(points)]
+    start = time.time()
+    for x, y in zip(xs, ys):
+        mesh.get_z(x, y)
+    single_time = time.time() - start
+    start = time.time()
+    for i in range(0, points, 64):
+        mesh.get_z_many(xs[i:i+64], ys[i:i+64])
+    batch_time = time.time() - start
+    return mesh, build_time, single_time, batch_time
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--moves", type="int", dest="moves", default=10000,
+                    help="number of infill moves")
+    opts.add_option("-s", "--spacing", type="float", dest="spacing",
+                    default=2., help="infill line spacing (mm)")
+    opts.add_option("-p", "--probe_count", type="int", dest="count",
+                    default=5, help="number of probe points per axis")
+    opts.add_option("-l", "--lookups", type="int", dest="lookups",
+                    default=100000, help="number of z lookups")
+    opts.add_option("-z", "--split_delta_z", type="float", dest="delta_z",
+                    default=.025, help="split_delta_z (mm)")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    sys.stdout.write("Mesh construction and %d z lookups (batches of 64,"
+                     " numpy %s):\n" % (options.lookups, "available"
+                                        if bed_mesh.numpy is not None
+                                        else "not available"))
+    sys.stdout.write("%-12s %10s %12s %14s\n" % (
+        "mesh", "build(ms)", "get_z(ms)", "get_z_many(ms)"))
+    for count, pps, algo in [(options.count, 2, 'lagrange'),
+                             (options.count, 2, 'bicubic'),
+                             (15, 4, 'lagrange'), (15, 4, 'bicubic')]:
+        mesh, build, single, batch = bench_mesh(count, pps, algo,
+                                                options.lookups)
+        sys.stdout.write("%-12s %10.1f %12.1f %14.1f\n" % (
+            "%s/%d" % (algo, mesh.mesh_x_count), build * 1000.,
+            single * 1000., batch * 1000.))
+    moves = gen_infill(options.moves, options.spacing)
+    scale = 10000. / options.moves
+    sys.stdout.write("Per 10000 infill moves (split_delta_z=%.3f):\n" % (
+        options.delta_z,))
+    sys.stdout.write("%-12s %-9s %12s %10s %14s\n" % (
+        "mesh", "splitter", "sub-moves", "cpu(ms)", "max dev(mm)"))
+    config = BenchConfig({'split_delta_z': options.delta_z})
+    for pps, algo in [(0, 'direct'), (2, 'lagrange'), (2, 'bicubic')]:
+        mesh = make_mesh(options.count, pps, algo)
+        name = "%s/%d" % (algo, mesh.mesh_x_count)
+        for sname, cls in [("sample", bed_mesh.MoveSplitter),
+                           ("cell", bed_mesh.CellMoveSplitter)]:
+            results, elapsed = run_splitter(cls(config, None), mesh, moves)
+            count = sum([len(r) for r in results])
+            dev = max_deviation(mesh, moves, results, 20)
+            sys.stdout.write("%-12s %-9s %12.0f %10.1f %14.4f\n" % (
+                name, sname, count * scale, elapsed * 1000. * scale, dev))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python2
+# Benchmark of serial and parallel step compression
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, math, random
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from klippy import chelper, toolhead
+from klippy.kinematics import extruder
+
+MCU_FREQ = 16000000.
+AXES = [b'x', b'y', b'z']
+
+
+######################################################################
+# Move generation
+######################################################################
+
+class BenchToolHead:
+    def __init__(self):
+        self.max_accel = 3000.
+        self.max_accel_to_decel = 1500.
+        self.junction_deviation = 5. * (math.sqrt(2.) - 1.) / 3000.
+        self.extruder = extruder.DummyExtruder()
+        self.cmove = None
+        self.moves = []
+
+class RecordMove(toolhead.Move):
+    def move(self):
+        self.toolhead.moves.append((
+            self.start_pos, self.axes_d, self.accel_t, self.cruise_t,
+            self.decel_t, self.start_v, self.cruise_v, self.accel))
+
+def gen_moves(count, max_length, speed):
+    rnd = random.Random(0)
+    th = BenchToolHead()
+    mq = toolhead.MoveQueue()
+    mq.set_extruder(th.extruder)
+    pos = [0., 0., 20., 0.]
+    for i in range(count):
+        angle = rnd.uniform(0., 2. * math.pi)
+        length = rnd.uniform(.1, max_length)
+        x = pos[0] + length * math.cos(angle)
+        y = pos[1] + length * math.sin(angle)
+        if x*x + y*y > 80.**2:
+            x, y = -x * .5, -y * .5
+        newpos = [x, y, pos[2] + rnd.uniform(-.1, .1), pos[3]]
+        mq.add_move(RecordMove(th, pos, newpos, speed))
+        pos = newpos
+    mq.flush()
+    return th.moves
+
+
+######################################################################
+# Step compression
+######################################################################
+
+# Generate the steps of all moves and return (steps, compress_time)
+def run_compress(moves, steppers, batch, threads):
+    ffi_main, ffi_lib = chelper.get_ffi()
+    outfile = open(os.devnull, 'wb')
+    sq = ffi_lib.serialqueue_alloc(outfile.fileno(), 1)
+    ffi_lib.serialqueue_set_clock_est(sq, 1000000000000.,
+                                      ffi_lib.get_monotonic(), 0)
+    # Steppers are spread over the cartesian axes (as with multiple z
+    # steppers or dual carriages)
+    sc_list = []
+    sks = []
+    for oid in range(steppers):
+        sc = ffi_main.gc(ffi_lib.stepcompress_alloc(oid),
+                         ffi_lib.stepcompress_free)
+        ffi_lib.stepcompress_fill(sc, 25, 0, 10, 11)
+        sk = ffi_main.gc(ffi_lib.cartesian_stepper_alloc(AXES[oid % 3]),
+                         ffi_lib.free)
+        step_dist = .0125 if oid % 3 < 2 else .0025
+        ffi_lib.itersolve_set_stepcompress(sk, sc, step_dist)
+        ffi_lib.itersolve_set_commanded_pos(
+            sk, ffi_lib.itersolve_calc_position_from_coord(sk, 0., 0., 20.))
+        sc_list.append(sc)
+        sks.append(sk)
+    ss = ffi_lib.steppersync_alloc(sq, sc_list, len(sc_list), 500)
+    ffi_lib.steppersync_set_time(ss, 0., MCU_FREQ)
+    pool = None
+    if threads:
+        pool = ffi_main.gc(ffi_lib.thread_pool_alloc(threads),
+                           ffi_lib.thread_pool_free)
+        ffi_lib.steppersync_set_thread_pool(ss, pool)
+    cmove = ffi_main.gc(ffi_lib.move_alloc(), ffi_lib.free)
+    last_pos = [ffi_lib.itersolve_get_commanded_pos(sk) for sk in sks]
+    steps = 0.
+    print_time = .1
+    compress_time = 0.
+    for i, (start_pos, axes_d, accel_t, cruise_t, decel_t, start_v,
+            cruise_v, accel) in enumerate(moves):
+        ffi_lib.move_fill(
+            cmove, print_time, accel_t, cruise_t, decel_t,
+            start_pos[0], start_pos[1], start_pos[2],
+            axes_d[0], axes_d[1], axes_d[2], start_v, cruise_v, accel)
+        for j, sk in enumerate(sks):
+            ffi_lib.itersolve_gen_steps(sk, cmove)
+            pos = ffi_lib.itersolve_get_commanded_pos(sk)
+            steps += abs(pos - last_pos[j]) / (.0125 if j % 3 < 2 else .0025)
+            last_pos[j] = pos
+        print_time += accel_t + cruise_t + decel_t
+        if (i + 1) % batch:
+            continue
+        start_time = time.time()
+        ffi_lib.steppersync_flush(ss, int((print_time - .05) * MCU_FREQ))
+        compress_time += time.time() - start_time
+    start_time = time.time()
+    ffi_lib.steppersync_flush(ss, int((print_time + 1.) * MCU_FREQ))
+    compress_time += time.time() - start_time
+    # Let the background thread write out the queued messages
+    sbuf = ffi_main.new('char[4096]')
+    while 1:
+        ffi_lib.serialqueue_get_stats(sq, sbuf, len(sbuf))
+        stats = ffi_main.string(sbuf).decode()
+        if 'ready_bytes=0 stalled_bytes=0' in stats:
+            break
+        time.sleep(.001)
+    ffi_lib.serialqueue_exit(sq)
+    ffi_lib.steppersync_free(ss)
+    ffi_lib.serialqueue_free(sq)
+    outfile.close()
+    return steps, compress_time
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--moves", type="int", dest="moves", default=2000,
+                    help="number of moves")
+    opts.add_option("-l", "--length", type="float", dest="length",
+                    default=20., help="maximum move length (mm)")
+    opts.add_option("-s", "--speed", type="float", dest="speed",
+                    default=150., help="move speed (mm/s)")
+    opts.add_option("-b", "--batch", type="int", dest="batch", default=1,
+                    help="moves generated between each flush")
+    opts.add_option("-c", "--steppers", type="string", dest="steppers",
+                    default="4,8,16", help="stepper counts to test")
+    opts.add_option("-t", "--threads", type="string", dest="threads",
+                    default="1,2,4,8", help="pool thread counts to test")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    steppers = [int(s) for s in options.steppers.split(',')]
+    threads = [int(t) for t in options.threads.split(',')]
+    moves = gen_moves(options.moves, options.length, options.speed)
+    # Build the C helper before timing anything
+    chelper.get_ffi()
+    sys.stdout.write("%d moves (max length %.1fmm, %.0fmm/s, batch %d)\n" % (
+        len(moves), options.length, options.speed, options.batch))
+    sys.stdout.write("%-10s %-8s %12s %16s %10s\n" % (
+        "steppers", "threads", "steps", "compress steps/s", "speedup"))
+    for count in steppers:
+        serial_time = None
+        for t in [0] + threads:
+            steps, compress_time = run_compress(moves, count, options.batch, t)
+            if serial_time is None:
+                serial_time = compress_time
+            sys.stdout.write("%-10d %-8s %12.0f %16.0f %9.2fx\n" % (
+                count, t or "serial", steps, steps / compress_time,
+                serial_time / compress_time))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python2
+# Benchmark of the klippy g-code line parser
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, glob
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from klippy import gcode, reactor
+
+# Minimal printer object - moves are discarded so that only the cost of
+# tokenizing and dispatching the g-code is measured
+class BenchPrinter:
+    def __init__(self):
+        self.reactor = reactor.Reactor()
+    def get_reactor(self):
+        return self.reactor
+    def get_start_args(self):
+        return {'debuginput': 'bench'}
+    def lookup_object(self, name, default=None):
+        return default
+    def request_exit(self, result):
+        pass
+    def invoke_shutdown(self, msg):
+        pass
+
+def make_parser(fast_moves):
+    gp = gcode.GCodeParser(BenchPrinter(), -1)
+    # Only moves are executed - other commands are dispatched to a no-op
+    for cmd, func in gp.ready_gcode_handlers.items():
+        if func is not gp.move_handler:
+            gp.ready_gcode_handlers[cmd] = (lambda params: None)
+    gp.is_printer_ready = True
+    gp.gcode_handlers = gp.ready_gcode_handlers
+    moves = []
+    gp.move_with_transform = (lambda pos, speed: moves.append(speed))
+    gp.position_with_transform = (lambda: [0., 0., 0., 0.])
+    if not fast_moves:
+        gp.parse_move = (lambda line: None)
+    return gp, moves
+
+def bench_file(fname, fast_moves, repeat):
+    f = open(fname, 'r')
+    lines = f.read().split('\n')
+    f.close()
+    gp, moves = make_parser(fast_moves)
+    start = time.time()
+    for i in range(repeat):
+        gp.process_commands(lines, need_ack=False)
+    elapsed = time.time() - start
+    return len(lines) * repeat, elapsed, len(moves)
+
+def main():
+    usage = "%prog [options] [gcode files]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-r", "--repeat", type="int", dest="repeat", default=20,
+                    help="number of times to parse each file")
+    options, args = opts.parse_args()
+    if not args:
+        testdir = os.path.join(os.path.dirname(__file__), '..', 'test',
+                               'klippy')
+        args = sorted(glob.glob(os.path.join(testdir, '*.gcode')))
+    sys.stdout.write("%-20s %8s %12s %12s %8s\n" % (
+        "file", "lines", "full(l/s)", "fast(l/s)", "speedup"))
+    for fname in args:
+        count, full_time, full_moves = bench_file(fname, False,
+                                                  options.repeat)
+        count, fast_time, fast_moves = bench_file(fname, True,
+                                                  options.repeat)
+        if full_moves != fast_moves:
+            sys.stdout.write("Move count mismatch on %s (%d vs %d)\n" % (
+                fname, full_moves, fast_moves))
+        sys.stdout.write("%-20s %8d %12.0f %12.0f %8.2f\n" % (
+            os.path.basename(fname), count // options.repeat,
+            count / full_time, count / fast_time, full_time / fast_time))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python2
+# Benchmark of the toolhead move queue "look-ahead" planner
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, math
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from klippy import toolhead
+from klippy.kinematics import extruder
+
+# Minimal toolhead - step generation is skipped so that only the cost
+# of the junction planning is measured
+class BenchToolHead:
+    def __init__(self, max_accel, square_corner_velocity):
+        self.max_accel = max_accel
+        self.max_accel_to_decel = max_accel * .5
+        self.junction_deviation = (square_corner_velocity**2
+                                   * (math.sqrt(2.) - 1.) / max_accel)
+        self.cmove = None
+        self.extruder = extruder.DummyExtruder()
+        self.move_count = 0
+
+class BenchMove(toolhead.Move):
+    def move(self):
+        self.toolhead.move_count += 1
+
+# Generate a path of short segments approximating arcs (as commonly
+# emitted by slicers for curved perimeters)
+def gen_arc_path(count, seg_len):
+    positions = []
+    x = y = e = 0.
+    angle = 0.
+    for i in range(count):
+        if i % 200 == 0:
+            # Sharp corner between arcs
+            angle += math.pi * .5
+        angle += seg_len / 20.
+        x += seg_len * math.cos(angle)
+        y += seg_len * math.sin(angle)
+        e += seg_len * .04
+        positions.append((x, y, .2, e))
+    return positions
+
+def bench_queue(queue_class, positions, speed, max_accel, scv):
+    th = BenchToolHead(max_accel, scv)
+    mq = queue_class()
+    mq.set_extruder(th.extruder)
+    start = time.time()
+    pos = (0., 0., .2, 0.)
+    for newpos in positions:
+        mq.add_move(BenchMove(th, pos, newpos, speed))
+        pos = newpos
+    mq.flush()
+    elapsed = time.time() - start
+    return th.move_count, elapsed
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--moves", type="int", dest="moves", default=50000,
+                    help="number of moves to plan")
+    opts.add_option("-l", "--segments", type="string", dest="segments",
+                    default="0.1,0.5,2.0",
+                    help="comma separated list of segment lengths (mm)")
+    opts.add_option("-s", "--speed", type="float", dest="speed", default=150.,
+                    help="requested move speed (mm/s)")
+    opts.add_option("-a", "--accel", type="float", dest="accel", default=3000.,
+                    help="max_accel (mm/s^2)")
+    opts.add_option("-c", "--scv", type="float", dest="scv", default=5.,
+                    help="square_corner_velocity (mm/s)")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    # Includes Move object creation, which is the same for both planners
+    sys.stdout.write("%10s %10s %14s %14s %8s\n" % (
+        "segment", "moves", "python(m/s)", "c(m/s)", "speedup"))
+    for seg_len in [float(s) for s in options.segments.split(',')]:
+        positions = gen_arc_path(options.moves, seg_len)
+        py_count, py_time = bench_queue(
+            toolhead.MoveQueue, positions, options.speed, options.accel,
+            options.scv)
+        c_count, c_time = bench_queue(
+            toolhead.CMoveQueue, positions, options.speed, options.accel,
+            options.scv)
+        if py_count != c_count:
+            sys.stdout.write("Move count mismatch (%d vs %d)\n" % (
+                py_count, c_count))
+        sys.stdout.write("%10.2f %10d %14.0f %14.0f %8.2f\n" % (
+            seg_len, c_count, py_count / py_time, c_count / c_time,
+            py_time / c_time))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python2
+# Memory and allocation benchmark of toolhead Move objects
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, math, gc, resource
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from klippy import toolhead
+from klippy.kinematics import extruder
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+class BenchToolHead:
+    def __init__(self):
+        self.max_accel = 3000.
+        self.max_accel_to_decel = 1500.
+        self.junction_deviation = 25. * (math.sqrt(2.) - 1.) / 3000.
+        self.cmove = None
+        self.extruder = extruder.DummyExtruder()
+        self.move_count = 0
+
+# Step generation is skipped - only the move objects are of interest
+class SlotsMove(toolhead.Move):
+    __slots__ = ()
+    def move(self):
+        self.toolhead.move_count += 1
+
+# Equivalent of the Move class with a per-instance __dict__ (as it was
+# before __slots__ were added)
+DictMove = type('DictMove', (object,), dict(
+    [(k, v) for k, v in toolhead.Move.__dict__.items()
+     if k not in toolhead.Move.__slots__
+     and k not in ('__slots__', '__dict__', '__weakref__')]
+    + [('move', SlotsMove.__dict__['move'])]))
+
+def gen_positions(count):
+    positions = []
+    for i in range(count):
+        angle = i * .05
+        positions.append((100. + 50. * math.cos(angle),
+                          100. + 50. * math.sin(angle), .2, i * .01))
+    return positions
+
+# Run 'count' moves through the move queue and hold 'hold' moves alive
+# at the end (as would be the case with a full look-ahead queue)
+def run_moves(move_class, positions, hold):
+    th = BenchToolHead()
+    mq = toolhead.CMoveQueue()
+    mq.set_extruder(th.extruder)
+    pos = (100., 100., .2, 0.)
+    held = []
+    for newpos in positions:
+        move = move_class(th, pos, newpos, 100.)
+        pos = newpos
+        mq.add_move(move)
+        held.append(move)
+        if len(held) > hold:
+            del held[:len(held) - hold]
+    mq.flush()
+    return held
+
+def measure(move_class, positions, hold):
+    res = {}
+    # Time
+    gc.collect()
+    start = time.time()
+    run_moves(move_class, positions, hold)
+    res['time'] = time.time() - start
+    # Garbage collector activity
+    gc.collect()
+    gc_before = sum([s['collections'] for s in gc.get_stats()]
+                    ) if hasattr(gc, 'get_stats') else None
+    run_moves(move_class, positions, hold)
+    if gc_before is not None:
+        res['gc'] = sum([s['collections'] for s in gc.get_stats()]
+                        ) - gc_before
+    # Memory held by the live moves and total allocations
+    if tracemalloc is not None:
+        gc.collect()
+        tracemalloc.start()
+        snap_start = tracemalloc.take_snapshot()
+        held = run_moves(move_class, positions, hold)
+        current, peak = tracemalloc.get_traced_memory()
+        snap = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        stats = snap.compare_to(snap_start, 'filename')
+        res['held_bytes'] = sum([s.size_diff for s in stats])
+        res['held_blocks'] = sum([s.count_diff for s in stats])
+        res['peak_bytes'] = peak
+        del held
+    return res
+
+# Report the growth in peak RSS of a child process that runs the moves
+def measure_rss(move_class, positions, hold):
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(rfd)
+        gc.collect()
+        start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        held = run_moves(move_class, positions, hold)
+        end_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(wfd, str(end_rss - start_rss).encode())
+        os._exit(0)
+    os.close(wfd)
+    data = os.read(rfd, 64)
+    os.close(rfd)
+    os.waitpid(pid, 0)
+    return int(data)
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--moves", type="int", dest="moves", default=10000,
+                    help="number of moves to generate")
+    opts.add_option("-q", "--queue", type="int", dest="hold", default=10000,
+                    help="number of moves kept alive")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    positions = gen_positions(options.moves)
+    scale = 10000. / options.moves
+    sys.stdout.write("Per 10000 moves (%d moves kept alive):\n" % (
+        options.hold,))
+    sys.stdout.write("%8s %10s %10s %12s %12s %12s %8s\n" % (
+        "class", "time(ms)", "+rss(KiB)", "held(KiB)", "blocks", "peak(KiB)",
+        "gc"))
+    classes = [("dict", DictMove), ("slots", SlotsMove)]
+    # Measure RSS first, before the parent process heap has grown
+    rss_growth = [measure_rss(cls, positions, options.hold)
+                  for name, cls in classes]
+    for (name, cls), rss in zip(classes, rss_growth):
+        res = measure(cls, positions, options.hold)
+        sys.stdout.write("%8s %10.1f %10d %12s %12s %12s %8s\n" % (
+            name, res['time'] * 1000. * scale, rss,
+            "%.1f" % (res['held_bytes'] * scale / 1024.,)
+            if 'held_bytes' in res else "-",
+            "%.0f" % (res['held_blocks'] * scale,)
+            if 'held_blocks' in res else "-",
+            "%.1f" % (res['peak_bytes'] * scale / 1024.,)
+            if 'peak_bytes' in res else "-",
+            "%d" % (res['gc'],) if 'gc' in res else "-"))
+
+if __name__ == '__main__':
+    main()
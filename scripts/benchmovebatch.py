@@ -0,0 +1,229 @@
+#!/usr/bin/env python2
+# Benchmark of per-move and batched submission of moves to the C helper
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, math, random
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from klippy import chelper, toolhead
+from klippy.kinematics import extruder
+
+MCU_FREQ = 16000000.
+MOVE_FLUSH_TIME = .050
+START_POS = [100., 100., .2, 0.]
+
+######################################################################
+# Simulated printer
+######################################################################
+
+# Count the calls made to the C helper
+class CountingFFI:
+    def __init__(self, ffi_lib):
+        self.ffi_lib = ffi_lib
+        self.calls = 0
+    def __getattr__(self, name):
+        func = getattr(self.ffi_lib, name)
+        def wrapper(*args):
+            self.calls += 1
+            return func(*args)
+        return wrapper
+
+# Minimal versions of the MCU and MCU_stepper classes
+class BenchMCU:
+    def __init__(self, ffi_lib, steppersync):
+        self.ffi_lib = ffi_lib
+        self.steppersync = steppersync
+    def get_steppersync(self):
+        return self.steppersync, (0., MCU_FREQ)
+    def flush_moves(self, print_time):
+        clock = int(print_time * MCU_FREQ)
+        if clock < 0:
+            return
+        ret = self.ffi_lib.steppersync_flush(self.steppersync, clock)
+        if ret:
+            raise Exception("Internal error in stepcompress")
+
+class BenchStepper:
+    def __init__(self, sk, gen_steps):
+        self.sk = sk
+        self.gen_steps = gen_steps
+    def step_itersolve(self, cmove):
+        ret = self.gen_steps(self.sk, cmove)
+        if ret:
+            raise Exception("Internal error in stepcompress")
+
+class BenchKinematics:
+    def __init__(self, steppers):
+        self.steppers = steppers
+    def move(self, print_time, move):
+        for i, stepper in enumerate(self.steppers):
+            if move.axes_d[i]:
+                stepper.step_itersolve(move.cmove)
+
+class BenchExtruder(extruder.DummyExtruder):
+    def __init__(self, stepper, cmove, extruder_move_fill):
+        self.stepper = stepper
+        self.cmove = cmove
+        self.extruder_move_fill = extruder_move_fill
+        self.extrude_pos = 0.
+    def move(self, print_time, move):
+        axis_r = move.axes_d[3] / move.move_d
+        self.extruder_move_fill(
+            self.cmove, print_time, move.accel_t, move.cruise_t,
+            move.decel_t, self.extrude_pos, move.start_v * axis_r,
+            move.cruise_v * axis_r, move.accel * axis_r, 0., 0.)
+        self.stepper.step_itersolve(self.cmove)
+        self.extrude_pos += move.axes_d[3]
+
+class BenchToolHead:
+    def __init__(self, step_dist, batch):
+        ffi_main, ffi_lib = chelper.get_ffi()
+        self.ffi = CountingFFI(ffi_lib)
+        self.outfile = open(os.devnull, 'wb')
+        self.serialqueue = ffi_lib.serialqueue_alloc(self.outfile.fileno(), 1)
+        ffi_lib.serialqueue_set_clock_est(
+            self.serialqueue, 1000000000000., ffi_lib.get_monotonic(), 0)
+        self.sc_list = sc_list = []
+        self.sks = sks = []
+        for oid, alloc, params in [
+                (0, 'cartesian_stepper_alloc', (b'x',)),
+                (1, 'cartesian_stepper_alloc', (b'y',)),
+                (2, 'cartesian_stepper_alloc', (b'z',)),
+                (3, 'extruder_stepper_alloc', ())]:
+            sc = ffi_main.gc(ffi_lib.stepcompress_alloc(oid),
+                             ffi_lib.stepcompress_free)
+            ffi_lib.stepcompress_fill(sc, 25, 0, 10, 11)
+            sk = ffi_main.gc(getattr(ffi_lib, alloc)(*params), ffi_lib.free)
+            ffi_lib.itersolve_set_stepcompress(sk, sc, step_dist)
+            ffi_lib.itersolve_set_commanded_pos(
+                sk, ffi_lib.itersolve_calc_position_from_coord(
+                    sk, START_POS[0], START_POS[1], START_POS[2]))
+            sc_list.append(sc)
+            sks.append(sk)
+        ffi_lib.itersolve_set_commanded_pos(sks[3], START_POS[3])
+        self.steppersync = ffi_lib.steppersync_alloc(
+            self.serialqueue, sc_list, len(sc_list), 500)
+        ffi_lib.steppersync_set_time(self.steppersync, 0., MCU_FREQ)
+        self.all_mcus = [BenchMCU(self.ffi, self.steppersync)]
+        self.max_accel = 3000.
+        self.max_accel_to_decel = 1500.
+        self.junction_deviation = 5. * (math.sqrt(2.) - 1.) / 3000.
+        self.print_time = .1
+        self.move_queue = toolhead.MoveQueue()
+        self.move_batch = None
+        if batch:
+            self.move_batch = toolhead.MoveBatch(self.all_mcus)
+            self.move_batch.itersolve_gen_steps = self.ffi.itersolve_gen_steps
+            self.move_batch.move_batch_gen_steps = (
+                self.ffi.move_batch_gen_steps)
+            self.move_queue.set_move_batch(self.move_batch)
+            self.cmove = self.move_batch.alloc_move()
+            ecmove = self.move_batch.alloc_move()
+            self.move_fill = self.move_batch.move_fill
+            extruder_move_fill = self.move_batch.extruder_move_fill
+            gen_steps = self.move_batch.gen_steps
+        else:
+            self.cmove = ffi_main.gc(ffi_lib.move_alloc(), ffi_lib.free)
+            ecmove = ffi_main.gc(ffi_lib.move_alloc(), ffi_lib.free)
+            self.move_fill = self.ffi.move_fill
+            extruder_move_fill = self.ffi.extruder_move_fill
+            gen_steps = self.ffi.itersolve_gen_steps
+        steppers = [BenchStepper(sk, gen_steps) for sk in sks]
+        self.kin = BenchKinematics(steppers[:3])
+        self.extruder = BenchExtruder(steppers[3], ecmove, extruder_move_fill)
+        self.move_queue.set_extruder(self.extruder)
+    def get_next_move_time(self):
+        return self.print_time
+    def update_move_time(self, movetime):
+        self.print_time += movetime
+        flush_to_time = self.print_time - MOVE_FLUSH_TIME
+        if self.move_batch is not None:
+            self.move_batch.flush_moves(flush_to_time)
+        else:
+            for m in self.all_mcus:
+                m.flush_moves(flush_to_time)
+    def close(self):
+        ffi_main, ffi_lib = chelper.get_ffi()
+        # Let the background thread write out the queued messages
+        sbuf = ffi_main.new('char[4096]')
+        while 1:
+            ffi_lib.serialqueue_get_stats(self.serialqueue, sbuf, len(sbuf))
+            stats = ffi_main.string(sbuf).decode()
+            if 'ready_bytes=0 stalled_bytes=0' in stats:
+                break
+            time.sleep(.001)
+        ffi_lib.serialqueue_exit(self.serialqueue)
+        ffi_lib.steppersync_free(self.steppersync)
+        ffi_lib.serialqueue_free(self.serialqueue)
+        self.outfile.close()
+
+# Short extruding segments, as generated by slicers for curved perimeters
+def gen_positions(count, length):
+    rnd = random.Random(0)
+    out = []
+    pos = START_POS
+    angle = 0.
+    for i in range(count):
+        angle += rnd.uniform(-.3, .3)
+        seg = rnd.uniform(.1, length)
+        pos = [pos[0] + seg * math.cos(angle), pos[1] + seg * math.sin(angle),
+               pos[2], pos[3] + seg * .03]
+        if not 10. < pos[0] < 190. or not 10. < pos[1] < 190.:
+            angle += math.pi
+        out.append(pos)
+    return out
+
+# Feed the moves through the look-ahead queue and return the elapsed
+# time and the number of calls to the C helper
+def run_moves(positions, speed, step_dist, batch):
+    th = BenchToolHead(step_dist, batch)
+    start_time = time.time()
+    pos = START_POS
+    for newpos in positions:
+        th.move_queue.add_move(toolhead.Move(th, pos, newpos, speed))
+        pos = newpos
+    th.move_queue.flush()
+    elapsed = time.time() - start_time
+    th.close()
+    return elapsed, th.ffi.calls
+
+
+######################################################################
+# Startup
+######################################################################
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--moves", type="int", dest="moves",
+                    default=20000, help="number of moves")
+    opts.add_option("-l", "--length", type="float", dest="length",
+                    default=1., help="maximum segment length (mm)")
+    opts.add_option("-s", "--speed", type="float", dest="speed",
+                    default=60., help="move speed (mm/s)")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    # Build the C helper before timing anything
+    chelper.get_ffi()
+    positions = gen_positions(options.moves, options.length)
+    sys.stdout.write("%d moves (max length %.1fmm, %.0fmm/s)\n" % (
+        len(positions), options.length, options.speed))
+    sys.stdout.write("%-10s %-8s %14s %12s %12s\n" % (
+        "steps", "mode", "C calls/move", "us/move", "overhead"))
+    # With a huge step distance no steps are generated, so the time is
+    # the host overhead of submitting the moves
+    for steps, step_dist in [("none", 1000000.), ("normal", .0125)]:
+        results = {}
+        for mode, batch in [("per-move", False), ("batch", True)]:
+            elapsed, calls = run_moves(positions, options.speed, step_dist,
+                                       batch)
+            results[mode] = elapsed
+            sys.stdout.write("%-10s %-8s %14.2f %12.2f %11.0f%%\n" % (
+                steps, mode, float(calls) / len(positions),
+                elapsed * 1000000. / len(positions),
+                100. * elapsed / results["per-move"]))
+
+if __name__ == '__main__':
+    main()
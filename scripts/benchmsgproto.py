@@ -0,0 +1,113 @@
+#!/usr/bin/env python2
+# Throughput benchmark of the mcu protocol message encoder and decoder
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, json
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from klippy import msgproto, serialhdl, chelper
+
+MESSAGES = {
+    10: "clock clock=%u",
+    11: "queue_step oid=%c interval=%u count=%hu add=%hi",
+    12: "analog_in_state oid=%c next_clock=%u value=%hu",
+    13: "stats count=%u sum=%u sumsq=%u",
+    14: "spi_transfer_response oid=%c response=%*s",
+    15: "end_stop_state oid=%c homing=%c pin=%c",
+    16: "buttons_state oid=%c ack_count=%c state=%*s",
+}
+SAMPLES = [
+    ("clock", [3000000000]),
+    ("queue_step", [3, 25000, 12, -3]),
+    ("analog_in_state", [5, 1234567890, 600]),
+    ("stats", [5000, 300000000, 4000000]),
+    ("spi_transfer_response", [2, [1, 2, 3, 4, 5, 6]]),
+    ("end_stop_state", [4, 1, 0]),
+    ("buttons_state", [6, 17, [0x05]]),
+]
+MODES = [
+    # name, use_native, use_compiled
+    ("python", False, False),
+    ("compiled", False, True),
+    ("native", True, False),
+    ("default", True, True),
+]
+
+def make_parser(use_native, use_compiled):
+    data = {'messages': MESSAGES, 'commands': list(MESSAGES.keys()),
+            'responses': []}
+    mp = msgproto.MessageParser(use_native=use_native,
+                                use_compiled=use_compiled)
+    mp.process_identify(json.dumps(data), decompress=False)
+    return mp
+
+def bench(func, count):
+    start = time.time()
+    for i in range(count):
+        func()
+    return count / (time.time() - start)
+
+class BenchSerial:
+    def __init__(self, mp):
+        self.msgparser = mp
+        self.ffi_main, self.ffi_lib = chelper.get_ffi()
+        self.devnull = open(os.devnull, 'wb')
+        self.serialqueue = self.ffi_lib.serialqueue_alloc(
+            self.devnull.fileno(), 1)
+        self.cmd_queue = self.ffi_lib.serialqueue_alloc_commandqueue()
+    raw_send = serialhdl.SerialReader.__dict__['raw_send']
+    raw_send_params = serialhdl.SerialReader.__dict__['raw_send_params']
+    def close(self):
+        self.ffi_lib.serialqueue_exit(self.serialqueue)
+        self.ffi_lib.serialqueue_free(self.serialqueue)
+        self.ffi_lib.serialqueue_free_commandqueue(self.cmd_queue)
+        self.devnull.close()
+
+def bench_parser(mp, name, params, count):
+    ffi_main, ffi_lib = chelper.get_ffi()
+    mf = mp.messages_by_name[name]
+    cmd = mf.encode(params)
+    block = [len(cmd) + 5, 0x10] + cmd + [0, 0, 0x7e]
+    cblock = ffi_main.new('uint8_t[64]', block)
+    raw = ''.join(map(chr, block))
+    if bytes is not str:
+        raw = raw.encode('latin-1')
+    crc_data = raw[:-3]
+    # Send a command (encode and queue for transmit)
+    ser = BenchSerial(mp)
+    scmd = serialhdl.SerialCommand(ser, ser.cmd_queue, mf)
+    send = bench((lambda: scmd.send(params)), count)
+    ser.close()
+    # Parse a received message (as done in SerialReader._bg_thread)
+    if mp.codec is None:
+        parse = bench((lambda: mp.parse(cblock[0:len(block)])), count)
+    else:
+        parse = bench((lambda: mp.parse_cdata(cblock, len(block))), count)
+    crc = bench((lambda: mp.crc16_ccitt(crc_data)), count)
+    return send, parse, crc
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--count", type="int", dest="count", default=100000,
+                    help="number of iterations per measurement")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    parsers = [(mode, make_parser(use_native, use_compiled))
+               for mode, use_native, use_compiled in MODES]
+    if parsers[-1][1].codec is None:
+        sys.stdout.write("C helper not available\n")
+        return
+    sys.stdout.write("Thousands of operations per second\n")
+    sys.stdout.write("%-22s %-9s %8s %8s %8s\n" % (
+        "message", "mode", "send", "parse", "crc16"))
+    for name, params in SAMPLES:
+        for mode, mp in parsers:
+            res = bench_parser(mp, name, params, options.count)
+            sys.stdout.write("%-22s %-9s %8.0f %8.0f %8.0f\n" % tuple(
+                [name, mode] + [r / 1000. for r in res]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python2
+# Benchmark of the host step pipeline over a corpus of g-code files
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# Each g-code file is processed by a full klippy instance in file
+# output mode (as with "klippy.py -i <gcode> -o <output>").  The time
+# spent in each stage of the step pipeline is reported:
+#   lookahead     - junction and velocity calculations (MoveQueue)
+#   move_fill     - kinematic and extruder processing of each move
+#   gen_steps     - step time generation in the C helper (itersolve)
+#   compress      - step compression into queue_step commands
+#   serial_encode - ordering the encoded commands for transmit
+# The compress and serial_encode times are measured in the C helper
+# (see steppersync_get_stats()).  The results are written as JSON.
+import sys, os, optparse, time, json, glob, logging, tempfile, platform
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from klippy import printer, toolhead, mcu
+
+
+######################################################################
+# Stage timing
+######################################################################
+
+STAGES = ['lookahead', 'move_fill', 'gen_steps', 'compress', 'serial_encode']
+
+# Time the methods of each stage (excluding the time of any nested
+# call to another timed method)
+class StageTimer:
+    def __init__(self):
+        self.times = {}
+        self.calls = {}
+        self.stack = []
+        self.patched = []
+    def wrap(self, cls, name, stage):
+        orig = cls.__dict__[name]
+        self.times[stage] = 0.
+        self.calls[stage] = 0
+        def wrapper(*args, **kwargs):
+            start_time = time.time()
+            self.stack.append(0.)
+            try:
+                return orig(*args, **kwargs)
+            finally:
+                elapsed = time.time() - start_time
+                nested_time = self.stack.pop()
+                self.times[stage] += elapsed - nested_time
+                self.calls[stage] += 1
+                if self.stack:
+                    self.stack[-1] += elapsed
+        setattr(cls, name, wrapper)
+        self.patched.append((cls, name, orig))
+    def restore(self):
+        for cls, name, orig in reversed(self.patched):
+            setattr(cls, name, orig)
+        del self.patched[:]
+
+def setup_timers():
+    st = StageTimer()
+    for cls in [toolhead.MoveQueue, toolhead.CMoveQueue]:
+        for name in ['add_move', 'flush']:
+            if name in cls.__dict__:
+                st.wrap(cls, name, 'lookahead')
+    st.wrap(toolhead.Move, 'move', 'move_fill')
+    # Calls into the C helper that generate, compress, and transmit
+    # steps (the split between them is reported by the C code)
+    st.wrap(toolhead.MoveBatch, 'flush', 'c_helper')
+    st.wrap(mcu.MCU, 'flush_moves', 'c_helper')
+    return st
+
+# Record the step statistics of each mcu before it is disconnected
+def setup_mcu_stats():
+    mcu_stats = {}
+    orig = mcu.MCU._disconnect
+    def disconnect(self):
+        if self._steppersync is not None and self._name not in mcu_stats:
+            stats = "%s %s" % (self._serial.stats(0.), self.step_stats())
+            mcu_stats[self._name] = dict(
+                [s.split('=', 1) for s in stats.split() if '=' in s])
+        orig(self)
+    mcu.MCU._disconnect = disconnect
+    def restore():
+        mcu.MCU._disconnect = orig
+    return mcu_stats, restore
+
+
+######################################################################
+# Pipeline run
+######################################################################
+
+def run_file(config_file, dictionary, gcode_file, output_file):
+    start_args = {
+        'config_file': config_file, 'start_reason': 'startup',
+        'debuginput': gcode_file, 'debugoutput': output_file,
+        'dictionary': dictionary, 'software_version': 'benchpipeline'}
+    st = setup_timers()
+    mcu_stats, restore_mcu_stats = setup_mcu_stats()
+    input_file = open(gcode_file, 'rb')
+    try:
+        p = printer.Printer(input_file.fileno(), None, start_args)
+        start_time = time.time()
+        start_cpu = os.times()
+        res = p.run()
+        end_cpu = os.times()
+        wall_time = time.time() - start_time
+    finally:
+        input_file.close()
+        restore_mcu_stats()
+        st.restore()
+    if res != 'exit':
+        raise Exception("klippy exited with '%s' on %s" % (res, gcode_file))
+    toolhead_obj = p.lookup_object('toolhead')
+    print_time = toolhead_obj.get_status(0.)['print_time']
+    # Combine the statistics of all mcus
+    steps = queue_step = bytes_write = 0
+    compress_time = send_time = 0.
+    for stats in mcu_stats.values():
+        steps += int(stats['steps'])
+        queue_step += int(stats['queue_step'])
+        bytes_write += int(stats['bytes_write'])
+        compress_time += float(stats['compress_time'])
+        send_time += float(stats['send_time'])
+    stages = {
+        'lookahead': st.times['lookahead'],
+        'move_fill': st.times['move_fill'],
+        'gen_steps': max(0., st.times['c_helper'] - compress_time - send_time),
+        'compress': compress_time,
+        'serial_encode': send_time}
+    return {
+        'file': os.path.basename(gcode_file),
+        'moves': st.calls['move_fill'],
+        'print_time': print_time,
+        'wall_time': wall_time,
+        'cpu_time': (end_cpu[0] + end_cpu[1]) - (start_cpu[0] + start_cpu[1]),
+        'stages': stages,
+        'steps': steps,
+        'queue_step': queue_step,
+        'steps_per_msg': float(steps) / max(1, queue_step),
+        'bytes': bytes_write,
+        'bytes_per_second': bytes_write / max(print_time, .001),
+        'steps_per_host_second': steps / max(sum(stages.values()), .000001),
+    }
+
+def main():
+    usage = "%prog [options] -d <dictionary> [gcode files]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--config", dest="config",
+                    default=os.path.join(os.path.dirname(__file__), '..',
+                                         'config', 'example.cfg'),
+                    help="printer config file")
+    opts.add_option("-d", "--dictionary", dest="dictionary",
+                    help="mcu protocol dictionary file")
+    opts.add_option("-o", "--output", dest="output", default="-",
+                    help="file to write JSON results to (default stdout)")
+    opts.add_option("-r", "--repeat", type="int", dest="repeat", default=1,
+                    help="number of runs of each file (best is reported)")
+    opts.add_option("-l", "--logfile", dest="logfile",
+                    help="write klippy log to file")
+    options, args = opts.parse_args()
+    if options.dictionary is None:
+        opts.error("A dictionary file must be specified")
+    if not args:
+        testdir = os.path.join(os.path.dirname(__file__), '..', 'test',
+                               'klippy')
+        args = sorted(glob.glob(os.path.join(testdir, '*.gcode')))
+    if options.logfile:
+        logging.basicConfig(filename=options.logfile, level=logging.INFO)
+    else:
+        logging.basicConfig(level=logging.ERROR)
+    tmpdir = tempfile.mkdtemp(prefix='benchpipeline')
+    output_file = os.path.join(tmpdir, 'output')
+    results = []
+    for gcode_file in args:
+        best = None
+        for i in range(options.repeat):
+            res = run_file(options.config, options.dictionary, gcode_file,
+                           output_file)
+            if best is None or res['cpu_time'] < best['cpu_time']:
+                best = res
+        results.append(best)
+        sys.stderr.write("%-20s %7d moves %10d steps %7.2f steps/msg"
+                         " %8.0f B/s %7.3fs\n" % (
+                             best['file'], best['moves'], best['steps'],
+                             best['steps_per_msg'], best['bytes_per_second'],
+                             best['cpu_time']))
+    os.remove(output_file)
+    os.rmdir(tmpdir)
+    data = {
+        'config': os.path.basename(options.config),
+        'dictionary': os.path.basename(options.dictionary),
+        'python': platform.python_version(),
+        'stages': STAGES,
+        'results': results}
+    if options.output == '-':
+        f = sys.stdout
+    else:
+        f = open(options.output, 'w')
+    json.dump(data, f, indent=2, separators=(',', ': '), sort_keys=True)
+    f.write("\n")
+    if f is not sys.stdout:
+        f.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python2
+# Micro-benchmark of the klippy reactor timer dispatch
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, struct, threading, random
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from klippy import reactor, util
+
+REACTORS = [("select", "SelectReactor"), ("poll", "PollReactor"),
+            ("epoll", "EPollReactor")]
+
+
+######################################################################
+# Timer dispatch
+######################################################################
+
+# Measure the cost of one timer wake-up with 'count' idle timers queued
+def bench_timers(reactor_class, count, iterations):
+    r = reactor_class()
+    far = 1000000.
+    for i in range(count):
+        r.register_timer((lambda e: far), far + i)
+    def active(eventtime):
+        return eventtime + .001
+    r.register_timer(active, 0.)
+    # Dispatch one active timer per wake-up
+    start = time.time()
+    eventtime = 0.
+    for i in range(iterations):
+        eventtime += .001
+        r._check_timers(eventtime)
+    dispatch_time = (time.time() - start) / iterations
+    # Register/unregister churn (as done by each reactor.pause() call)
+    start = time.time()
+    for i in range(iterations):
+        t = r.register_timer(active, eventtime + .5)
+        r.unregister_timer(t)
+    churn_time = (time.time() - start) / iterations
+    return dispatch_time, churn_time
+
+
+######################################################################
+# File descriptor dispatch latency
+######################################################################
+
+# Measure the delay from a background thread writing to one of 'numfds'
+# pipes until the reactor invokes the matching callback.  'numtimers'
+# periodic timers are active and half of them call pause() on every
+# invocation to exercise greenlet churn.
+def bench_fds(reactor_class, numfds, numtimers, duration, rate):
+    r = reactor_class()
+    latencies = []
+    pipes = []
+    def make_reader(rfd):
+        def reader(eventtime):
+            data = os.read(rfd, 4096)
+            for i in range(0, len(data) - 7, 8):
+                sent = struct.unpack('d', data[i:i+8])[0]
+                latencies.append(eventtime - sent)
+        return reader
+    for i in range(numfds):
+        rfd, wfd = os.pipe()
+        util.set_nonblock(rfd)
+        r.register_fd(rfd, make_reader(rfd))
+        pipes.append((rfd, wfd))
+    def make_timer(period, do_pause):
+        def timer_cb(eventtime):
+            if do_pause:
+                eventtime = r.pause(eventtime + period * .5)
+            return eventtime + period
+        return timer_cb
+    for i in range(numtimers):
+        r.register_timer(make_timer(.001 + .0001 * i, i & 1), r.NOW)
+    # Background writer
+    done = []
+    def writer():
+        rnd = random.Random(0)
+        while not done:
+            rfd, wfd = pipes[rnd.randrange(len(pipes))]
+            os.write(wfd, struct.pack('d', r.monotonic()))
+            time.sleep(1. / rate)
+    def stop(eventtime):
+        r.end()
+        return r.NEVER
+    r.register_timer(stop, r.monotonic() + duration)
+    t = threading.Thread(target=writer)
+    t.start()
+    try:
+        r.run()
+    finally:
+        done.append(1)
+        t.join()
+        for rfd, wfd in pipes:
+            os.close(rfd)
+            os.close(wfd)
+    return latencies
+
+def percentile(data, pct):
+    if not data:
+        return 0.
+    return data[min(len(data) - 1, int(len(data) * pct / 100.))]
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--iterations", type="int", dest="iterations",
+                    default=20000, help="wake-ups per measurement")
+    opts.add_option("-t", "--timers", type="string", dest="timers",
+                    default="1,10,100,1000,5000",
+                    help="comma separated list of idle timer counts")
+    opts.add_option("-f", "--fds", type="int", dest="fds", default=32,
+                    help="number of file descriptors for the latency test")
+    opts.add_option("-m", "--active-timers", type="int", dest="active",
+                    default=20, help="number of active timers during"
+                    " the latency test")
+    opts.add_option("-d", "--duration", type="float", dest="duration",
+                    default=2., help="seconds per latency measurement")
+    opts.add_option("-r", "--rate", type="float", dest="rate",
+                    default=2000., help="fd writes per second")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    counts = [int(c) for c in options.timers.split(',')]
+    sys.stdout.write("%8s %8s %14s %14s\n" % (
+        "reactor", "timers", "dispatch(us)", "reg+unreg(us)"))
+    for name, cls in REACTORS:
+        reactor_class = getattr(reactor, cls)
+        for count in counts:
+            dispatch_time, churn_time = bench_timers(
+                reactor_class, count, options.iterations)
+            sys.stdout.write("%8s %8d %14.3f %14.3f\n" % (
+                name, count, dispatch_time * 1000000.,
+                churn_time * 1000000.))
+    sys.stdout.write("\nfd dispatch latency (%d fds, %d active timers):\n"
+                     % (options.fds, options.active))
+    sys.stdout.write("%8s %8s %10s %10s %10s %10s\n" % (
+        "reactor", "events", "p50(us)", "p90(us)", "p99(us)", "max(us)"))
+    for name, cls in REACTORS:
+        latencies = sorted(bench_fds(
+            getattr(reactor, cls), options.fds, options.active,
+            options.duration, options.rate))
+        sys.stdout.write("%8s %8d %10.1f %10.1f %10.1f %10.1f\n" % (
+            name, len(latencies), percentile(latencies, 50) * 1000000.,
+            percentile(latencies, 90) * 1000000.,
+            percentile(latencies, 99) * 1000000.,
+            percentile(latencies, 100) * 1000000.))
+    sys.stdout.write("\nDefault reactor: %s\n" % (reactor.Reactor.__name__,))
+
+if __name__ == '__main__':
+    main()
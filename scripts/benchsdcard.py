@@ -0,0 +1,189 @@
+#!/usr/bin/env python2
+# Throughput benchmark of the virtual sdcard file reader
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, random, tempfile, shutil
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from klippy import reactor, gcode
+from klippy.extras import virtual_sdcard
+
+# Write a synthetic g-code file of approximately 'size' bytes
+def gen_file(filename, size):
+    rnd = random.Random(0)
+    lines = []
+    for i in range(40000):
+        lines.append("G1 X%.3f Y%.3f E%.5f\n" % (
+            rnd.uniform(0, 200), rnd.uniform(0, 200), rnd.random()))
+    block = ''.join(lines).encode()
+    f = open(filename, 'wb')
+    written = 0
+    while written < size:
+        f.write(block)
+        written += len(block)
+    f.close()
+
+# Minimal printer objects needed to run VirtualSD.work_handler()
+class BenchGCode:
+    error = Exception
+    def __init__(self):
+        self.line_count = 0
+    def register_command(self, cmd, func, *args, **kwargs):
+        pass
+    def respond(self, msg):
+        pass
+    def respond_error(self, msg):
+        sys.stdout.write("%s\n" % (msg,))
+    def has_pending_input(self):
+        return False
+    def process_batch(self, commands):
+        count = 0
+        for line in commands:
+            count += 1
+        self.line_count += count
+        return True
+
+class BenchToolHead:
+    def get_stall_count(self):
+        return 0
+
+# The real g-code parser with moves discarded and other commands ignored
+def make_gcode_parser(printer):
+    gp = gcode.GCodeParser(printer, -1)
+    for cmd, func in gp.ready_gcode_handlers.items():
+        if func is not gp.move_handler:
+            gp.ready_gcode_handlers[cmd] = (lambda params: None)
+    gp.is_printer_ready = True
+    gp.gcode_handlers = gp.ready_gcode_handlers
+    gp.move_with_transform = (lambda pos, speed: None)
+    gp.position_with_transform = (lambda: [0., 0., 0., 0.])
+    return gp
+
+class BenchPrinter:
+    def __init__(self, parse):
+        self.reactor = reactor.Reactor()
+        self.objects = {'toolhead': BenchToolHead()}
+        if parse:
+            self.objects['gcode'] = make_gcode_parser(self)
+        else:
+            self.objects['gcode'] = BenchGCode()
+    def get_reactor(self):
+        return self.reactor
+    def get_start_args(self):
+        return {'debuginput': 'bench'}
+    def lookup_object(self, name, default=None):
+        return self.objects[name]
+    def invoke_shutdown(self, msg):
+        pass
+
+class BenchConfig:
+    def __init__(self, path, cache_path, parse):
+        self.printer = BenchPrinter(parse)
+        self.options = {'path': path, 'cache_path': cache_path}
+    def get_printer(self):
+        return self.printer
+    def get(self, name, default=None):
+        return self.options[name]
+
+# Report the longest time spent in a single call to 'func'
+class MaxTime:
+    def __init__(self, func):
+        self.func = func
+        self.max_time = 0.
+    def __call__(self, *args):
+        start = time.time()
+        res = self.func(*args)
+        self.max_time = max(self.max_time, time.time() - start)
+        return res
+
+# The reader as it was before the background read-ahead was added
+def bench_blocking(filename):
+    f = open(filename, 'rb')
+    read = MaxTime(f.read)
+    line_count = 0
+    partial_input = b""
+    start = time.time()
+    while 1:
+        data = read(8192)
+        if not data:
+            break
+        lines = data.split(b'\n')
+        lines[0] = partial_input + lines[0]
+        partial_input = lines.pop()
+        lines.reverse()
+        while lines:
+            lines.pop()
+            line_count += 1
+    f.close()
+    return line_count, time.time() - start, read.max_time
+
+def bench_virtual_sdcard(filename, cache_path=None, parse=False):
+    config = BenchConfig(os.path.dirname(filename), cache_path, parse)
+    vsd = virtual_sdcard.VirtualSD(config)
+    vsd.printer_state('ready')
+    vsd.cmd_M23({'#original': "M23 " + os.path.basename(filename)})
+    get_data = []
+    orig_open_reader = vsd.open_reader
+    def open_reader():
+        reader, writer = orig_open_reader()
+        reader.get_data = MaxTime(reader.get_data)
+        get_data.append(reader.get_data)
+        return reader, writer
+    vsd.open_reader = open_reader
+    start = time.time()
+    vsd.cmd_M24({})
+    vsd.work_handler(vsd.reactor.monotonic())
+    elapsed = time.time() - start
+    line_count = getattr(config.printer.objects['gcode'], 'line_count', None)
+    return line_count, elapsed, get_data[0].max_time
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-s", "--size", type="int", dest="size", default=500,
+                    help="size of the generated file (MB)")
+    opts.add_option("-f", "--file", type="string", dest="filename",
+                    help="use an existing g-code file")
+    opts.add_option("-p", "--parse", action="store_true", dest="parse",
+                    help="also run the g-code parser (with and without"
+                    " the pre-parsed cache)")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    tmpdir = tempfile.mkdtemp()
+    filename = options.filename
+    if filename is None:
+        filename = os.path.join(tmpdir, "bench.gcode")
+        gen_file(filename, options.size * 1024 * 1024)
+    try:
+        size = os.path.getsize(filename)
+        sys.stdout.write("File size %.1fMB\n" % (size / (1024. * 1024.),))
+        sys.stdout.write("%-16s %10s %10s %12s %14s\n" % (
+            "reader", "lines", "MB/s", "Klines/s", "max block(ms)"))
+        tests = [("blocking read", bench_blocking),
+                 ("virtual_sdcard", bench_virtual_sdcard)]
+        if options.parse:
+            cache_path = os.path.join(tmpdir, "cache")
+            os.mkdir(cache_path)
+            tests += [
+                ("text+gcode", (lambda fname: bench_virtual_sdcard(
+                    fname, None, True))),
+                ("build+gcode", (lambda fname: bench_virtual_sdcard(
+                    fname, cache_path, True))),
+                ("cached+gcode", (lambda fname: bench_virtual_sdcard(
+                    fname, cache_path, True)))]
+        total_lines = None
+        for name, func in tests:
+            line_count, elapsed, max_block = func(filename)
+            if line_count is None:
+                line_count = total_lines
+            total_lines = line_count
+            sys.stdout.write("%-16s %10d %10.1f %12.0f %14.3f\n" % (
+                name, line_count, size / (1024. * 1024. * elapsed),
+                line_count / (1000. * elapsed), max_block * 1000.))
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
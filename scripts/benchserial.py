@@ -0,0 +1,265 @@
+#!/usr/bin/env python2
+# Benchmark of the response dispatch of the serial background thread
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# A fake micro-controller (in a child process) answers the identify
+# requests of the host and then floods it with analog_in_state
+# responses over a pty.  The host handles the responses either in the
+# serial background thread or in batches in the reactor, while the
+# reactor runs a periodic busy task (as with move processing).  The
+# serial background thread pulls up to a given number of responses
+# from the C helper at each wakeup.  The time a response is sent is
+# encoded in its next_clock parameter so that the latency of each
+# response can be measured.
+import sys, os, optparse, time, json, zlib, select, tty, traceback
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from klippy import chelper, msgproto, reactor, serialhdl
+
+DICTIONARY = {
+    'messages': {
+        0: "identify_response offset=%u data=%.*s",
+        1: "identify offset=%u count=%c",
+        2: "analog_in_state oid=%c next_clock=%u value=%hu",
+    },
+    'commands': [1],
+    'responses': [0, 2],
+    'config': {'CLOCK_FREQ': 1000000},
+    'version': 'benchserial',
+}
+
+
+######################################################################
+# Fake micro-controller
+######################################################################
+
+# Encode a message block (a block without a command is an ack)
+def encode_block(seq, cmd=()):
+    block = bytearray([msgproto.MESSAGE_MIN + len(cmd),
+                       (seq & msgproto.MESSAGE_SEQ_MASK)
+                       | msgproto.MESSAGE_DEST])
+    block.extend(cmd)
+    block.extend(bytearray(msgproto.crc16_ccitt(str(block))))
+    block.append(ord(msgproto.MESSAGE_SYNC))
+    return block
+
+class FakeMCU:
+    def __init__(self, fd, count, rate):
+        self.fd = fd
+        self.count = count
+        self.rate = rate
+        self.mp = msgproto.MessageParser(use_native=False)
+        self.mp.process_identify(json.dumps(DICTIONARY), decompress=False)
+        self.identify_data = zlib.compress(json.dumps(DICTIONARY))
+        self.identify_done = False
+        self.seq = 0
+        self.input = bytearray()
+        self.get_monotonic = chelper.get_ffi()[1].get_monotonic
+    def write(self, cmds):
+        # Each response is sent in its own message block
+        data = bytearray()
+        for cmd in cmds:
+            data.extend(encode_block(self.seq, cmd))
+        os.write(self.fd, str(data))
+    def handle_input(self):
+        self.input.extend(os.read(self.fd, 4096))
+        while self.input:
+            if self.input[0] == ord(msgproto.MESSAGE_SYNC):
+                del self.input[0]
+                continue
+            msglen = self.input[0]
+            if len(self.input) < msglen:
+                break
+            block = self.input[:msglen]
+            del self.input[:msglen]
+            self.seq = (block[msgproto.MESSAGE_POS_SEQ] + 1)
+            params = self.mp.parse(block)
+            if params['#name'] != 'identify':
+                os.write(self.fd, str(encode_block(self.seq)))
+                continue
+            offset = params['offset']
+            data = self.identify_data[offset:offset+params['count']]
+            if not data:
+                self.identify_done = True
+            mid = self.mp.messages_by_name['identify_response']
+            self.write([mid.encode([offset, data])])
+    def run(self):
+        # Answer the identify requests
+        while not self.identify_done:
+            select.select([self.fd], [], [])
+            self.handle_input()
+        time.sleep(.200)
+        # Flood the host with analog_in_state responses
+        mid = self.mp.messages_by_name['analog_in_state']
+        per_write = 16
+        start_time = self.get_monotonic()
+        sent = 0
+        while sent < self.count:
+            if self.rate:
+                next_time = start_time + sent / self.rate
+                delay = next_time - self.get_monotonic()
+                if delay > 0.:
+                    time.sleep(delay)
+            cmds = []
+            for i in range(min(per_write, self.count - sent)):
+                clock = int(self.get_monotonic() * 1000000.) & 0xffffffff
+                cmds.append(mid.encode([0, clock, sent & 0xffff]))
+                sent += 1
+            self.write(cmds)
+            if select.select([self.fd], [], [], 0.)[0]:
+                self.handle_input()
+        # Keep acking until the host disconnects
+        while 1:
+            try:
+                select.select([self.fd], [], [])
+                self.handle_input()
+            except OSError:
+                break
+
+def start_fake_mcu(count, rate):
+    master_fd, slave_fd = os.openpty()
+    tty.setraw(slave_fd)
+    pid = os.fork()
+    if not pid:
+        os.close(slave_fd)
+        try:
+            FakeMCU(master_fd, count, rate).run()
+        except:
+            traceback.print_exc()
+        os._exit(0)
+    os.close(master_fd)
+    return pid, os.ttyname(slave_fd), slave_fd
+
+
+######################################################################
+# Host
+######################################################################
+
+class Bench:
+    def __init__(self, count, rate, batch, pull, busy_time):
+        self.count = count
+        self.batch = batch
+        self.busy_time = busy_time
+        self.pid, self.ptyname, self.slave_fd = start_fake_mcu(count, rate)
+        self.reactor = reactor.Reactor()
+        self.serial = serialhdl.SerialReader(self.reactor, self.ptyname, 0)
+        self.serial.PULL_BATCH_SIZE = pull
+        self.latencies = []
+        self.start_time = self.end_time = None
+        self.busy_timer = None
+        self.timer_late = []
+        self.result = None
+    def handle_analog_in_state(self, params):
+        now = self.serial.ffi_lib.get_monotonic()
+        if self.start_time is None:
+            self.start_time = now
+        sent = params['next_clock']
+        now_clock = int(now * 1000000.) & 0xffffffff
+        self.latencies.append(((now_clock - sent) & 0xffffffff) / 1000000.)
+        if len(self.latencies) >= self.count:
+            self.end_time = now
+    def busy_event(self, eventtime):
+        # Simulate the main thread work of a busy printer
+        self.timer_late.append(self.reactor.monotonic() - eventtime)
+        end_time = time.time() + self.busy_time
+        while time.time() < end_time:
+            pass
+        return eventtime + .010
+    def run_bench(self, eventtime):
+        self.serial.connect()
+        self.serial.register_callback(self.handle_analog_in_state,
+                                      'analog_in_state', 0, self.batch)
+        self.busy_timer = self.reactor.register_timer(
+            self.busy_event, self.reactor.NOW)
+        timeout = self.reactor.monotonic() + 60.
+        while self.end_time is None and self.reactor.monotonic() < timeout:
+            self.reactor.pause(self.reactor.monotonic() + .010)
+        self.reactor.unregister_timer(self.busy_timer)
+        stats = self.serial.stats(self.reactor.monotonic())
+        self.serial.disconnect()
+        self.result = stats
+        self.reactor.end()
+    def run(self):
+        start_cpu = os.times()
+        self.reactor.register_callback(self.run_bench)
+        self.reactor.run()
+        end_cpu = os.times()
+        os.close(self.slave_fd)
+        os.waitpid(self.pid, 0)
+        lat = sorted(self.latencies)
+        if not lat:
+            raise Exception("No responses received")
+        def percentile(p):
+            return lat[min(len(lat) - 1, int(len(lat) * p))]
+        elapsed = (self.end_time or self.reactor.monotonic()) - self.start_time
+        timer_late = sorted(self.timer_late)
+        return {
+            'received': len(lat),
+            'msgs_per_second': len(lat) / max(elapsed, .000001),
+            'latency_avg': sum(lat) / len(lat),
+            'latency_p50': percentile(.50),
+            'latency_p99': percentile(.99),
+            'latency_max': lat[-1],
+            'timer_late_max': timer_late[-1] if timer_late else 0.,
+            'host_cpu_per_msg': ((end_cpu[0] + end_cpu[1])
+                                 - (start_cpu[0] + start_cpu[1])) / len(lat),
+            'serial_stats': self.result,
+        }
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--count", type="int", dest="count",
+                    default=100000, help="number of responses")
+    opts.add_option("-r", "--rates", type="string", dest="rates",
+                    default="0,5000",
+                    help="responses per second to test (0 is unlimited)")
+    opts.add_option("-p", "--pull", type="string", dest="pull",
+                    default="1,64",
+                    help="responses pulled per background thread wakeup")
+    opts.add_option("-b", "--busy", type="float", dest="busy",
+                    default=.002,
+                    help="reactor busy time every 10ms (in seconds)")
+    opts.add_option("-j", "--json", dest="json",
+                    help="write the results as JSON to the given file")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    chelper.get_ffi()
+    rates = [float(r) for r in options.rates.split(',')]
+    pulls = [int(p) for p in options.pull.split(',')]
+    sys.stdout.write("%d responses, reactor busy %.1fms every 10ms\n" % (
+        options.count, options.busy * 1000.))
+    sys.stdout.write("%-9s %-8s %5s %10s %9s %9s %9s %9s %9s %7s\n" % (
+        "rate", "dispatch", "pull", "msgs/s", "avg ms", "p50 ms", "p99 ms",
+        "max ms", "late ms", "cpu us"))
+    results = []
+    for rate in rates:
+        for dispatch, batch in [("thread", False), ("batch", True)]:
+            for pull in pulls:
+                res = Bench(options.count, rate, batch, pull,
+                            options.busy).run()
+                res.update({'rate': rate, 'dispatch': dispatch,
+                            'pull': pull})
+                results.append(res)
+                sys.stdout.write(
+                    "%-9s %-8s %5d %10.0f %9.3f %9.3f %9.3f %9.3f %9.3f"
+                    " %7.1f\n" % (
+                        rate and "%.0f" % (rate,) or "max", dispatch, pull,
+                        res['msgs_per_second'], res['latency_avg'] * 1000.,
+                        res['latency_p50'] * 1000.,
+                        res['latency_p99'] * 1000.,
+                        res['latency_max'] * 1000.,
+                        res['timer_late_max'] * 1000.,
+                        res['host_cpu_per_msg'] * 1000000.))
+    if options.json:
+        f = open(options.json, 'w')
+        json.dump(results, f, indent=2, separators=(',', ': '),
+                  sort_keys=True)
+        f.write("\n")
+        f.close()
+
+if __name__ == '__main__':
+    main()
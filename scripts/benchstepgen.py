@@ -0,0 +1,198 @@
+#!/usr/bin/env python2
+# Benchmark of serial, parallel, and analytic step generation
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, math, random, collections
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from klippy import chelper, toolhead
+from klippy.kinematics import extruder
+
+MCU_FREQ = 16000000.
+
+def delta_steppers():
+    out = []
+    for angle in [210., 330., 90.]:
+        tx = math.cos(math.radians(angle)) * 140.
+        ty = math.sin(math.radians(angle)) * 140.
+        out.append(('delta_stepper_alloc', (250.**2, tx, ty), .01))
+    return out
+
+KINEMATICS = [
+    ('cartesian', [('cartesian_stepper_alloc', (b'x',), .0125),
+                   ('cartesian_stepper_alloc', (b'y',), .0125),
+                   ('cartesian_stepper_alloc', (b'z',), .0025)]),
+    ('corexy', [('corexy_stepper_alloc', (b'+',), .0125),
+                ('corexy_stepper_alloc', (b'-',), .0125),
+                ('cartesian_stepper_alloc', (b'z',), .0025)]),
+    ('delta', delta_steppers()),
+]
+EXTRUDER = ('extruder_stepper_alloc', (), .002)
+SOLVERS = collections.OrderedDict([('iterative', False), ('analytic', True)])
+
+
+######################################################################
+# Move generation
+######################################################################
+
+class BenchToolHead:
+    def __init__(self):
+        self.max_accel = 3000.
+        self.max_accel_to_decel = 1500.
+        self.junction_deviation = 5. * (math.sqrt(2.) - 1.) / 3000.
+        self.extruder = extruder.DummyExtruder()
+        self.cmove = None
+        self.moves = []
+
+class RecordMove(toolhead.Move):
+    def move(self):
+        self.toolhead.moves.append((
+            self.start_pos, self.axes_d, self.accel_t, self.cruise_t,
+            self.decel_t, self.start_v, self.cruise_v, self.accel))
+
+def gen_moves(count, max_length, speed):
+    rnd = random.Random(0)
+    th = BenchToolHead()
+    mq = toolhead.MoveQueue()
+    mq.set_extruder(th.extruder)
+    pos = [0., 0., 20., 0.]
+    for i in range(count):
+        angle = rnd.uniform(0., 2. * math.pi)
+        length = rnd.uniform(.1, max_length)
+        x = pos[0] + length * math.cos(angle)
+        y = pos[1] + length * math.sin(angle)
+        if x*x + y*y > 80.**2:
+            x, y = -x * .5, -y * .5
+        newpos = [x, y, pos[2], pos[3] + rnd.uniform(0., .1)]
+        mq.add_move(RecordMove(th, pos, newpos, speed))
+        pos = newpos
+    mq.flush()
+    return th.moves
+
+
+######################################################################
+# Step generation
+######################################################################
+
+# Generate the steps of all moves and return (steps, gen_time, total_time)
+def run_stepgen(kin_steppers, moves, threads, analytic=False):
+    ffi_main, ffi_lib = chelper.get_ffi()
+    outfile = open(os.devnull, 'wb')
+    sq = ffi_lib.serialqueue_alloc(outfile.fileno(), 1)
+    ffi_lib.serialqueue_set_clock_est(sq, 1000000000000.,
+                                      ffi_lib.get_monotonic(), 0)
+    sc_list = []
+    steppers = []
+    for oid, (alloc, params, step_dist) in enumerate(
+            kin_steppers + [EXTRUDER]):
+        sc = ffi_main.gc(ffi_lib.stepcompress_alloc(oid),
+                         ffi_lib.stepcompress_free)
+        ffi_lib.stepcompress_fill(sc, 25, 0, 10, 11)
+        sk = ffi_main.gc(getattr(ffi_lib, alloc)(*params), ffi_lib.free)
+        ffi_lib.itersolve_set_stepcompress(sk, sc, step_dist)
+        ffi_lib.itersolve_set_analytic(sk, analytic)
+        ffi_lib.itersolve_set_commanded_pos(
+            sk, ffi_lib.itersolve_calc_position_from_coord(sk, 0., 0., 20.))
+        sc_list.append(sc)
+        steppers.append((sk, step_dist))
+    ss = ffi_lib.steppersync_alloc(sq, sc_list, len(sc_list), 500)
+    ffi_lib.steppersync_set_time(ss, 0., MCU_FREQ)
+    cmove = ffi_main.gc(ffi_lib.move_alloc(), ffi_lib.free)
+    ecmove = ffi_main.gc(ffi_lib.move_alloc(), ffi_lib.free)
+    gen_steps = ffi_lib.itersolve_gen_steps
+    pool = None
+    if threads:
+        pool = ffi_main.gc(ffi_lib.stepgen_pool_alloc(threads),
+                           ffi_lib.stepgen_pool_free)
+        queue = ffi_lib.stepgen_pool_queue
+        gen_steps = lambda sk, m: queue(pool, sk, m)
+    # Approximate step count from the distance each stepper travels
+    steps = 0.
+    last_pos = [ffi_lib.itersolve_get_commanded_pos(sk)
+                for sk, sd in steppers]
+    print_time = .1
+    epos = 0.
+    gen_time = 0.
+    start_time = time.time()
+    for (start_pos, axes_d, accel_t, cruise_t, decel_t, start_v,
+         cruise_v, accel) in moves:
+        gen_start = time.time()
+        ffi_lib.move_fill(
+            cmove, print_time, accel_t, cruise_t, decel_t,
+            start_pos[0], start_pos[1], start_pos[2],
+            axes_d[0], axes_d[1], axes_d[2], start_v, cruise_v, accel)
+        for sk, step_dist in steppers[:-1]:
+            gen_steps(sk, cmove)
+        axis_r = axes_d[3] / math.sqrt(sum([d*d for d in axes_d[:3]]))
+        ffi_lib.extruder_move_fill(
+            ecmove, print_time, accel_t, cruise_t, decel_t, epos,
+            start_v * axis_r, cruise_v * axis_r, accel * axis_r, 0., 0.)
+        gen_steps(steppers[-1][0], ecmove)
+        if pool is not None:
+            ffi_lib.stepgen_pool_flush(pool)
+        gen_time += time.time() - gen_start
+        epos += axes_d[3]
+        print_time += accel_t + cruise_t + decel_t
+        ffi_lib.steppersync_flush(ss, int((print_time - .05) * MCU_FREQ))
+        if pool is None:
+            for i, (sk, step_dist) in enumerate(steppers):
+                pos = ffi_lib.itersolve_get_commanded_pos(sk)
+                steps += abs(pos - last_pos[i]) / step_dist
+                last_pos[i] = pos
+    ffi_lib.steppersync_flush(ss, int((print_time + 1.) * MCU_FREQ))
+    total_time = time.time() - start_time
+    # Let the background thread write out the queued messages
+    sbuf = ffi_main.new('char[4096]')
+    while 1:
+        ffi_lib.serialqueue_get_stats(sq, sbuf, len(sbuf))
+        stats = ffi_main.string(sbuf).decode()
+        if 'ready_bytes=0 stalled_bytes=0' in stats:
+            break
+        time.sleep(.001)
+    ffi_lib.serialqueue_exit(sq)
+    ffi_lib.steppersync_free(ss)
+    ffi_lib.serialqueue_free(sq)
+    outfile.close()
+    return steps, gen_time, total_time
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--moves", type="int", dest="moves", default=5000,
+                    help="number of moves")
+    opts.add_option("-l", "--length", type="float", dest="length",
+                    default=20., help="maximum move length (mm)")
+    opts.add_option("-s", "--speed", type="float", dest="speed",
+                    default=150., help="move speed (mm/s)")
+    opts.add_option("-t", "--threads", type="string", dest="threads",
+                    default="1,2,4", help="pool thread counts to test")
+    opts.add_option("-a", "--solvers", type="string", dest="solvers",
+                    default="iterative,analytic", help="step solvers to test")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    threads = [int(t) for t in options.threads.split(',')]
+    solvers = [s for s in SOLVERS if s in options.solvers.split(',')]
+    moves = gen_moves(options.moves, options.length, options.speed)
+    # Build the C helper before timing anything
+    chelper.get_ffi()
+    sys.stdout.write("%d moves (max length %.1fmm, %.0fmm/s)\n" % (
+        len(moves), options.length, options.speed))
+    sys.stdout.write("%-10s %-10s %-8s %12s %14s %14s\n" % (
+        "kinematics", "solver", "threads", "steps", "gen steps/s",
+        "total steps/s"))
+    for name, kin_steppers in KINEMATICS:
+        steps, gen_time, total_time = run_stepgen(kin_steppers, moves, 0)
+        for solver in solvers:
+            analytic = SOLVERS[solver]
+            for t in [0] + threads:
+                if t or analytic:
+                    s, gen_time, total_time = run_stepgen(
+                        kin_steppers, moves, t, analytic)
+                sys.stdout.write("%-10s %-10s %-8s %12.0f %14.0f %14.0f\n" % (
+                    name, solver, t or "serial", steps, steps / gen_time,
+                    steps / total_time))
+
+if __name__ == '__main__':
+    main()
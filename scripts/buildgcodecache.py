@@ -0,0 +1,33 @@
+#!/usr/bin/env python2
+# Build the virtual_sdcard pre-parsed cache of g-code files
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from klippy.extras import virtual_sdcard
+
+def main():
+    usage = "%prog [options] <cache_path> <gcode files>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-f", "--force", action="store_true", dest="force",
+                    help="rebuild caches that are already valid")
+    options, args = opts.parse_args()
+    if len(args) < 2:
+        opts.error("Incorrect number of arguments")
+    cache_dirname = args[0]
+    for filename in args[1:]:
+        cache_filename = virtual_sdcard.get_cache_filename(
+            cache_dirname, filename)
+        key = virtual_sdcard.get_file_key(filename)
+        if (not options.force and virtual_sdcard.check_cache(
+                cache_filename, key) is not None):
+            sys.stdout.write("%s: cache is up to date\n" % (filename,))
+            continue
+        virtual_sdcard.build_cache(filename, cache_filename)
+        sys.stdout.write("%s: wrote %s (%d bytes)\n" % (
+            filename, cache_filename, os.path.getsize(cache_filename)))
+
+if __name__ == '__main__':
+    main()
@@ -16,8 +16,11 @@ setup(
             "klippy/chelper/kin_cartesian.c",
             "klippy/chelper/kin_corexy.c",
             "klippy/chelper/kin_delta.c",
-            "klippy/chelper/kin_extruder.c"
-        ])
+            "klippy/chelper/kin_extruder.c",
+            "klippy/chelper/lookahead.c",
+            "klippy/chelper/msgblock.c",
+            "klippy/chelper/threadpool.c"
+        ], libraries=['pthread'])
     ],
     url='https://github.com/KevinOConnor/klipper',
     author='Kevin O\'Connor',
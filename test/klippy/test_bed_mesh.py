@@ -0,0 +1,368 @@
+# Tests for the bed_mesh move splitters
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import json, math, random
+import pytest
+
+from klippy.extras import bed_mesh
+
+class FakeConfig:
+    def __init__(self, **kwargs):
+        self.options = kwargs
+        self.accessed = set()
+    def getfloat(self, name, default, minval=None):
+        self.accessed.add(name)
+        return self.options.get(name, default)
+
+def make_mesh(seed, count=5, pps=2, algo='lagrange'):
+    rnd = random.Random(seed)
+    params = {
+        'min_x': 20., 'max_x': 180., 'min_y': 10., 'max_y': 190.,
+        'x_offset': 5., 'y_offset': -3., 'x_count': count, 'y_count': count,
+        'mesh_x_pps': pps, 'mesh_y_pps': pps, 'algo': algo, 'tension': .2}
+    mesh = bed_mesh.ZMesh(params)
+    mesh.build_mesh([[rnd.uniform(-.3, .3) for i in range(count)]
+                     for j in range(count)])
+    return mesh
+
+def make_moves(seed, count):
+    rnd = random.Random(seed)
+    pos = [100., 100., .2, 0.]
+    moves = []
+    for i in range(count):
+        kind = rnd.random()
+        newpos = list(pos)
+        if kind < .05:
+            newpos[2] += rnd.uniform(0., 1.)
+        else:
+            # Include moves that leave the probed area
+            newpos[0] = rnd.uniform(-20., 220.)
+            newpos[1] = rnd.uniform(-20., 220.)
+            if kind < .5:
+                newpos[0] = pos[0]
+            newpos[3] += rnd.uniform(0., 5.)
+        moves.append((pos, newpos))
+        pos = newpos
+    return moves
+
+def split_move(splitter, mesh, prev_pos, next_pos, factor):
+    splitter.set_mesh(mesh)
+    splitter.build_move(prev_pos, next_pos, factor)
+    out = []
+    while not splitter.traverse_complete:
+        out.append(list(splitter.split()))
+    return out
+
+def test_splitter_options():
+    # A config written for the "sample" method is accepted by the
+    # "cell" method
+    for splitter_class in [bed_mesh.MoveSplitter, bed_mesh.CellMoveSplitter]:
+        config = FakeConfig(split_delta_z=.05, move_check_distance=4.)
+        splitter_class(config, None)
+        assert config.accessed == set(['split_delta_z',
+                                       'move_check_distance'])
+
+@pytest.mark.parametrize('seed', range(4))
+def test_cell_splitter(seed):
+    algo = ['lagrange', 'bicubic'][seed % 2]
+    mesh = make_mesh(seed, algo=algo)
+    tolerance = [.01, .025, .1, .5][seed]
+    splitter = bed_mesh.CellMoveSplitter(
+        FakeConfig(split_delta_z=tolerance), None)
+    for i, (prev_pos, next_pos) in enumerate(make_moves(seed, 300)):
+        factor = [1., .5][i % 2]
+        sub_moves = split_move(splitter, mesh, prev_pos, next_pos, factor)
+        # The final position is exact
+        end = list(next_pos)
+        end[2] += factor * mesh.get_z(end[0], end[1])
+        assert sub_moves[-1] == end
+        # Sub-moves stay within the tolerance of the mesh
+        dx, dy = next_pos[0] - prev_pos[0], next_pos[1] - prev_pos[1]
+        if not dx and not dy:
+            assert len(sub_moves) == 1
+            continue
+        start = list(prev_pos)
+        start[2] += factor * mesh.get_z(start[0], start[1])
+        for sub in sub_moves:
+            for j in range(1, 20):
+                pos = [bed_mesh.lerp(j / 20., s, e)
+                       for s, e in zip(start, sub)]
+                if abs(dx) > abs(dy):
+                    t = (pos[0] - prev_pos[0]) / dx
+                else:
+                    t = (pos[1] - prev_pos[1]) / dy
+                base_z = bed_mesh.lerp(t, prev_pos[2], next_pos[2])
+                mesh_z = factor * mesh.get_z(pos[0], pos[1])
+                assert abs(pos[2] - base_z - mesh_z) <= tolerance + 1e-9
+            start = sub
+
+######################################################################
+# Mesh construction and batch lookup
+######################################################################
+
+# Reference implementations of the original (per point) upsampling
+def ref_probed_table(mesh, z_table):
+    return [[0. if ((i % mesh.x_mult) or (j % mesh.y_mult))
+             else z_table[j//mesh.y_mult][i//mesh.x_mult]
+             for i in range(mesh.mesh_x_count)]
+            for j in range(mesh.mesh_y_count)]
+
+def ref_lagrange(mesh, z_table):
+    tbl = ref_probed_table(mesh, z_table)
+    xpts = [mesh.get_x_coordinate(i * mesh.x_mult)
+            for i in range(len(z_table[0]))]
+    ypts = [mesh.get_y_coordinate(j * mesh.y_mult)
+            for j in range(len(z_table))]
+    def calc(lpts, c, get_z):
+        total = 0.
+        for i in range(len(lpts)):
+            n = d = 1.
+            for j in range(len(lpts)):
+                if j != i:
+                    n *= (c - lpts[j])
+                    d *= (lpts[i] - lpts[j])
+            total += get_z(i) * n / d
+        return total
+    for i in range(0, mesh.mesh_y_count, mesh.y_mult):
+        for j in range(mesh.mesh_x_count):
+            if j % mesh.x_mult:
+                tbl[i][j] = calc(xpts, mesh.get_x_coordinate(j),
+                                 lambda k: tbl[i][k*mesh.x_mult])
+    for i in range(mesh.mesh_x_count):
+        for j in range(mesh.mesh_y_count):
+            if j % mesh.y_mult:
+                tbl[j][i] = calc(ypts, mesh.get_y_coordinate(j),
+                                 lambda k: tbl[k*mesh.y_mult][i])
+    return tbl
+
+def ref_cardinal_spline(pts, mult, idx, tension):
+    last_pt = len(pts) - 1 - mult
+    if idx < mult:
+        p0, p1, p2, p3 = pts[0], pts[0], pts[mult], pts[2*mult]
+        t = idx / float(mult)
+    elif idx > last_pt:
+        p0, p1 = pts[last_pt - mult], pts[last_pt]
+        p2 = p3 = pts[last_pt + mult]
+        t = (idx - last_pt) / float(mult)
+    else:
+        i = idx - idx % mult
+        p0, p1, p2, p3 = pts[i-mult], pts[i], pts[i+mult], pts[i+2*mult]
+        t = (idx - i) / float(mult)
+    t2 = t*t
+    t3 = t2*t
+    m1 = tension * (p2 - p0)
+    m2 = tension * (p3 - p1)
+    return (p1 * (2*t3 - 3*t2 + 1) + p2 * (-2*t3 + 3*t2)
+            + m1 * (t3 - 2*t2 + t) + m2 * (t3 - t2))
+
+def ref_bicubic(mesh, z_table):
+    tbl = ref_probed_table(mesh, z_table)
+    c = mesh.probe_params['tension']
+    for y in range(0, mesh.mesh_y_count, mesh.y_mult):
+        row = list(tbl[y])
+        for x in range(mesh.mesh_x_count):
+            if x % mesh.x_mult:
+                tbl[y][x] = ref_cardinal_spline(row, mesh.x_mult, x, c)
+    for x in range(mesh.mesh_x_count):
+        col = [tbl[y][x] for y in range(mesh.mesh_y_count)]
+        for y in range(mesh.mesh_y_count):
+            if y % mesh.y_mult:
+                tbl[y][x] = ref_cardinal_spline(col, mesh.y_mult, y, c)
+    return tbl
+
+def make_z_table(seed, x_count, y_count):
+    rnd = random.Random(seed)
+    return [[rnd.uniform(-.3, .3) for i in range(x_count)]
+            for j in range(y_count)]
+
+def make_params(x_count, y_count, pps, algo):
+    return {
+        'min_x': 20., 'max_x': 180., 'min_y': 10., 'max_y': 190.,
+        'x_offset': 5., 'y_offset': -3., 'x_count': x_count,
+        'y_count': y_count, 'mesh_x_pps': pps, 'mesh_y_pps': pps + 1,
+        'algo': algo, 'tension': .2}
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+@pytest.mark.parametrize('algo', ['lagrange', 'bicubic'])
+@pytest.mark.parametrize('size', [(4, 4), (5, 7), (15, 15)])
+def test_build_mesh(monkeypatch, use_numpy, algo, size):
+    if not use_numpy:
+        monkeypatch.setattr(bed_mesh, 'numpy', None)
+    elif bed_mesh.numpy is None:
+        pytest.skip("numpy not available")
+    x_count, y_count = size
+    z_table = make_z_table(x_count, x_count, y_count)
+    for pps in [1, 2, 4]:
+        mesh = bed_mesh.ZMesh(make_params(x_count, y_count, pps, algo))
+        mesh.build_mesh(z_table)
+        ref = {'lagrange': ref_lagrange, 'bicubic': ref_bicubic}[algo](
+            mesh, z_table)
+        assert len(mesh.mesh_z_table) == len(ref)
+        for row, ref_row in zip(mesh.mesh_z_table, ref):
+            assert row == pytest.approx(ref_row, rel=1e-9, abs=1e-9)
+        # Probed points are not altered
+        for j in range(y_count):
+            for i in range(x_count):
+                assert mesh.mesh_z_table[j * mesh.y_mult][i * mesh.x_mult] \
+                    == z_table[j][i]
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_get_z_many(monkeypatch, use_numpy):
+    if not use_numpy:
+        monkeypatch.setattr(bed_mesh, 'numpy', None)
+    elif bed_mesh.numpy is None:
+        pytest.skip("numpy not available")
+    rnd = random.Random(5)
+    for algo in ['direct', 'lagrange', 'bicubic']:
+        mesh = make_mesh(5, pps=[0, 2, 2][len(algo) % 3], algo=algo)
+        # Include points outside the mesh and exactly on grid lines
+        xs = [rnd.uniform(-20., 220.) for i in range(500)]
+        ys = [rnd.uniform(-20., 220.) for i in range(500)]
+        xs += [mesh.get_x_coordinate(i) for i in range(mesh.mesh_x_count)]
+        ys += [mesh.get_y_coordinate(i) for i in range(mesh.mesh_y_count)]
+        ys = ys[:len(xs)]
+        expected = [mesh.get_z(x, y) for x, y in zip(xs, ys)]
+        assert mesh.get_z_many(xs, ys) == expected
+        for count in [0, 1, 5]:
+            assert mesh.get_z_many(xs[:count], ys[:count]) == expected[:count]
+    mesh = bed_mesh.ZMesh(make_params(5, 5, 2, 'lagrange'))
+    assert mesh.get_z_many([1., 2.], [3., 4.]) == [0., 0.]
+
+# Reference implementation of the original sample splitter
+def ref_sample_split(mesh, prev_pos, next_pos, factor, delta_z, check_dist):
+    cur = list(prev_pos)
+    z_offset = factor * mesh.get_z(prev_pos[0], prev_pos[1])
+    axes_d = [n - p for p, n in zip(prev_pos, next_pos)]
+    length = math.sqrt(sum([d*d for d in axes_d[:3]]))
+    axis_move = [not bed_mesh.isclose(d, 0., abs_tol=1e-10) for d in axes_d]
+    out = []
+    if axis_move[0] or axis_move[1]:
+        checked = 0.
+        while checked + check_dist < length:
+            checked += check_dist
+            t = checked / length
+            for i in range(4):
+                if axis_move[i]:
+                    cur[i] = bed_mesh.lerp(t, prev_pos[i], next_pos[i])
+            next_z = factor * mesh.get_z(cur[0], cur[1])
+            if abs(next_z - z_offset) >= delta_z:
+                z_offset = next_z
+                out.append([cur[0], cur[1], cur[2] + z_offset, cur[3]])
+    end = list(next_pos)
+    end[2] += factor * mesh.get_z(end[0], end[1])
+    out.append(end)
+    return out
+
+@pytest.mark.parametrize('seed', range(2))
+def test_sample_splitter(seed):
+    mesh = make_mesh(seed, algo='bicubic')
+    splitter = bed_mesh.MoveSplitter(
+        FakeConfig(split_delta_z=.01, move_check_distance=3.), None)
+    for i, (prev_pos, next_pos) in enumerate(make_moves(seed, 300)):
+        factor = [1., .5][i % 2]
+        assert split_move(splitter, mesh, prev_pos, next_pos, factor) == (
+            ref_sample_split(mesh, prev_pos, next_pos, factor, .01, 3.))
+
+######################################################################
+# Mesh profiles
+######################################################################
+
+@pytest.mark.parametrize('algo', ['direct', 'lagrange', 'bicubic'])
+def test_profile_roundtrip(tmpdir, algo):
+    z_table = make_z_table(3, 5, 4)
+    mesh = bed_mesh.ZMesh(make_params(5, 4, [0, 2, 3][len(algo) % 3],
+                                      algo))
+    mesh.build_mesh(z_table)
+    filename = str(tmpdir.join("default.mesh"))
+    bed_mesh.save_profile(filename, mesh, z_table)
+    loaded, probed = bed_mesh.load_profile(filename)
+    assert probed == z_table
+    assert loaded.probe_params == mesh.probe_params
+    assert loaded.mesh_z_table == mesh.mesh_z_table
+    for attr in ['mesh_x_min', 'mesh_x_max', 'mesh_y_min', 'mesh_y_max',
+                 'mesh_x_count', 'mesh_y_count', 'mesh_x_dist',
+                 'mesh_y_dist']:
+        assert getattr(loaded, attr) == getattr(mesh, attr)
+    rnd = random.Random(0)
+    xs = [rnd.uniform(0., 200.) for i in range(100)]
+    ys = [rnd.uniform(0., 200.) for i in range(100)]
+    assert loaded.get_z_many(xs, ys) == mesh.get_z_many(xs, ys)
+
+def test_profile_invalid(tmpdir):
+    z_table = make_z_table(4, 4, 4)
+    mesh = bed_mesh.ZMesh(make_params(4, 4, 2, 'bicubic'))
+    mesh.build_mesh(z_table)
+    filename = str(tmpdir.join("test.mesh"))
+    bed_mesh.save_profile(filename, mesh, z_table)
+    with open(filename, 'rb') as f:
+        data = f.read()
+    for bad in [b"", data[:20], data[:-8], data + b"\0" * 8,
+                b"X" + data[1:], data[:8] + b"\2" + data[9:]]:
+        with open(filename, 'wb') as f:
+            f.write(bad)
+        with pytest.raises(bed_mesh.BedMeshError):
+            bed_mesh.load_profile(filename)
+
+class FakeGCode:
+    class error(Exception):
+        pass
+    def __init__(self):
+        self.responses = []
+    def respond_info(self, msg):
+        self.responses.append(msg)
+
+def write_raw_profile(filename, params_data, x_count=0, y_count=0):
+    # Write a profile with a valid header around the given parameters
+    params_data += b" " * (-len(params_data) % 8)
+    count = x_count * y_count
+    with open(filename, 'wb') as f:
+        f.write(bed_mesh.PROFILE_HEADER.pack(
+            bed_mesh.PROFILE_MAGIC, bed_mesh.PROFILE_VERSION,
+            len(params_data), x_count, y_count, x_count, y_count)
+                + params_data + b"\0" * (16 * count))
+
+@pytest.mark.parametrize('params_data, x_count', [
+    (b'{"x_count": 4, "y_co', 0),
+    (b'{"x_count": 0}', 0),
+    (b'[1, 2]', 0),
+    (b'{"min_x": "a", "max_x": 1, "x_offset": 0, "algo": "direct"}', 0),
+    (json.dumps(dict(make_params(4, 4, 2, 'lagrange'),
+                     mesh_x_pps=None)).encode(), 4),
+])
+def test_profile_corrupt_default(tmpdir, params_data, x_count):
+    # A corrupt default profile does not prevent the printer startup
+    bm = bed_mesh.BedMesh.__new__(bed_mesh.BedMesh)
+    bm.gcode = FakeGCode()
+    bm.profile_path = str(tmpdir)
+    bm.z_mesh = None
+    filename = bm.get_profile_filename('default')
+    write_raw_profile(filename, params_data, x_count, x_count)
+    with pytest.raises(bed_mesh.BedMeshError):
+        bed_mesh.load_profile(filename)
+    bm.printer_state('ready')
+    assert bm.z_mesh is None
+
+class FakeCalibrate:
+    def __init__(self, probed_z_table):
+        self.probed_z_table = probed_z_table
+
+def test_save_no_mesh(tmpdir):
+    # Saving a profile without a (complete) mesh is a gcode error
+    mesh = bed_mesh.ZMesh(make_params(4, 4, 2, 'lagrange'))
+    mesh.build_mesh(make_z_table(5, 4, 4))
+    for z_mesh, probed_z_table in [(None, None), (None, make_z_table(5, 4, 4)),
+                                   (mesh, None), (mesh, []),
+                                   (mesh, make_z_table(5, 3, 4))]:
+        bm = bed_mesh.BedMesh.__new__(bed_mesh.BedMesh)
+        bm.gcode = FakeGCode()
+        bm.profile_path = str(tmpdir)
+        bm.z_mesh = z_mesh
+        bm.calibrate = FakeCalibrate(probed_z_table)
+        with pytest.raises(FakeGCode.error):
+            bm.save_profile('default')
+        assert not tmpdir.listdir()
+    bm.calibrate = FakeCalibrate(make_z_table(5, 4, 4))
+    bm.save_profile('default')
+    assert bm.gcode.responses == ["Mesh profile 'default' saved"]
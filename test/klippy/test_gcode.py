@@ -0,0 +1,72 @@
+# Tests for the g-code move tokenizer
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import pytest
+
+from klippy import gcode, reactor
+
+class FakePrinter:
+    def __init__(self):
+        self.reactor = reactor.Reactor()
+    def get_reactor(self):
+        return self.reactor
+    def get_start_args(self):
+        return {'debuginput': 'test'}
+    def lookup_object(self, name, default=None):
+        return default
+    def request_exit(self, result):
+        pass
+    def invoke_shutdown(self, msg):
+        pass
+
+def run_lines(lines, fast_moves):
+    gp = gcode.GCodeParser(FakePrinter(), -1)
+    gp.is_printer_ready = True
+    gp.gcode_handlers = gp.ready_gcode_handlers
+    moves = []
+    gp.move_with_transform = (lambda pos, speed: moves.append(
+        (list(pos), speed)))
+    gp.position_with_transform = (lambda: [0., 0., 0., 0.])
+    if not fast_moves:
+        gp.parse_move = (lambda line: None)
+    gp.process_commands(lines)
+    return moves, gp.last_position
+
+LINES = [
+    "G1 X10 Y20 F6000",
+    "G0 X-1.5 Y+2.25 Z.3",
+    "G1 X1. E1.5 ; comment",
+    "G1 E2.5;comment",
+    "G1",
+    "G1 X10Y20",
+    "g1 x3 y4",
+    "N10 G1 X5 *23",
+    "G1 X1e1",
+    "G1 X1.2.3",
+    "G1 X",
+    "G1 F0",
+    "G10",
+    "G91",
+    "G1 X1 Y1 E.1",
+    "M83",
+    "G1 E1 F-100",
+    "G90",
+    "G1 X7 X8",
+    "G1 Z2 (comment)",
+]
+
+@pytest.mark.parametrize('line', LINES)
+def test_fast_move_matches_full_parser(line):
+    assert run_lines([line], True) == run_lines([line], False)
+
+def test_fast_move_sequence():
+    assert run_lines(LINES, True) == run_lines(LINES, False)
+
+def test_pretokenized_moves():
+    entries = []
+    for line in LINES:
+        args = gcode.tokenize_move(line.strip())
+        entries.append(line if args is None else (args, line.strip()))
+    assert run_lines(entries, True) == run_lines(LINES, False)
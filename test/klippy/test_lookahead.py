@@ -0,0 +1,117 @@
+# Tests comparing the C lookahead planner with the python reference
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import math, random
+import pytest
+
+from klippy import toolhead
+from klippy.kinematics import extruder
+
+class FakeToolHead:
+    def __init__(self, max_accel, square_corner_velocity):
+        self.max_accel = max_accel
+        self.max_accel_to_decel = max_accel * .5
+        self.junction_deviation = (square_corner_velocity**2
+                                   * (math.sqrt(2.) - 1.) / max_accel)
+        self.cmove = None
+        self.extruder = extruder.DummyExtruder()
+
+class RecordMove(toolhead.Move):
+    def move(self):
+        self.toolhead.flushed.append((
+            self.end_pos, self.accel_t, self.cruise_t, self.decel_t,
+            self.start_v, self.cruise_v, self.end_v))
+
+def make_moves(seed, count):
+    rnd = random.Random(seed)
+    pos = [0., 0., 0., 0.]
+    moves = []
+    for i in range(count):
+        kind = rnd.random()
+        newpos = list(pos)
+        if kind < .05:
+            # Extrude only move
+            newpos[3] += rnd.uniform(-2., 2.)
+        elif kind < .10:
+            # Repeat the last direction (a straight line continuation)
+            newpos[0] += rnd.choice([.5, 1., 5.])
+        else:
+            angle = rnd.uniform(0., 2. * math.pi)
+            dist = rnd.choice([.05, .2, 1., 10., 50.]) * rnd.random() + .01
+            newpos[0] += dist * math.cos(angle)
+            newpos[1] += dist * math.sin(angle)
+            if rnd.random() < .1:
+                newpos[2] += rnd.uniform(-.5, .5)
+            newpos[3] += dist * .05
+        speed = rnd.choice([5., 25., 100., 300.])
+        # Occasionally force a flush, like a dwell or M400 would
+        flush = rnd.random() < .02
+        moves.append((newpos, speed, flush))
+        pos = newpos
+    return moves
+
+def feed_queue(mq, th, moves):
+    pos = [0., 0., 0., 0.]
+    for newpos, speed, flush in moves:
+        move = RecordMove(th, pos, newpos, speed)
+        pos = newpos
+        if not move.move_d:
+            continue
+        if not move.is_kinematic_move:
+            move.limit_speed(speed * .5, th.max_accel * .5)
+        mq.add_move(move)
+        if flush:
+            mq.flush()
+    mq.flush()
+
+def run_queue(queue_class, moves, max_accel=3000., scv=5.):
+    th = FakeToolHead(max_accel, scv)
+    th.flushed = []
+    mq = queue_class()
+    mq.set_extruder(th.extruder)
+    mq.set_flush_time(2.)
+    feed_queue(mq, th, moves)
+    return th.flushed
+
+def compare(ref, res):
+    assert len(ref) == len(res)
+    for r, c in zip(ref, res):
+        assert r[0] == c[0]
+        for rv, cv in zip(r[1:], c[1:]):
+            assert cv == pytest.approx(rv, rel=1e-9, abs=1e-12)
+
+@pytest.mark.parametrize('seed', range(8))
+def test_random_moves(seed):
+    moves = make_moves(seed, 2000)
+    compare(run_queue(toolhead.MoveQueue, moves),
+            run_queue(toolhead.CMoveQueue, moves))
+
+def test_short_arc_segments():
+    moves = []
+    for i in range(5000):
+        angle = i * .02
+        moves.append(([50. * math.cos(angle), 50. * math.sin(angle), .2,
+                       i * .01], 150., False))
+    for accel, scv in [(500., 1.), (3000., 5.), (20000., 20.)]:
+        compare(run_queue(toolhead.MoveQueue, moves, accel, scv),
+                run_queue(toolhead.CMoveQueue, moves, accel, scv))
+
+def test_reset():
+    moves = make_moves(99, 300)
+    th = FakeToolHead(3000., 5.)
+    th.flushed = []
+    mq = toolhead.CMoveQueue()
+    mq.set_extruder(th.extruder)
+    pos = [0., 0., 0., 0.]
+    for newpos, speed, flush in moves[:50]:
+        move = RecordMove(th, pos, newpos, speed)
+        pos = newpos
+        if move.move_d:
+            mq.add_move(move)
+    mq.reset()
+    th.flushed = []
+    mq.set_flush_time(2.)
+    feed_queue(mq, th, moves)
+    compare(run_queue(toolhead.MoveQueue, moves), th.flushed)
@@ -0,0 +1,191 @@
+# Tests comparing the native and generated message codecs with the
+# python reference
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import json, random
+import pytest
+
+from klippy import msgproto
+
+MESSAGES = [
+    "clock clock=%u",
+    "config_stepper oid=%c step_pin=%c dir_pin=%c min_stop_interval=%u"
+    " invert_step=%c",
+    "queue_step oid=%c interval=%u count=%hu add=%hi",
+    "set_next_step_dir oid=%c dir=%c",
+    "reset_step_clock oid=%c clock=%u",
+    "stepper_position oid=%c pos=%i",
+    "analog_in_state oid=%c next_clock=%u value=%hu",
+    "spi_send oid=%c data=%*s",
+    "spi_transfer_response oid=%c response=%*s",
+    "shutdown clock=%u static_string_id=%hu",
+]
+
+def make_parser(use_native, use_compiled):
+    ids = list(range(len(msgproto.DefaultMessages),
+                     len(msgproto.DefaultMessages) + len(MESSAGES)))
+    data = {'messages': dict(zip(ids, MESSAGES)), 'commands': ids,
+            'responses': [], 'static_strings': {'1': "Test"}}
+    mp = msgproto.MessageParser(use_native=use_native,
+                                use_compiled=use_compiled)
+    mp.process_identify(json.dumps(data), decompress=False)
+    return mp
+
+def make_parsers():
+    parsers = [make_parser(False, False), make_parser(True, False)]
+    if parsers[1].codec is None:
+        pytest.skip("C helper not available")
+    return parsers
+
+def random_value(rnd, t):
+    if not t.is_int:
+        return [rnd.randrange(256) for i in range(rnd.randrange(16))]
+    limit = 1 << (8 * (t.max_length - 1) if t.max_length < 5 else 32)
+    kind = rnd.randrange(4)
+    if kind == 0:
+        return rnd.randrange(-0x30, 0x70)
+    if kind == 1:
+        for edge in (0x20, 0x60, 0x1000, 0x3000, 0x80000, 0x180000,
+                     0x4000000, 0xc000000, 0x80000000):
+            if rnd.random() < .3:
+                return edge + rnd.randrange(-2, 2)
+    if t.signed:
+        return rnd.randrange(-(limit >> 1), limit >> 1)
+    return rnd.randrange(limit)
+
+def to_cdata(mp, data):
+    return mp.codec.ffi_main.new('uint8_t[]', list(data))
+
+@pytest.mark.parametrize('seed', range(4))
+def test_roundtrip(seed):
+    rnd = random.Random(seed)
+    pymp, cmp = make_parsers()
+    for i in range(2000):
+        msgformat = rnd.choice(MESSAGES)
+        pymf = pymp.messages_by_name[msgformat.split()[0]]
+        cmf = cmp.messages_by_name[msgformat.split()[0]]
+        params = [random_value(rnd, t) for t in pymf.param_types]
+        pycmd = pymf.encode(params)
+        # Native encoding must be byte for byte identical
+        if not cmf.native_buffers:
+            assert cmp.codec.encode([cmf.msgid] + params) == pycmd
+        # Decoding must produce the same values
+        s = pycmd + [0, 0, 0]
+        assert cmf.parse_cdata(to_cdata(cmp, s), len(s), 0) == pymf.parse(
+            s, 0)
+        # Full message block parse
+        block = [0, 0x10] + pycmd + [0, 0, 0x7e]
+        assert cmp.parse_cdata(to_cdata(cmp, block), len(block)) == (
+            pymp.parse(block))
+
+def test_crc():
+    rnd = random.Random(0)
+    pymp, cmp = make_parsers()
+    for i in range(500):
+        data = ''.join([chr(rnd.randrange(256))
+                        for j in range(rnd.randrange(64))])
+        raw = data
+        if bytes is not str:
+            raw = data.encode('latin-1')
+        assert cmp.codec.crc16_ccitt(raw) == msgproto.crc16_ccitt(data)
+    for seq in range(20):
+        cmd = ''.join(map(chr, pymp.messages_by_name['clock'].encode(
+            [rnd.randrange(1 << 32)])))
+        block = pymp.encode(seq, cmd)
+        assert cmp.encode(seq, cmd) == block
+        assert cmp.check_packet(block) == pymp.check_packet(block)
+
+def test_malformed():
+    rnd = random.Random(1)
+    pymp, cmp = make_parsers()
+    for i in range(3000):
+        name = rnd.choice(MESSAGES).split()[0]
+        pymf = pymp.messages_by_name[name]
+        cmf = cmp.messages_by_name[name]
+        s = [rnd.choice([0, 0x7f, 0x80, 0xff, rnd.randrange(256)])
+             for j in range(rnd.randrange(1, 12))]
+        # Place the data in a larger buffer to check that the length
+        # is honored
+        buf = to_cdata(cmp, s + [0x80] * 8)
+        try:
+            expected = pymf.parse(buf[0:len(s)], 0)
+        except IndexError:
+            with pytest.raises(IndexError):
+                cmf.parse_cdata(buf, len(s), 0)
+            continue
+        assert cmf.parse_cdata(buf, len(s), 0) == expected
+
+@pytest.mark.parametrize('seed', range(4))
+def test_compiled_roundtrip(seed):
+    rnd = random.Random(seed)
+    pymp = make_parser(False, False)
+    genmp = make_parser(False, True)
+    for i in range(2000):
+        name = rnd.choice(MESSAGES).split()[0]
+        pymf = pymp.messages_by_name[name]
+        genmf = genmp.messages_by_name[name]
+        params = [random_value(rnd, t) for t in pymf.param_types]
+        pycmd = pymf.encode(params)
+        assert genmf.encode(params) == pycmd
+        byname = dict(zip([n for n, t in pymf.param_names], params))
+        assert genmf.encode_by_name(**byname) == pycmd
+        block = [0, 0x10] + pycmd + [0, 0, 0x7e]
+        assert genmp.parse(block) == pymp.parse(block)
+
+def test_compiled_malformed():
+    rnd = random.Random(2)
+    pymp = make_parser(False, False)
+    genmp = make_parser(False, True)
+    for i in range(3000):
+        name = rnd.choice(MESSAGES).split()[0]
+        pymf = pymp.messages_by_name[name]
+        genmf = genmp.messages_by_name[name]
+        s = [rnd.choice([0, 0x7f, 0x80, 0xff, rnd.randrange(256)])
+             for j in range(rnd.randrange(1, 12))]
+        try:
+            expected = pymf.parse(s, 0)
+        except IndexError:
+            with pytest.raises(IndexError):
+                genmf.parse(s, 0)
+            continue
+        assert genmf.parse(s, 0) == expected
+
+@pytest.mark.parametrize('seed', range(2))
+def test_compiled_cdata(seed):
+    # The generated parsers decode message blocks in place in a C buffer
+    rnd = random.Random(seed)
+    pymp = make_parser(False, False)
+    genmp = make_parser(True, True)
+    if genmp.codec is None:
+        pytest.skip("C helper not available")
+    assert not genmp.native_messages
+    for i in range(2000):
+        name = rnd.choice(MESSAGES).split()[0]
+        pymf = pymp.messages_by_name[name]
+        params = [random_value(rnd, t) for t in pymf.param_types]
+        block = [0, 0x10] + pymf.encode(params) + [0, 0, 0x7e]
+        # Stale data after the block must not be used
+        buf = to_cdata(genmp, block + [0x80] * 8)
+        assert genmp.parse_cdata(buf, len(block)) == pymp.parse(block)
+        # A truncated block is an error
+        with pytest.raises((msgproto.error, IndexError)):
+            genmp.parse_cdata(buf, len(block) - 1)
+
+def test_create_command():
+    pymp = make_parser(False, False)
+    genmp = make_parser(False, True)
+    for msg in ["clock clock=4000000000", "set_next_step_dir oid=3 dir=1",
+                "spi_send oid=2 data=0102ff", "stepper_position oid=1 pos=-5",
+                "  reset_step_clock oid=7 clock=0x1234 ", ""]:
+        expected = pymp.create_command(msg)
+        assert genmp.create_command(msg) == expected
+        # A second call is served from the cache
+        cmd = genmp.create_command(msg)
+        assert cmd == expected
+        if cmd:
+            cmd.append(0)
+            assert genmp.create_command(msg) == expected
+    with pytest.raises(msgproto.error):
+        genmp.create_command("clock foo=3")
@@ -0,0 +1,114 @@
+# Tests for the startup and the status reporting of the printer
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import pytest
+
+from klippy import printer, mcu
+
+class FakeMCU:
+    def __init__(self, reactor, connect_time, error=None):
+        self.reactor = reactor
+        self.connect_time = connect_time
+        self.error = error
+        self.start_time = self.end_time = None
+        self.is_aborted = False
+    def connect(self):
+        # Wait for the responses of a (slow) micro-controller - a
+        # connect_time of None waits until the connection is aborted
+        self.start_time = self.reactor.monotonic()
+        if self.connect_time is None:
+            while not self.is_aborted:
+                self.reactor.pause(self.reactor.monotonic() + 0.010)
+            self.end_time = self.reactor.monotonic()
+            raise mcu.error("aborted")
+        self.reactor.pause(self.start_time + self.connect_time)
+        self.end_time = self.reactor.monotonic()
+        if self.error is not None:
+            raise mcu.error(self.error)
+    def abort_connect(self):
+        self.is_aborted = True
+
+class MCUPrinter(printer.Printer):
+    def __init__(self, mcus):
+        printer.Printer.__init__(self, -1, None, {'debuginput': 'test'})
+        self.connect_error = self.connect_time = None
+        self.mcus = []
+        for name, connect_time, error in mcus:
+            m = FakeMCU(self.reactor, connect_time, error)
+            self.add_object(name, m)
+            self.mcus.append(m)
+    def _connect(self, eventtime):
+        try:
+            self._connect_mcus()
+        except mcu.error as e:
+            self.connect_error = str(e)
+        self.connect_time = self.reactor.monotonic() - eventtime
+        self.reactor.end()
+        return self.reactor.NEVER
+
+def test_connect_parallel():
+    p = MCUPrinter([('mcu', .300, None), ('mcu aux1', .300, None),
+                    ('mcu aux2', .300, None)])
+    p.reactor.run()
+    assert p.connect_error is None
+    assert .300 <= p.connect_time < .600
+    # All mcus are connecting at the same time
+    assert max(m.start_time for m in p.mcus) < min(m.end_time for m in p.mcus)
+
+@pytest.mark.parametrize('mcus, expected', [
+    # The error of the first mcu in the config is reported
+    ([('mcu', .200, "main failed"), ('mcu aux', 0., "aux failed")],
+     "main failed"),
+    ([('mcu', .200, None), ('mcu aux', 0., "aux failed")], "aux failed"),
+    ([('mcu', 0., None), ('mcu aux', .200, "aux failed")], "aux failed"),
+])
+def test_connect_error(mcus, expected):
+    p = MCUPrinter(mcus)
+    p.reactor.run()
+    assert p.connect_error == expected
+
+def test_connect_abort():
+    # The mcus still connecting are stopped when an mcu fails
+    p = MCUPrinter([('mcu', .100, "main failed"), ('mcu aux1', None, None),
+                    ('mcu aux2', 0., None)])
+    p.reactor.run()
+    assert p.connect_error == "main failed"
+    main, aux1, aux2 = p.mcus
+    assert aux1.is_aborted and not aux2.is_aborted
+    # Let the aborted connection exit
+    def stop(eventtime):
+        p.reactor.pause(eventtime + .100)
+        p.reactor.end()
+    p.reactor.register_callback(stop)
+    p.reactor.run()
+    assert aux1.end_time is not None
+
+class FakeStatusObject:
+    def __init__(self):
+        self.status = {'temperature': 20., 'target': 0.}
+        self.calls = 0
+    def get_status(self, eventtime):
+        self.calls += 1
+        return dict(self.status)
+
+def make_status_printer():
+    p = printer.Printer(-1, None, {'debuginput': 'test'})
+    objs = {'heater_bed': FakeStatusObject(), 'fan': FakeStatusObject()}
+    for name, obj in objs.items():
+        p.add_object(name, obj)
+    return p.lookup_object('status'), objs
+
+def test_status_cache():
+    status, objs = make_status_printer()
+    bed = objs['heater_bed']
+    info = status.lookup_status('heater_bed', 1.)
+    assert info == {'temperature': 20., 'target': 0.}
+    # The status is reused within a reactor tick
+    assert status.lookup_status('heater_bed', 1.005) is info
+    assert bed.calls == 1
+    bed.status['temperature'] = 21.
+    info = status.lookup_status('heater_bed', 1.020)
+    assert info == {'temperature': 21., 'target': 0.}
+    assert bed.calls == 2
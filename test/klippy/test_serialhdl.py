@@ -0,0 +1,229 @@
+# Tests for the response dispatch of the serial reader
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import json, socket, threading, time, zlib
+
+from klippy import serialhdl
+
+class FakeReactor:
+    def __init__(self):
+        self.async_callbacks = []
+    def register_async_callback(self, callback):
+        self.async_callbacks.append(callback)
+    def run_async(self):
+        callbacks = self.async_callbacks
+        self.async_callbacks = []
+        for cb in callbacks:
+            cb(0.)
+        return len(callbacks)
+
+def dispatch(sr, params):
+    # Dispatch a response as done by the background thread
+    hdl = sr.handlers.get((params['#name'], params.get('oid')),
+                          sr.handle_default)
+    hdl(params)
+
+def test_handler_table():
+    # Registering a callback replaces the handler table
+    sr = serialhdl.SerialReader(FakeReactor(), '/dev/null', 0)
+    got = []
+    handlers = sr.handlers
+    sr.register_callback(got.append, 'analog_in_state', 3)
+    assert sr.handlers is not handlers
+    assert ('analog_in_state', 3) not in handlers
+    dispatch(sr, {'#name': 'analog_in_state', 'oid': 3, 'value': 1})
+    assert got == [{'#name': 'analog_in_state', 'oid': 3, 'value': 1}]
+    handlers = sr.handlers
+    sr.unregister_callback('analog_in_state', 3)
+    assert ('analog_in_state', 3) in handlers
+    assert ('analog_in_state', 3) not in sr.handlers
+
+def test_batch_dispatch():
+    # Batched responses are run in order by a single reactor callback
+    reactor = FakeReactor()
+    sr = serialhdl.SerialReader(reactor, '/dev/null', 0)
+    got = []
+    sr.register_callback(got.append, 'analog_in_state', 0, batch=True)
+    def flood():
+        for i in range(1000):
+            dispatch(sr, {'#name': 'analog_in_state', 'oid': 0, 'value': i})
+    t = threading.Thread(target=flood)
+    t.start()
+    t.join()
+    assert not got
+    assert reactor.run_async() == 1
+    assert [p['value'] for p in got] == list(range(1000))
+    assert reactor.run_async() == 0
+    # A new response schedules a new reactor callback
+    dispatch(sr, {'#name': 'analog_in_state', 'oid': 0, 'value': 1000})
+    assert reactor.run_async() == 1
+    assert len(got) == 1001
+    assert sr.batch_dropped == 0
+
+def test_batch_overflow():
+    # The oldest responses are discarded when the queue is full
+    class SmallSerialReader(serialhdl.SerialReader):
+        BATCH_QUEUE_SIZE = 10
+    reactor = FakeReactor()
+    sr = SmallSerialReader(reactor, '/dev/null', 0)
+    got = []
+    sr.register_callback(got.append, 'analog_in_state', 0, batch=True)
+    for i in range(25):
+        dispatch(sr, {'#name': 'analog_in_state', 'oid': 0, 'value': i})
+    reactor.run_async()
+    assert [p['value'] for p in got] == list(range(15, 25))
+    assert sr.batch_dropped == 15
+
+def encode_block(seq, cmd):
+    # Build a message block as sent by the micro-controller
+    mp = serialhdl.msgproto
+    block = [mp.MESSAGE_MIN + len(cmd), (seq & mp.MESSAGE_SEQ_MASK)
+             | mp.MESSAGE_DEST] + list(cmd)
+    crc = mp.crc16_ccitt([chr(b) for b in block])
+    return bytearray(block + [ord(c) for c in crc] + [ord(mp.MESSAGE_SYNC)])
+
+def test_pull_batch():
+    # Responses are pulled from the C helper in batches and handled
+    # in order
+    class SmallSerialReader(serialhdl.SerialReader):
+        PULL_BATCH_SIZE = 4
+    data = {'messages': {
+        0: "identify_response offset=%u data=%.*s",
+        1: "identify offset=%u count=%c",
+        2: "analog_in_state oid=%c next_clock=%u value=%hu"},
+            'commands': [1], 'responses': [0, 2]}
+    mcu_sock, host_sock = socket.socketpair()
+    sr = SmallSerialReader(FakeReactor(), '/dev/null', 0)
+    sr.msgparser.process_identify(json.dumps(data), decompress=False)
+    sr.serialqueue = sr.ffi_lib.serialqueue_alloc(host_sock.fileno(), 0)
+    got = []
+    sr.register_callback(got.append, 'analog_in_state', 0)
+    sr.background_thread = threading.Thread(target=sr._bg_thread)
+    sr.background_thread.start()
+    mid = sr.msgparser.messages_by_name['analog_in_state']
+    mcu_sock.sendall(b''.join([bytes(encode_block(i + 1, mid.encode(
+        [0, i * 1000, i]))) for i in range(100)]))
+    for i in range(100):
+        if len(got) >= 100:
+            break
+        time.sleep(.010)
+    sr.disconnect()
+    mcu_sock.close()
+    host_sock.close()
+    assert [p['value'] for p in got] == list(range(100))
+    assert [p['next_clock'] for p in got] == [i * 1000 for i in range(100)]
+    assert all(p['#receive_time'] > 0. for p in got)
+
+class FakeCommand:
+    def __init__(self):
+        self.sent = []
+    def send(self, data):
+        self.sent.append(tuple(data))
+
+class FakeSerial:
+    def __init__(self):
+        self.reactor = FakeReactor()
+        self.reactor.NOW = 0.
+        self.reactor.register_timer = lambda callback, waketime: None
+        self.identify_cmd = FakeCommand()
+    def lookup_command(self, msgformat):
+        return self.identify_cmd
+    def register_callback(self, callback, name, oid=None):
+        pass
+
+def run_bootstrap(firmware_data, cached_data=None):
+    # Answer the identify requests until the download completes
+    fs = FakeSerial()
+    sbs = serialhdl.SerialBootStrap(fs, cached_data)
+    sbs.send_event(0.)
+    requests = 0
+    while not sbs.is_done:
+        offset, count = fs.identify_cmd.sent[requests]
+        requests += 1
+        sbs.handle_identify({'offset': offset,
+                             'data': firmware_data[offset:offset+count]})
+    return sbs, requests
+
+def make_identify_data(count):
+    # The identify data is handled as a (python2) str
+    data = {'messages': dict((i, "msg%d" % (i,)) for i in range(count)),
+            'version': 'v1'}
+    return zlib.compress(json.dumps(data).encode()).decode('latin-1')
+
+def test_bootstrap_cache():
+    data = make_identify_data(200)
+    sbs, requests = run_bootstrap(data)
+    assert sbs.identify_data == data and not sbs.is_cached
+    assert requests == len(data) // 40 + 2
+    # A matching cached data dictionary needs three requests
+    sbs, requests = run_bootstrap(data, data)
+    assert sbs.identify_data == data and sbs.is_cached
+    assert requests == 3
+    # New firmware must be downloaded
+    new_data = make_identify_data(201)
+    for cached_data in [data, data[:-1], data + 'x']:
+        sbs, requests = run_bootstrap(new_data, cached_data)
+        assert sbs.identify_data == new_data and not sbs.is_cached
+
+def test_identify_cache(tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    cache = serialhdl.IdentifyCache(cache_dir, '/dev/ttyACM0')
+    assert cache.load() is None
+    dictionary = {'messages': {'1': 'identify offset=%u count=%c'},
+                  'config': {'MCU': 'atmega2560'}}
+    cache.save(b'data', dictionary)
+    assert cache.load() == (b'data', dictionary)
+    assert serialhdl.IdentifyCache(cache_dir, '/dev/ttyACM1').load() is None
+    # An invalid cache file is ignored
+    f = open(cache.filename, 'wb')
+    f.write(b'garbage')
+    f.close()
+    assert cache.load() is None
+
+def test_send_encoded(tmpdir):
+    # Encoded commands are sent in order in as few blocks as possible
+    data = {'messages': {
+        0: "identify_response offset=%u data=%.*s",
+        1: "identify offset=%u count=%c",
+        2: "config_stepper oid=%c step_pin=%c dir_pin=%c"
+        " min_stop_interval=%u invert_step=%c"},
+            'commands': [1, 2], 'responses': [0]}
+    fname = str(tmpdir.join('output'))
+    sr = serialhdl.SerialReader(FakeReactor(), '/dev/null', 0)
+    sr.connect_file(open(fname, 'wb'), json.dumps(data))
+    sr.set_clock_est(1000000000000., 0., 0)
+    cmds = ["config_stepper oid=%d step_pin=%d dir_pin=%d"
+            " min_stop_interval=%d invert_step=0" % (i, i, i, i * 1000)
+            for i in range(50)]
+    encoded_data, lens = sr.encode_commands(cmds)
+    assert len(lens) == len(cmds) and sum(lens) == len(encoded_data)
+    sr.send_encoded((encoded_data, lens))
+    for i in range(100):
+        if b'ready_bytes=0 stalled_bytes=0' in sr.stats(0.):
+            break
+        time.sleep(.010)
+    sr.disconnect()
+    output = bytearray(open(fname, 'rb').read())
+    # Extract the payload of each message block
+    payloads = []
+    pos = 0
+    while pos < len(output):
+        if output[pos] == ord(serialhdl.msgproto.MESSAGE_SYNC):
+            pos += 1
+            continue
+        msglen = output[pos]
+        assert msglen <= serialhdl.msgproto.MESSAGE_MAX
+        payloads.append(output[pos + serialhdl.msgproto.MESSAGE_HEADER_SIZE
+                               :pos + msglen
+                               - serialhdl.msgproto.MESSAGE_TRAILER_SIZE])
+        pos += msglen
+    assert bytearray().join(payloads) == bytearray(encoded_data)
+    # Each block is filled before the next block is started
+    block_lens = [0]
+    for l in lens:
+        if block_lens[-1] + l > serialhdl.msgproto.MESSAGE_PAYLOAD_MAX:
+            block_lens.append(0)
+        block_lens[-1] += l
+    assert [len(p) for p in payloads] == block_lens
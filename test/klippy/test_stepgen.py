@@ -0,0 +1,415 @@
+# Tests comparing parallel step generation and compression and the
+# analytic solver with the serial iterative solver
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import collections, json, math, random, time
+import pytest
+
+from klippy import chelper, msgproto, toolhead
+from klippy.kinematics import extruder
+
+MCU_FREQ = 16000000.
+MAX_ERROR = 25
+QUEUE_STEP_ID = 10
+SET_DIR_ID = 11
+MESSAGES = {
+    QUEUE_STEP_ID: "queue_step oid=%c interval=%u count=%hu add=%hi",
+    SET_DIR_ID: "set_next_step_dir oid=%c dir=%c",
+}
+
+def delta_steppers():
+    out = []
+    for angle in [210., 330., 90.]:
+        tx = math.cos(math.radians(angle)) * 140.
+        ty = math.sin(math.radians(angle)) * 140.
+        out.append(('delta_stepper_alloc', (250.**2, tx, ty), .01))
+    return out
+
+KINEMATICS = {
+    'cartesian': [('cartesian_stepper_alloc', (b'x',), .0125),
+                  ('cartesian_stepper_alloc', (b'y',), .0125),
+                  ('cartesian_stepper_alloc', (b'z',), .0025)],
+    'corexy': [('corexy_stepper_alloc', (b'+',), .0125),
+               ('corexy_stepper_alloc', (b'-',), .0125),
+               ('cartesian_stepper_alloc', (b'z',), .0025)],
+    'delta': delta_steppers(),
+}
+
+class FakeToolHead:
+    def __init__(self):
+        self.max_accel = 3000.
+        self.max_accel_to_decel = 1500.
+        self.junction_deviation = 25. * (math.sqrt(2.) - 1.) / 3000.
+        self.cmove = None
+        self.extruder = extruder.DummyExtruder()
+
+class RecordMove(toolhead.Move):
+    def move(self):
+        self.toolhead.flushed.append((
+            self.start_pos, self.axes_d, self.accel_t, self.cruise_t,
+            self.decel_t, self.start_v, self.cruise_v, self.accel))
+
+# Generate moves with velocity trapezoids from the look-ahead planner
+def make_moves(seed, count):
+    rnd = random.Random(seed)
+    th = FakeToolHead()
+    th.flushed = []
+    mq = toolhead.MoveQueue()
+    mq.set_extruder(th.extruder)
+    pos = [0., 0., 20., 0.]
+    for i in range(count):
+        angle = rnd.uniform(0., 2. * math.pi)
+        radius = rnd.uniform(0., 80.)
+        newpos = [radius * math.cos(angle), radius * math.sin(angle),
+                  pos[2], pos[3] + rnd.uniform(0., 2.)]
+        if rnd.random() < .05:
+            newpos[2] += rnd.uniform(-1., 1.)
+        mq.add_move(RecordMove(th, pos, newpos, rnd.choice([20., 100.])))
+        pos = newpos
+    mq.flush()
+    return th.flushed
+
+class StepGen:
+    def __init__(self, kin, filename, threads, analytic=False,
+                 max_error=MAX_ERROR, compress_threads=0, baud=0,
+                 adaptive_error=0):
+        self.ffi_main, self.ffi_lib = ffi_main, ffi_lib = chelper.get_ffi()
+        self.outfile = open(filename, 'wb')
+        self.serialqueue = ffi_lib.serialqueue_alloc(self.outfile.fileno(), 1)
+        ffi_lib.serialqueue_set_clock_est(
+            self.serialqueue, 1000000000000., ffi_lib.get_monotonic(), 0)
+        self.steppers = []
+        for oid, (alloc, params, step_dist) in enumerate(
+                KINEMATICS[kin] + [('extruder_stepper_alloc', (), .002)]):
+            sc = ffi_main.gc(ffi_lib.stepcompress_alloc(oid),
+                             ffi_lib.stepcompress_free)
+            ffi_lib.stepcompress_fill(sc, max_error, 0, QUEUE_STEP_ID,
+                                      SET_DIR_ID)
+            sk = ffi_main.gc(getattr(ffi_lib, alloc)(*params), ffi_lib.free)
+            ffi_lib.itersolve_set_stepcompress(sk, sc, step_dist)
+            ffi_lib.itersolve_set_analytic(sk, analytic)
+            ffi_lib.itersolve_set_commanded_pos(
+                sk, ffi_lib.itersolve_calc_position_from_coord(
+                    sk, 0., 0., 20.))
+            self.steppers.append((sc, sk))
+        self.steppersync = ffi_lib.steppersync_alloc(
+            self.serialqueue, [sc for sc, sk in self.steppers],
+            len(self.steppers), 500)
+        ffi_lib.steppersync_set_time(self.steppersync, 0., MCU_FREQ)
+        if baud:
+            # Simulate a serial link with the given baud rate
+            link_rate = baud / 10.
+            ffi_lib.steppersync_set_adaptive_error(
+                self.steppersync, adaptive_error, link_rate / MCU_FREQ,
+                link_rate * .100)
+        self.compress_pool = None
+        if compress_threads:
+            self.compress_pool = ffi_main.gc(
+                ffi_lib.thread_pool_alloc(compress_threads),
+                ffi_lib.thread_pool_free)
+            ffi_lib.steppersync_set_thread_pool(
+                self.steppersync, self.compress_pool)
+        self.cmove = ffi_main.gc(ffi_lib.move_alloc(), ffi_lib.free)
+        self.ecmove = ffi_main.gc(ffi_lib.move_alloc(), ffi_lib.free)
+        self.gen_steps = ffi_lib.itersolve_gen_steps
+        self.pool = None
+        if threads:
+            self.pool = ffi_main.gc(ffi_lib.stepgen_pool_alloc(threads),
+                                    ffi_lib.stepgen_pool_free)
+            queue = ffi_lib.stepgen_pool_queue
+            self.gen_steps = lambda sk, m: queue(self.pool, sk, m)
+    def run(self, moves, batch=1, pressure_advance=0.):
+        ffi_lib = self.ffi_lib
+        print_time = .1
+        epos = 0.
+        for i, (start_pos, axes_d, accel_t, cruise_t, decel_t, start_v,
+                cruise_v, accel) in enumerate(moves):
+            ffi_lib.move_fill(
+                self.cmove, print_time, accel_t, cruise_t, decel_t,
+                start_pos[0], start_pos[1], start_pos[2],
+                axes_d[0], axes_d[1], axes_d[2], start_v, cruise_v, accel)
+            for sc, sk in self.steppers[:-1]:
+                assert not self.gen_steps(sk, self.cmove)
+            move_d = math.sqrt(sum([d*d for d in axes_d[:3]]))
+            axis_r = axes_d[3] / move_d
+            # Simplified pressure advance (see extruder.PrinterExtruder)
+            extra_accel_v = extra_decel_v = 0.
+            pressure_d = pressure_advance * (cruise_v - start_v) * axis_r
+            if accel_t:
+                extra_accel_v = pressure_d / accel_t
+            if decel_t:
+                extra_decel_v = -pressure_d / decel_t
+            ffi_lib.extruder_move_fill(
+                self.ecmove, print_time, accel_t, cruise_t, decel_t, epos,
+                start_v * axis_r, cruise_v * axis_r, accel * axis_r,
+                extra_accel_v, extra_decel_v)
+            assert not self.gen_steps(self.steppers[-1][1], self.ecmove)
+            epos += (axes_d[3] + extra_accel_v * accel_t
+                     + extra_decel_v * decel_t)
+            print_time += accel_t + cruise_t + decel_t
+            if (i + 1) % batch:
+                continue
+            if self.pool is not None:
+                assert not ffi_lib.stepgen_pool_flush(self.pool)
+            assert not ffi_lib.steppersync_flush(
+                self.steppersync, int((print_time - .05) * MCU_FREQ))
+        if self.pool is not None:
+            assert not ffi_lib.stepgen_pool_flush(self.pool)
+        assert not ffi_lib.steppersync_flush(
+            self.steppersync, int((print_time + 1.) * MCU_FREQ))
+        return [ffi_lib.itersolve_get_commanded_pos(sk)
+                for sc, sk in self.steppers]
+    def run_batch(self, moves, batch_size):
+        # Submit the moves through toolhead.MoveBatch
+        mb = toolhead.MoveBatch([FakeMCU(self)], self.pool)
+        cmove = mb.alloc_move()
+        ecmove = mb.alloc_move()
+        print_time = .1
+        epos = 0.
+        for i, (start_pos, axes_d, accel_t, cruise_t, decel_t, start_v,
+                cruise_v, accel) in enumerate(moves):
+            mb.move_fill(
+                cmove, print_time, accel_t, cruise_t, decel_t,
+                start_pos[0], start_pos[1], start_pos[2],
+                axes_d[0], axes_d[1], axes_d[2], start_v, cruise_v, accel)
+            for sc, sk in self.steppers[:-1]:
+                assert not mb.gen_steps(sk, cmove)
+            move_d = math.sqrt(sum([d*d for d in axes_d[:3]]))
+            axis_r = axes_d[3] / move_d
+            mb.extruder_move_fill(
+                ecmove, print_time, accel_t, cruise_t, decel_t, epos,
+                start_v * axis_r, cruise_v * axis_r, accel * axis_r, 0., 0.)
+            assert not mb.gen_steps(self.steppers[-1][1], ecmove)
+            epos += axes_d[3]
+            print_time += accel_t + cruise_t + decel_t
+            mb.flush_moves(print_time - .05)
+            if not (i + 1) % batch_size:
+                mb.flush()
+        mb.flush()
+        mb.flush_moves(print_time + 1.)
+        return [self.ffi_lib.itersolve_get_commanded_pos(sk)
+                for sc, sk in self.steppers]
+    def stats(self):
+        sbuf = self.ffi_main.new('char[4096]')
+        self.ffi_lib.steppersync_get_stats(self.steppersync, sbuf, len(sbuf))
+        return dict([s.split('=', 1) for s in
+                     self.ffi_main.string(sbuf).decode().split()])
+    def stepper_stats(self):
+        out = []
+        sbuf = self.ffi_main.new('char[4096]')
+        for sc, sk in self.steppers:
+            self.ffi_lib.stepcompress_get_stats(sc, sbuf, len(sbuf))
+            out.append(dict([s.split('=', 1) for s in
+                             self.ffi_main.string(sbuf).decode().split()]))
+        return out
+    def close(self):
+        # Wait for the background thread to write all queued messages
+        sbuf = self.ffi_main.new('char[4096]')
+        while 1:
+            self.ffi_lib.serialqueue_get_stats(
+                self.serialqueue, sbuf, len(sbuf))
+            stats = dict([s.split('=', 1) for s in
+                          self.ffi_main.string(sbuf).decode().split()])
+            if stats['ready_bytes'] == stats['stalled_bytes'] == '0':
+                break
+            time.sleep(.001)
+        self.ffi_lib.serialqueue_exit(self.serialqueue)
+        self.ffi_lib.steppersync_free(self.steppersync)
+        self.ffi_lib.serialqueue_free(self.serialqueue)
+        self.outfile.close()
+
+class FakeMCU:
+    def __init__(self, stepgen):
+        self.stepgen = stepgen
+    def get_steppersync(self):
+        return self.stepgen.steppersync, (0., MCU_FREQ)
+    def flush_moves(self, print_time):
+        clock = int(print_time * MCU_FREQ)
+        if clock >= 0:
+            assert not self.stepgen.ffi_lib.steppersync_flush(
+                self.stepgen.steppersync, clock)
+
+# Decode the messages of each stepper from the output file
+def decode_output(filename):
+    mp = msgproto.MessageParser()
+    data = {'messages': MESSAGES, 'commands': list(MESSAGES.keys()),
+            'responses': []}
+    mp.process_identify(json.dumps(data), decompress=False)
+    f = open(filename, 'rb')
+    data = bytearray(f.read())
+    f.close()
+    out = collections.defaultdict(list)
+    pos = 0
+    while pos < len(data):
+        block = list(data[pos:pos+data[pos]])
+        pos += data[pos]
+        msgpos = msgproto.MESSAGE_HEADER_SIZE
+        while msgpos < len(block) - msgproto.MESSAGE_TRAILER_SIZE:
+            mid = mp.messages_by_id[block[msgpos]]
+            params, msgpos = mid.parse(block, msgpos)
+            out[params['oid']].append((mid.name, sorted(params.items())))
+    return out
+
+def run_stepgen(tmpdir, kin, moves, threads, batch=1, move_batch=0,
+                analytic=False, max_error=MAX_ERROR, pressure_advance=0.,
+                compress_threads=0):
+    filename = str(tmpdir.join("%s-%d-%d-%d-%d-%d-%g-%d.out" % (
+        kin, threads, batch, move_batch, analytic, max_error,
+        pressure_advance, compress_threads)))
+    sg = StepGen(kin, filename, threads, analytic, max_error,
+                 compress_threads)
+    if move_batch:
+        positions = sg.run_batch(moves, move_batch)
+    else:
+        positions = sg.run(moves, batch, pressure_advance)
+    sg.close()
+    return positions, decode_output(filename)
+
+@pytest.mark.parametrize('kin', sorted(KINEMATICS.keys()))
+def test_parallel_stepgen(tmpdir, kin):
+    moves = make_moves(1, 300)
+    ref_positions, ref = run_stepgen(tmpdir, kin, moves, 0)
+    assert sum([len(msgs) for msgs in ref.values()]) > 1000
+    for threads in [1, 2, 4]:
+        positions, res = run_stepgen(tmpdir, kin, moves, threads)
+        assert positions == ref_positions
+        assert sorted(res.keys()) == sorted(ref.keys())
+        for oid in ref:
+            assert res[oid] == ref[oid]
+
+def test_pool_batch(tmpdir):
+    # Steps of several moves may be queued before a flush
+    moves = make_moves(2, 100)
+    for threads in [0, 3]:
+        ref_positions, ref = run_stepgen(tmpdir, 'delta', moves, threads, 7)
+        positions, res = run_stepgen(tmpdir, 'delta', moves, 3, 7)
+        assert positions == ref_positions
+        for oid in ref:
+            assert res[oid] == ref[oid]
+
+@pytest.mark.parametrize('kin', sorted(KINEMATICS.keys()))
+def test_parallel_compress(tmpdir, kin):
+    # Flushing many moves at once exceeds the minimum number of pending
+    # steps that is compressed on the thread pool
+    moves = make_moves(5, 200)
+    for batch in [1, 20]:
+        ref_positions, ref = run_stepgen(tmpdir, kin, moves, 0, batch)
+        for threads, compress_threads in [(0, 1), (0, 2), (0, 4), (2, 3)]:
+            positions, res = run_stepgen(tmpdir, kin, moves, threads, batch,
+                                         compress_threads=compress_threads)
+            assert positions == ref_positions
+            assert sorted(res.keys()) == sorted(ref.keys())
+            for oid in ref:
+                assert res[oid] == ref[oid]
+
+@pytest.mark.parametrize('kin', sorted(KINEMATICS.keys()))
+def test_move_batch(tmpdir, kin):
+    # Batched submission must match submitting one move at a time
+    moves = make_moves(3, 200)
+    ref_positions, ref = run_stepgen(tmpdir, kin, moves, 0)
+    for threads, move_batch in [(0, 1), (0, 5), (0, 1000), (2, 5)]:
+        positions, res = run_stepgen(tmpdir, kin, moves, threads,
+                                     move_batch=move_batch)
+        assert positions == ref_positions
+        assert sorted(res.keys()) == sorted(ref.keys())
+        for oid in ref:
+            assert res[oid] == ref[oid]
+
+# Return the step clocks and directions of each stepper in the output
+def step_clocks(output):
+    out = {}
+    for oid, msgs in output.items():
+        steps = out[oid] = []
+        clock = 0
+        sdir = 1
+        for name, params in msgs:
+            params = dict(params)
+            if name == 'set_next_step_dir':
+                sdir = params['dir']
+                continue
+            interval = params['interval']
+            for i in range(params['count']):
+                clock += interval
+                steps.append((clock, sdir))
+                interval += params['add']
+    return out
+
+@pytest.mark.parametrize('kin', sorted(KINEMATICS.keys()))
+def test_analytic_solver(tmpdir, kin):
+    # Without step compression the step clocks of the analytic solver
+    # must be within max_stepper_error of the iterative solver
+    moves = make_moves(4, 200)
+    for pressure_advance in [0., .05]:
+        ref_positions, ref = run_stepgen(
+            tmpdir, kin, moves, 0, max_error=0,
+            pressure_advance=pressure_advance)
+        positions, res = run_stepgen(
+            tmpdir, kin, moves, 0, analytic=True, max_error=0,
+            pressure_advance=pressure_advance)
+        ref_steps = step_clocks(ref)
+        res_steps = step_clocks(res)
+        assert sorted(res_steps.keys()) == sorted(ref_steps.keys())
+        for oid in ref_steps:
+            assert len(res_steps[oid]) == len(ref_steps[oid])
+            for (clock, sdir), (ref_clock, ref_sdir) in zip(
+                    res_steps[oid], ref_steps[oid]):
+                assert sdir == ref_sdir
+                assert abs(clock - ref_clock) <= MAX_ERROR
+        for pos, ref_pos in zip(positions, ref_positions):
+            assert pos == pytest.approx(ref_pos)
+        if kin == 'delta':
+            # Delta kinematics always use the iterative solver
+            assert res[0] == ref[0]
+
+def test_step_stats(tmpdir):
+    # The step statistics must match the transmitted commands
+    moves = make_moves(6, 50)
+    filename = str(tmpdir.join("stats.out"))
+    sg = StepGen('cartesian', filename, 0)
+    sg.run(moves)
+    stats = sg.stats()
+    sg.close()
+    msgs = [m for oid_msgs in decode_output(filename).values()
+            for m in oid_msgs if m[0] == 'queue_step']
+    assert int(stats['queue_step']) == len(msgs)
+    assert int(stats['steps']) == sum([dict(p)['count'] for n, p in msgs])
+    assert float(stats['compress_time']) > 0.
+
+def run_link(tmpdir, moves, baud, adaptive_error):
+    filename = str(tmpdir.join("link-%d-%d.out" % (baud, adaptive_error)))
+    sg = StepGen('corexy', filename, 0, baud=baud,
+                 adaptive_error=adaptive_error)
+    sg.run(moves)
+    stats = sg.stepper_stats()
+    sg.close()
+    return stats, decode_output(filename)
+
+def test_adaptive_error(tmpdir):
+    # A slow (simulated) serial link widens the step compression error
+    # and reduces the number of commands sent
+    moves = make_moves(7, 200)
+    ref_positions, ref = run_stepgen(tmpdir, 'corexy', moves, 0)
+    ref_msgs = sum([len(msgs) for msgs in ref.values()])
+    fast_stats, fast = run_link(tmpdir, moves, 100000000, 4 * MAX_ERROR)
+    assert fast == ref
+    for stats in fast_stats:
+        assert float(stats['avg_max_error']) == pytest.approx(
+            MAX_ERROR / MCU_FREQ, abs=1e-9)
+    slow_stats, slow = run_link(tmpdir, moves, 9600, 4 * MAX_ERROR)
+    assert sum([len(msgs) for msgs in slow.values()]) < ref_msgs
+    for stats in slow_stats:
+        assert MAX_ERROR / MCU_FREQ < float(stats['avg_max_error'])
+        assert float(stats['max_error']) <= 4 * MAX_ERROR / MCU_FREQ
+    # The steps must be within the widened error of the exact step times
+    exact_positions, exact = run_stepgen(tmpdir, 'corexy', moves, 0,
+                                         max_error=0)
+    exact_steps = step_clocks(exact)
+    slow_steps = step_clocks(slow)
+    for oid in exact_steps:
+        assert len(slow_steps[oid]) == len(exact_steps[oid])
+        for (clock, sdir), (exact_clock, exact_sdir) in zip(
+                slow_steps[oid], exact_steps[oid]):
+            assert sdir == exact_sdir
+            assert exact_clock - 4 * MAX_ERROR <= clock <= exact_clock
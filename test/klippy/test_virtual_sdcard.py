@@ -0,0 +1,243 @@
+# Tests for the virtual sdcard file reader and g-code cache
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, random
+import pytest
+
+from klippy import reactor
+from klippy.extras import virtual_sdcard
+
+class FakeGCode:
+    error = Exception
+    def __init__(self):
+        self.vsd = None
+        self.lines = []
+        self.pause_after = None
+        self.responses = []
+    def register_command(self, cmd, func, *args, **kwargs):
+        pass
+    def respond(self, msg):
+        self.responses.append(msg)
+    def respond_error(self, msg):
+        self.responses.append("!! " + msg)
+    def has_pending_input(self):
+        return False
+    def process_batch(self, commands):
+        for line in commands:
+            # Record the file position reported while the line runs
+            self.lines.append((self.vsd.file_position, line))
+            if self.pause_after is not None and len(
+                    self.lines) >= self.pause_after:
+                self.vsd.must_pause_work = True
+        return True
+
+class FakeToolHead:
+    def get_stall_count(self):
+        return 0
+
+class FakePrinter:
+    def __init__(self):
+        self.reactor = reactor.Reactor()
+        self.gcode = FakeGCode()
+    def get_reactor(self):
+        return self.reactor
+    def lookup_object(self, name, default=None):
+        return {'gcode': self.gcode, 'toolhead': FakeToolHead()}[name]
+
+class FakeConfig:
+    def __init__(self, path, cache_path=None):
+        self.printer = FakePrinter()
+        self.options = {'path': path, 'cache_path': cache_path}
+    def get_printer(self):
+        return self.printer
+    def get(self, name, default=None):
+        return self.options[name]
+
+def make_file(tmpdir, seed, count):
+    rnd = random.Random(seed)
+    lines = []
+    for i in range(count):
+        kind = rnd.random()
+        if kind < .05:
+            lines.append("")
+        elif kind < .10:
+            lines.append("; comment %d\r" % (i,))
+        else:
+            lines.append("G1 X%.3f Y%.3f E%.5f" % (
+                rnd.uniform(0, 200), rnd.uniform(0, 200), rnd.random()))
+    data = '\n'.join(lines)
+    if seed % 2:
+        data += '\n'
+    tmpdir.join("test.gcode").write_binary(data.encode())
+    return data
+
+def expected_lines(data, position=0):
+    out = []
+    for line in data[position:].split('\n'):
+        out.append((position, line))
+        position += len(line) + 1
+    if not out[-1][1]:
+        out.pop()
+    return out
+
+def start_sdcard(tmpdir, monkeypatch, cache_path=None):
+    monkeypatch.setattr(virtual_sdcard, 'READ_CHUNK_SIZE', 1000)
+    monkeypatch.setattr(virtual_sdcard, 'READ_AHEAD_CHUNKS', 3)
+    config = FakeConfig(str(tmpdir), cache_path)
+    vsd = virtual_sdcard.VirtualSD(config)
+    vsd.printer_state('ready')
+    gcode = config.printer.gcode
+    gcode.vsd = vsd
+    vsd.cmd_M23({'#original': "M23 test.gcode"})
+    return vsd, gcode
+
+def run_print(vsd):
+    vsd.cmd_M24({})
+    vsd.work_handler(vsd.reactor.monotonic())
+
+@pytest.mark.parametrize('seed', range(4))
+def test_read_lines(tmpdir, monkeypatch, seed):
+    data = make_file(tmpdir, seed, 3000)
+    vsd, gcode = start_sdcard(tmpdir, monkeypatch)
+    run_print(vsd)
+    assert gcode.lines == expected_lines(data)
+    assert gcode.responses[-1] == "Done printing file"
+    assert vsd.current_file is None
+    # The position does not go past the end of the file (even if the
+    # final line has no trailing newline)
+    assert vsd.file_position == vsd.file_size == len(data)
+
+def test_pause_resume(tmpdir, monkeypatch):
+    data = make_file(tmpdir, 1, 2000)
+    vsd, gcode = start_sdcard(tmpdir, monkeypatch)
+    for pause_after in (1, 300, 301, 1200):
+        gcode.pause_after = pause_after
+        run_print(vsd)
+        assert vsd.work_timer is None
+        assert vsd.file_position == expected_lines(data)[pause_after][0]
+    gcode.pause_after = None
+    run_print(vsd)
+    assert gcode.lines == expected_lines(data)
+
+def test_set_position(tmpdir, monkeypatch):
+    data = make_file(tmpdir, 0, 2000)
+    vsd, gcode = start_sdcard(tmpdir, monkeypatch)
+    position = expected_lines(data)[777][0]
+    vsd.gcode.get_int = (lambda name, params, minval: position)
+    vsd.cmd_M26({})
+    run_print(vsd)
+    assert gcode.lines == expected_lines(data, position)
+
+def expected_entries(data, position=0):
+    expected = expected_lines(data, position)
+    entries = virtual_sdcard.tokenize_lines([l for p, l in expected])
+    return [(p, e) for (p, l), e in zip(expected, entries)]
+
+def start_cached(tmpdir, monkeypatch):
+    cache_path = tmpdir.ensure_dir("cache")
+    vsd, gcode = start_sdcard(tmpdir, monkeypatch, str(cache_path))
+    return vsd, gcode, cache_path.join("test.gcode.cache")
+
+@pytest.mark.parametrize('seed', range(2))
+def test_cache(tmpdir, monkeypatch, seed):
+    data = make_file(tmpdir, seed, 3000)
+    # The first print builds the cache
+    vsd, gcode, cache_file = start_cached(tmpdir, monkeypatch)
+    assert vsd.cache_offset is None
+    run_print(vsd)
+    assert gcode.lines == expected_entries(data)
+    assert vsd.file_position == len(data)
+    assert cache_file.check()
+    # Later prints are run from the cache
+    vsd, gcode, cache_file = start_cached(tmpdir, monkeypatch)
+    assert vsd.cache_offset is not None
+    run_print(vsd)
+    assert gcode.lines == expected_entries(data)
+    assert vsd.file_position == len(data)
+    assert gcode.responses[-1] == "Done printing file"
+
+def test_cache_resume(tmpdir, monkeypatch):
+    data = make_file(tmpdir, 2, 2000)
+    virtual_sdcard.build_cache(str(tmpdir.join("test.gcode")),
+                               str(tmpdir.ensure_dir("cache").join(
+                                   "test.gcode.cache")))
+    vsd, gcode = start_sdcard(tmpdir, monkeypatch,
+                              str(tmpdir.join("cache")))
+    assert vsd.cache_offset is not None
+    for pause_after in (1, 500, 1500):
+        gcode.pause_after = pause_after
+        run_print(vsd)
+        assert vsd.file_position == expected_lines(data)[pause_after][0]
+    gcode.pause_after = None
+    run_print(vsd)
+    assert gcode.lines == expected_entries(data)
+    assert vsd.file_position == len(data)
+    # Set a position in the middle of a line - the g-code file is used
+    vsd, gcode, cache_file = start_cached(tmpdir, monkeypatch)
+    position = expected_lines(data)[1234][0] + 3
+    vsd.gcode.get_int = (lambda name, params, minval: position)
+    vsd.cmd_M26({})
+    run_print(vsd)
+    assert gcode.lines == expected_lines(data, position)
+
+def test_cache_invalidate(tmpdir, monkeypatch):
+    data = make_file(tmpdir, 0, 1000)
+    vsd, gcode, cache_file = start_cached(tmpdir, monkeypatch)
+    # A paused print does not store a cache
+    gcode.pause_after = 100
+    run_print(vsd)
+    assert not cache_file.check()
+    gcode.pause_after = None
+    run_print(vsd)
+    assert not cache_file.check()
+    vsd, gcode, cache_file = start_cached(tmpdir, monkeypatch)
+    run_print(vsd)
+    assert cache_file.check()
+    # Modifying the file invalidates the cache
+    data = make_file(tmpdir, 2, 1000)
+    os.utime(str(tmpdir.join("test.gcode")), (0, 0))
+    vsd, gcode, cache_file = start_cached(tmpdir, monkeypatch)
+    assert vsd.cache_offset is None
+    run_print(vsd)
+    assert gcode.lines == expected_entries(data)
+    vsd, gcode, cache_file = start_cached(tmpdir, monkeypatch)
+    assert vsd.cache_offset is not None
+
+def cache_block_offsets(cache_file, offset):
+    # Return the file offsets of the blocks in a cache file
+    data = cache_file.read_binary()
+    offsets = []
+    while offset < len(data):
+        offsets.append(offset)
+        position, length = virtual_sdcard.CACHE_BLOCK.unpack_from(
+            data, offset)
+        offset += virtual_sdcard.CACHE_BLOCK.size + length
+    return data, offsets
+
+@pytest.mark.parametrize('damage', ['truncate_block', 'truncate_cache',
+                                    'garbage'])
+def test_cache_corrupt(tmpdir, monkeypatch, damage):
+    # A corrupt cache is dropped and the print continues from the
+    # g-code file
+    data = make_file(tmpdir, 0, 2000)
+    vsd, gcode, cache_file = start_cached(tmpdir, monkeypatch)
+    run_print(vsd)
+    vsd, gcode, cache_file = start_cached(tmpdir, monkeypatch)
+    cache_data, offsets = cache_block_offsets(cache_file, vsd.cache_offset)
+    assert len(offsets) > 4
+    offset = offsets[3]
+    if damage == 'truncate_block':
+        cache_data = cache_data[:offset + 20]
+    elif damage == 'truncate_cache':
+        cache_data = cache_data[:offset]
+    else:
+        pos = offset + virtual_sdcard.CACHE_BLOCK.size
+        cache_data = cache_data[:pos] + b"\xff" * 16 + cache_data[pos + 16:]
+    cache_file.write_binary(cache_data)
+    run_print(vsd)
+    assert [p for p, l in gcode.lines] == [p for p, l in expected_lines(data)]
+    assert gcode.responses[-1] == "Done printing file"
+    assert vsd.file_position == len(data)
+    assert not cache_file.check()